@@ -25,19 +25,18 @@ from threading import RLock
 import cairo
 from gnome15 import g15driver
 from gnome15 import g15globals
-from gnome15.util import g15scheduler
 from gnome15.util import g15uigconf
 from gnome15.util import g15gconf
+from gnome15.util import g15frame
+from gnome15.util import g15metrics
 from gnome15 import g15uinput
+from gnome15 import g15stick
 from gnome15 import g15exceptions
 import sys
 import os
 from gi.repository import GConf
 from gi.repository import Gtk
 import logging
-from PIL import ImageMath
-from PIL import Image
-import array
 logger = logging.getLogger(__name__)
 load_error = None
 try :
@@ -220,16 +219,16 @@ class Driver(g15driver.AbstractDriver):
         g15driver.AbstractDriver.__init__(self, "g15direct")
         self.on_close = on_close
         self.device = device
-        self.timer = None
+        self.metrics = g15metrics.get_metrics(device.uid)
         self.joy_mode = None
         self.lock = RLock()
         self.down = []
-        self.move_x = 0
-        self.move_y = 0
+        self.stick = None
         self.connected = False
         self.conf_client = GConf.Client.get_default()
         self.last_keys = None
         self.last_ext_keys = None
+        self.mono_packer = None
         
         # We can only have one instance of this driver active in a single runtime
         self.allow_multiple = False
@@ -306,55 +305,22 @@ class Driver(g15driver.AbstractDriver):
              
         self.lock.acquire()        
         try :           
-            size = self.get_size()
+            if self.mono_packer is None:
+                width, height = self.get_size()
+                self.mono_packer = g15frame.MonoPacker(width, height, threshold = 170)
             
-            # Paint to 565 image provided into an ARGB image surface for PIL's benefit. PIL doesn't support 565?
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
-            
-            # Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            # colours dithered. It would be nice if Cairo could do this :( Any suggestions? 
-            pil_img = Image.frombuffer("RGBA", size, argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            #pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'L')",pil_img=pil_img)
-            #pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            #pil_img = pil_img.point(lambda i: i >= 250,'1')
-            pil_img = pil_img.point(lambda i: i >= 170,'1')
-            
-            invert_control = self.get_control("invert_lcd")
-            if invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-    
-            # Convert image buffer to string
-            buf = ""
-            for x in list(pil_img.getdata()): 
-                buf += chr(x)
-                
-            if len(buf) != self.device.lcd_size[0] * self.device.lcd_size[1]:
+            # Threshold and pack the surface straight to the LCD format. Pixels are lit
+            # for dark colours, unless the LCD is inverted
+            self.mono_packer.invert = self.get_control("invert_lcd").value == 0
+            with self.metrics.timer(g15metrics.STAGE_ENCODE):
+                buf = bytes(self.mono_packer.encode(img))
+            if len(buf) != ( self.device.lcd_size[0] * self.device.lcd_size[1] ) // 8:
                 logger.warning("Invalid buffer size")
             else:
-                # TODO Replace with C routine
-                arrbuf = array.array('B', self.empty_buf.encode())
-                width, height = self.get_size() 
-                max_byte_offset = 0
-                for x in range(0, width):
-                    for y in range(0, height):
-                        pixel_offset = y * width + x;
-                        byte_offset = pixel_offset // 8;
-                        max_byte_offset =  max(max_byte_offset, byte_offset)
-                        bit_offset = 7-(pixel_offset % 8);
-                        val = ord(buf[x+(y*160)])
-                        pv = arrbuf[byte_offset]
-                        if val > 0:
-                            arrbuf[byte_offset] = pv | 1 << bit_offset
-                        else:
-                            arrbuf[byte_offset] = pv &  ~(1 << bit_offset)
-                buf = arrbuf.tostring()
                 try :
                     logger.debug("Writing buffer of %d bytes", len(buf))
-                    pylibg15.write_pixmap(buf)
+                    with self.metrics.timer(g15metrics.STAGE_WRITE):
+                        pylibg15.write_pixmap(buf)
                 except IOError as e:
                     logger.error("Failed to send buffer.", exc_info = e)
                     self.disconnect()
@@ -373,11 +339,6 @@ class Driver(g15driver.AbstractDriver):
         self.callback = None
         self.notify_handles = [] 
                 
-        # Create an empty string buffer for use with monochrome LCD
-        self.empty_buf = ""
-        for _ in range(0, 861):
-            self.empty_buf += chr(0)
-        
         # TODO Enable UINPUT if multimedia key support is required?
         self.timeout = 10000
         e = self.conf_client.get("/apps/gnome15/%s/timeout" % self.device.uid)
@@ -409,6 +370,12 @@ class Driver(g15driver.AbstractDriver):
         self.joy_mode = self.conf_client.get_string("/apps/gnome15/%s/joymode" % self.device.uid)
         self.digital_calibration = g15gconf.get_int_or_default(self.conf_client, "/apps/gnome15/%s/digital_offset" % self.device.uid, 63)
         self.analogue_calibration = g15gconf.get_int_or_default(self.conf_client, "/apps/gnome15/%s/analogue_offset" % self.device.uid, 20)
+        c = self.analogue_calibration if self.joy_mode in [ g15uinput.JOYSTICK, g15uinput.MOUSE ] else self.digital_calibration
+        if self.stick is None:
+            self.stick = g15stick.StickEmulator("MouseMove", c)
+        else:
+            self.stick.stop()
+            self.stick.set_calibration(c)
             
     def _config_changed(self, client, connection_id, entry, *args):
         self._load_configuration()
@@ -419,6 +386,8 @@ class Driver(g15driver.AbstractDriver):
                 self.conf_client.notify_remove(h)
             logger.info("Exiting pylibg15")
             self.connected = False
+            if self.stick is not None:
+                self.stick.stop()
             if self.thread is not None:
                 self.thread.on_exit = pylibg15.exit
                 self.thread.deactivate()
@@ -489,12 +458,6 @@ class Driver(g15driver.AbstractDriver):
             this_keys += self._convert_ext_g15daemon_code(ext_code)
         
         if self.get_model_name() == g15driver.MODEL_G13:
-            c = self.analogue_calibration if self.joy_mode in [ g15uinput.JOYSTICK, g15uinput.MOUSE ] else self.digital_calibration
-            
-            low_val = g15uinput.JOYSTICK_CENTER - c
-            high_val = g15uinput.JOYSTICK_CENTER + c
-            max_step = 5
-                
             pos = pylibg15.get_joystick_position()
             """
             The device itself gives us joystick position values between 0 and 255.
@@ -513,12 +476,12 @@ class Driver(g15driver.AbstractDriver):
                     self._abs_joystick(this_keys, pos)
             elif self.joy_mode == g15uinput.DIGITAL_JOYSTICK:
                 if has_js:
-                    self._digital_joystick(this_keys, pos, low_val, high_val)
+                    self._digital_joystick(this_keys, pos)
             elif self.joy_mode == g15uinput.MOUSE:
                 if has_js:
-                    self._rel_mouse(this_keys, pos, low_val, high_val, max_step)                 
+                    self._rel_mouse(this_keys, pos)                 
             else:
-                self._emit_macro_keys(this_keys, pos, low_val, high_val)
+                self._emit_macro_keys(this_keys, pos)
         
         up = []
         down = []
@@ -561,13 +524,9 @@ class Driver(g15driver.AbstractDriver):
         
     def _do_uinput_keys(self, down, up):
         if len(down) > 0:
-            for uinput_code in down:
-                g15uinput.emit(g15uinput.KEYBOARD, uinput_code, 1, False)
-            g15uinput.syn(g15uinput.KEYBOARD)
+            g15uinput.emit_all([ (g15uinput.KEYBOARD, uinput_code, 1) for uinput_code in down ])
         if len(up) > 0:            
-            for uinput_code in up:
-                g15uinput.emit(g15uinput.KEYBOARD, uinput_code, 0, False)
-            g15uinput.syn(g15uinput.KEYBOARD)
+            g15uinput.emit_all([ (g15uinput.KEYBOARD, uinput_code, 0) for uinput_code in up ])
         
     def _do_macro_keys(self, down, up):
         if len(down) > 0:
@@ -589,14 +548,16 @@ class Driver(g15driver.AbstractDriver):
                 m.append(c)
         return m
         
-    def _emit_macro_keys(self, this_keys, pos, low_val, high_val):
-        if pos[0] < low_val:
+    def _emit_macro_keys(self, this_keys, pos):
+        dir_x = self.stick.direction(pos[0])
+        dir_y = self.stick.direction(pos[1])
+        if dir_x < 0:
             this_keys.append(g15driver.G_KEY_LEFT)                    
-        elif pos[0] > high_val:
+        elif dir_x > 0:
             this_keys.append(g15driver.G_KEY_RIGHT)                    
-        if pos[1] < low_val:
+        if dir_y < 0:
             this_keys.append(g15driver.G_KEY_UP)
-        elif pos[1] > high_val:
+        elif dir_y > 0:
             this_keys.append(g15driver.G_KEY_DOWN)
             
     def _check_js_buttons(self, joystick_type, this_keys):
@@ -609,53 +570,19 @@ class Driver(g15driver.AbstractDriver):
         self._check_buttons(g15uinput.MOUSE, this_keys, g15driver.G_KEY_JOY_DOWN, g15uinput.BTN_RIGHT)
         self._check_buttons(g15uinput.MOUSE, this_keys, g15driver.G_KEY_JOY_CENTER, g15uinput.BTN_MIDDLE)
         
-    def _rel_mouse(self, this_keys, pos, low_val, high_val, max_step):
+    def _rel_mouse(self, this_keys, pos):
         self._check_mouse_buttons(this_keys)
-        
-        relx = 0    
-        rely = 0
-        
-        if pos[0] < low_val:
-            relx = ( low_val - pos[0] ) * -1                    
-        elif pos[0] > high_val:
-            relx = pos[0] - high_val                    
-        if pos[1] < low_val:
-            rely = ( low_val - pos[1] ) * -1
-        elif pos[1] > high_val:
-            rely = pos[1] - high_val
-            
-        relx = -max_step if relx < -max_step else ( max_step if relx > max_step else relx)
-        rely = -max_step if rely < -max_step else ( max_step if rely > max_step else rely)
-            
-        self.move_x = relx
-        self.move_y = rely
-        if relx != 0 or rely != 0:
-            self._mouse_move() 
-        else:
-            if self.timer is not None:                    
-                self.timer.cancel()
+        self.stick.move(pos[0], pos[1])
         
     def _abs_joystick(self, this_keys, pos):
         self._check_js_buttons(g15uinput.JOYSTICK, this_keys)
-        g15uinput.emit(g15uinput.JOYSTICK, g15uinput.ABS_X, pos[0], syn=False)
-        g15uinput.emit(g15uinput.JOYSTICK, g15uinput.ABS_Y, pos[1])
+        g15uinput.emit_all([ (g15uinput.JOYSTICK, g15uinput.ABS_X, pos[0]),
+                             (g15uinput.JOYSTICK, g15uinput.ABS_Y, pos[1]) ])
 
-    def _digital_joystick(self, this_keys, pos, low_val, high_val):
+    def _digital_joystick(self, this_keys, pos):
         self._check_js_buttons(g15uinput.DIGITAL_JOYSTICK, this_keys)
-        pos_x = g15uinput.JOYSTICK_CENTER
-        pos_y = g15uinput.JOYSTICK_CENTER
-
-        if pos[0] < low_val:
-            pos_x = g15uinput.JOYSTICK_MIN
-        elif pos[0] > high_val:
-            pos_x = g15uinput.JOYSTICK_MAX
-        if pos[1] < low_val:
-            pos_y = g15uinput.JOYSTICK_MIN
-        elif pos[1] > high_val:
-            pos_y = g15uinput.JOYSTICK_MAX
-
-        g15uinput.emit(g15uinput.DIGITAL_JOYSTICK, g15uinput.ABS_X, pos_x, syn=False)
-        g15uinput.emit(g15uinput.DIGITAL_JOYSTICK, g15uinput.ABS_Y, pos_y)
+        g15uinput.emit_all([ (g15uinput.DIGITAL_JOYSTICK, g15uinput.ABS_X, self.stick.digital(pos[0])),
+                             (g15uinput.DIGITAL_JOYSTICK, g15uinput.ABS_Y, self.stick.digital(pos[1])) ])
         
     def _check_buttons(self, target, this_keys, key, button):        
         if key in this_keys:
@@ -667,14 +594,6 @@ class Driver(g15driver.AbstractDriver):
             g15uinput.emit(target, button, 0)
             self.down.remove(key)
         
-    def _mouse_move(self):
-        if self.move_x != 0 or self.move_y != 0:        
-            if self.move_x != 0:
-                g15uinput.emit(g15uinput.MOUSE, g15uinput.REL_X, self.move_x)        
-            if self.move_y != 0:
-                g15uinput.emit(g15uinput.MOUSE, g15uinput.REL_Y, self.move_y)
-            self.timer = g15scheduler.schedule("MouseMove", 0.05, self._mouse_move)
-        
     def _do_update_control(self, control):
         level = control.value
         logger.debug("Updating control %s to %s", str(control.id), str(control.value))
@@ -21,7 +21,6 @@ with the keyboard
 from gnome15 import g15locale
 _ = g15locale.get_translation("gnome15-drivers").gettext
 
-from io import StringIO
 from threading import RLock
 import cairo
 from gnome15 import g15driver
@@ -29,14 +28,16 @@ from gnome15 import g15globals
 from gnome15.util import g15convert
 from gnome15.util import g15uigconf
 from gnome15.util import g15cairo
+from gnome15.util import g15frame
+from gnome15.util import g15metrics
 from gnome15 import g15exceptions
 import sys
 import os
+import time
 from gi.repository import GConf
 from gi.repository import Gtk
 import usb
 import logging
-import array
 logger = logging.getLogger(__name__)
 
 # Import from local version of pylibg19 if available
@@ -151,7 +152,9 @@ class Driver(g15driver.AbstractDriver):
         g15driver.AbstractDriver.__init__(self, "g19direct")
         self.on_close = on_close
         self.device = device
+        self.metrics = g15metrics.get_metrics(device.uid)
         self.lock = RLock()
+        self.rgb565_encoder = None
         self.connected = False
         self.conf_client = GConf.Client.get_default()
     
@@ -203,43 +206,45 @@ class Driver(g15driver.AbstractDriver):
         if not self.is_connected():
             return
                 
+        encode_started = time.time()
         width = img.get_width()
         height = img.get_height()
-        # Create a new flipped, rotated image. The G19 expects the image to scan vertically, but
-        # the cairo image surface will be horizontal. Rotating then flipping the image is the
-        # quickest way to convert this. 16 bit color (5-6-5) is also required. Unfortunately this format
-        # was disabled for a long time, as was only re-enabled in version 1.8.6.
-        try:
-            back_surface = cairo.ImageSurface (4, height, width)
-        except Exception as e:
-            logger.debug('Could not create ImageSurface. Trying earlier API.', exc_info = e)
-            # Earlier version of Cairo
-            back_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, height, width)
-        
-        back_context = cairo.Context (back_surface)        
-        g15cairo.rotate_around_center(back_context, width, height, 270)
-        g15cairo.flip_horizontal(back_context, width, height)
-        back_context.set_source_surface(img, 0, 0)
-        back_context.set_operator(cairo.OPERATOR_SOURCE)
-        back_context.paint()
-        if back_surface.get_format() == cairo.FORMAT_ARGB32:
-            file_str = StringIO()
-            data = back_surface.get_data()
-            for i in range(0, len(data), 4):
-                r = ord(data[i + 2])
-                g = ord(data[i + 1])
-                b = ord(data[i + 0])
-                file_str.write(self._rgb_to_uint16(r, g, b))              
-            buf = array.array('B', b'file_str.getvalue()')   
-        else:   
-            buf = back_surface.get_data()
+        if self.rgb565_encoder is None:
+            # The G19 expects the image to scan vertically, so the encoder transposes
+            self.rgb565_encoder = g15frame.RGB565Encoder(width, height, transpose = True)
+        if g15frame.has_numpy():
+            buf = self.rgb565_encoder.encode(img)
+        else:
+            # Create a new flipped, rotated image. The G19 expects the image to scan vertically, but
+            # the cairo image surface will be horizontal. Rotating then flipping the image is the
+            # quickest way to convert this. 16 bit color (5-6-5) is also required. Unfortunately this format
+            # was disabled for a long time, as was only re-enabled in version 1.8.6.
+            try:
+                back_surface = cairo.ImageSurface (4, height, width)
+            except Exception as e:
+                logger.debug('Could not create ImageSurface. Trying earlier API.', exc_info = e)
+                # Earlier version of Cairo. Let the encoder do the conversion (and transpose)
+                back_surface = None
+
+            if back_surface is None:
+                buf = self.rgb565_encoder.encode(img)
+            else:
+                back_context = cairo.Context (back_surface)
+                g15cairo.rotate_around_center(back_context, width, height, 270)
+                g15cairo.flip_horizontal(back_context, width, height)
+                back_context.set_source_surface(img, 0, 0)
+                back_context.set_operator(cairo.OPERATOR_SOURCE)
+                back_context.paint()
+                buf = back_surface.get_data()
+        self.metrics.record(g15metrics.STAGE_ENCODE, time.time() - encode_started)
                   
-        expected_size = MAX_X * MAX_Y * ( self.get_bpp() / 8 )
+        expected_size = MAX_X * MAX_Y * ( self.get_bpp() // 8 )
         if len(buf) != expected_size:
             logger.warning("Invalid buffer size, expected %d, got %d", expected_size, len(buf))
         else:
             try:
-                self.lg19.send_frame(buf)
+                with self.metrics.timer(g15metrics.STAGE_WRITE):
+                    self.lg19.send_frame(buf)
             except usb.USBError as e:
                 logger.debug("Failed to send buffer.", exc_info = e)
                 self._on_receive_error(e)
@@ -349,17 +354,3 @@ class Driver(g15driver.AbstractDriver):
         except usb.USBError as e:
             logger.debug('Error updating control.', exc_info = e)
             self._on_receive_error(e)
-            
-    def _rgb_to_uint16(self, r, g, b):
-        rBits = r * 32 / 255
-        gBits = g * 64 / 255
-        bBits = b * 32 / 255
-
-        rBits = rBits if rBits <= 31 else 31
-        gBits = gBits if gBits <= 63 else 63
-        bBits = bBits if bBits <= 31 else 31        
-
-        valueH = (int(rBits) << 3) | (int(gBits) >> 3)
-        valueL = (int(gBits) << 5) | int(bBits)
-
-        return chr(valueL & 0xff) + chr(valueH & 0xff)
@@ -17,7 +17,6 @@
 from gnome15 import g15locale
 _ = g15locale.get_translation("gnome15-drivers").gettext
 
-from io import StringIO
 from pyinputevent.uinput import UInputDevice
 from pyinputevent.pyinputevent import InputEvent, SimpleDevice
 from pyinputevent.keytrans import *
@@ -28,8 +27,11 @@ from pyinputevent import scancodes as S
 from gnome15 import g15driver
 from gnome15.util import g15scheduler
 from gnome15.util import g15uigconf
+from gnome15.util import g15frame
+from gnome15.util import g15metrics
 from gnome15 import g15globals
 from gnome15 import g15uinput
+from gnome15 import g15stick
 from gi.repository import GConf
 import fcntl
 import os
@@ -38,8 +40,6 @@ import cairo
 import re
 import usb
 from . import fb
-from PIL import Image
-from PIL import ImageMath
 import array
 import struct
 import dbus
@@ -732,11 +732,11 @@ class ForwardDevice(AbstractInputDevice):
         self.alt = False
         self.shift = False
         self.current_x = g15uinput.JOYSTICK_CENTER
-        self.digital_down = []
         self.current_y = g15uinput.JOYSTICK_CENTER
-        self.last_x = g15uinput.JOYSTICK_CENTER
-        self.last_y = g15uinput.JOYSTICK_CENTER
-        self.move_timer = None
+        self.digital_x = g15uinput.JOYSTICK_CENTER
+        self.digital_y = g15uinput.JOYSTICK_CENTER
+        self.stick = g15stick.StickEmulator("MouseMove", driver.calibration,
+                                            max_step = 3, divisor = 8, interval = 0.1)
 
     def send_all(self, events):
         for event in events:
@@ -813,38 +813,10 @@ class ForwardDevice(AbstractInputDevice):
         event        --    event
         """
         if self.driver.joy_mode == g15uinput.DIGITAL_JOYSTICK:
-            self._record_current_absolute_position(event)
             self._digital_joystick(event)
         elif self.driver.joy_mode == g15uinput.MOUSE:
-            low_val = g15uinput.JOYSTICK_CENTER - self.driver.calibration
-            high_val = g15uinput.JOYSTICK_CENTER + self.driver.calibration
-            
-            if event.ecode == S.REL_X:
-                self.current_x = event.evalue - g15uinput.DEVICE_JOYSTICK_CENTER
-            if event.ecode == S.REL_Y:
-                self.current_y = event.evalue - g15uinput.DEVICE_JOYSTICK_CENTER
-            
-            # Get the amount between the current value and the centre to move
-            move_x = 0    
-            move_y = 0
-            if self.current_x >= high_val:
-                move_x = self.current_x - high_val
-            elif self.current_x <= low_val:
-                move_x = self.current_x - low_val
-            if self.current_y >= high_val:
-                move_y = self.current_y - high_val
-            elif self.current_y <= low_val:
-                move_y = self.current_y - low_val
-                
-            if self.current_x != self.last_x or self.current_y != self.last_y:
-                self.last_x = self.current_x
-                self.last_y = self.current_y 
-                self.move_x = self._clamp(-3, move_x / 8, 3)
-                self.move_y = self._clamp(-3, move_y / 8, 3) 
-                self._mouse_move()
-            else:
-                if self.move_timer is not None:                    
-                    self.move_timer.cancel()
+            self._record_current_absolute_position(event)
+            self.stick.move(self.current_x, self.current_y)
         else:
             self._emit_macro(event)
             
@@ -863,16 +835,6 @@ class ForwardDevice(AbstractInputDevice):
         elif ecode == S.BTN_Z:
             return g15uinput.BTN_MIDDLE
             
-    def _compute_bounds(self):
-        """
-        Calculate the distances from the (rough) centre position to the position
-        when movement each axis will start emiting events based on the 
-        current calibration value.
-          
-        """
-        return (g15uinput.JOYSTICK_CENTER - (self.driver.calibration),
-                g15uinput.JOYSTICK_CENTER + (self.driver.calibration))
-            
     def _emit_macro(self, event):
         """
         Emit macro keys for joystick positions, so they can be processed as all
@@ -882,15 +844,14 @@ class ForwardDevice(AbstractInputDevice):
         Keyword arguments:
         event        --    event 
         """
-        low_val, high_val = self._compute_bounds()
-        val = event.evalue - g15uinput.DEVICE_JOYSTICK_CENTER
+        direction = self.stick.direction(event.evalue - g15uinput.DEVICE_JOYSTICK_CENTER)
         if event.ecode == S.ABS_X:
-            if val < low_val:
+            if direction < 0:
                 self._release_keys([g15driver.G_KEY_RIGHT])
                 if not g15driver.G_KEY_LEFT in self.held_keys:
                     self.callback([g15driver.G_KEY_LEFT], g15driver.KEY_STATE_DOWN)
                     self.held_keys.append(g15driver.G_KEY_LEFT)
-            elif val > high_val:
+            elif direction > 0:
                 self._release_keys([g15driver.G_KEY_LEFT])
                 if not g15driver.G_KEY_RIGHT in self.held_keys:
                     self.callback([g15driver.G_KEY_RIGHT], g15driver.KEY_STATE_DOWN)
@@ -898,12 +859,12 @@ class ForwardDevice(AbstractInputDevice):
             else:                                         
                 self._release_keys([g15driver.G_KEY_LEFT,g15driver.G_KEY_RIGHT])    
         if event.ecode == S.ABS_Y:
-            if val < low_val:
+            if direction < 0:
                 self._release_keys([g15driver.G_KEY_DOWN])
                 if not g15driver.G_KEY_UP in self.held_keys:
                     self.callback([g15driver.G_KEY_UP], g15driver.KEY_STATE_DOWN)
                     self.held_keys.append(g15driver.G_KEY_UP)                        
-            elif val > high_val:
+            elif direction > 0:
                 self._release_keys([g15driver.G_KEY_UP])
                 if  not g15driver.G_KEY_DOWN in self.held_keys:
                     self.callback([g15driver.G_KEY_DOWN], g15driver.KEY_STATE_DOWN)
@@ -917,62 +878,21 @@ class ForwardDevice(AbstractInputDevice):
                 self.callback([k], g15driver.KEY_STATE_UP)
                 self.held_keys.remove(k)
     
-    def _clamp(self, minimum, x, maximum):
-        return max(minimum, min(x, maximum))
-
-    def _mouse_move(self):
-        if self.move_x != 0 or self.move_y != 0:
-            if self.move_x != 0:
-                g15uinput.emit(g15uinput.MOUSE, g15uinput.REL_X, self.move_x)        
-            if self.move_y != 0:
-                g15uinput.emit(g15uinput.MOUSE, g15uinput.REL_Y, self.move_y)
-            self.move_timer = g15scheduler.schedule("MouseMove", 0.1, self._mouse_move)
-        
     def _digital_joystick(self, event):
-        low_val, high_val = self._compute_bounds()
-        val = event.evalue - g15uinput.DEVICE_JOYSTICK_CENTER
-        if event.ecode == S.ABS_X:
-            if val < low_val and not "l" in self.digital_down:
-                self.digital_down.append("l")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_X,
-                               g15uinput.JOYSTICK_MIN)
-            elif val > high_val and not "r" in self.digital_down:
-                self.digital_down.append("r")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_X,
-                               g15uinput.JOYSTICK_MAX)
-            elif val >= low_val and val <= high_val and "l" in self.digital_down:
-                self.digital_down.remove("l")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_X,
-                               g15uinput.JOYSTICK_CENTER)
-            elif val >= low_val and val <= high_val and "r" in self.digital_down:
-                self.digital_down.remove("r")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_X,
-                               g15uinput.JOYSTICK_CENTER)
-        if event.ecode == S.ABS_Y:
-            if val < low_val and not "u" in self.digital_down:
-                self.digital_down.append("u")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_Y,
-                               g15uinput.JOYSTICK_MIN)
-            elif val > high_val and not "d" in self.digital_down:
-                self.digital_down.append("d")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_Y,
-                               g15uinput.JOYSTICK_MAX)
-            if val >= low_val and val <= high_val and "u" in self.digital_down:
-                self.digital_down.remove("u")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_Y,
-                               g15uinput.JOYSTICK_CENTER)
-            elif val >= low_val and val <= high_val and "d" in self.digital_down:
-                self.digital_down.remove("d")
-                g15uinput.emit(g15uinput.DIGITAL_JOYSTICK,
-                               g15uinput.ABS_Y,
-                               g15uinput.JOYSTICK_CENTER)
+        """
+        Emit a digital joystick axis event when the stick crosses into or out 
+        of the dead zone on that axis.
+        
+        Keyword arguments:
+        event        --    event
+        """
+        value = self.stick.digital(event.evalue - g15uinput.DEVICE_JOYSTICK_CENTER)
+        if event.ecode == S.ABS_X and value != self.digital_x:
+            self.digital_x = value
+            g15uinput.emit(g15uinput.DIGITAL_JOYSTICK, g15uinput.ABS_X, value)
+        elif event.ecode == S.ABS_Y and value != self.digital_y:
+            self.digital_y = value
+            g15uinput.emit(g15uinput.DIGITAL_JOYSTICK, g15uinput.ABS_Y, value)
 
 class Driver(g15driver.AbstractDriver):
 
@@ -981,9 +901,12 @@ class Driver(g15driver.AbstractDriver):
         self.notify_handles = []
         self.fb = None
         self.var_info = None
+        self.rgb565_encoder = None
+        self.mono_packer = None
         self.on_close = on_close
         self.key_thread = None
         self.device = device
+        self.metrics = g15metrics.get_metrics(device.uid)
         self.device_info = None
         self.system_service = None
         self.conf_client = GConf.Client.get_default()
@@ -1076,87 +999,69 @@ class Driver(g15driver.AbstractDriver):
     def paint(self, img):  
         if not self.fb:
             return 
+        with self.metrics.timer(g15metrics.STAGE_ENCODE):
+            buf = self._encode_frame(img)
+        if self.fb and self.fb.buffer:
+            with self.metrics.timer(g15metrics.STAGE_WRITE):
+                self.fb.buffer[0:len(buf)] = buf
+            
+    def paint_damaged(self, img, damage):
+        if not self.fb:
+            return False
+        with self.metrics.timer(g15metrics.STAGE_ENCODE):
+            buf = self._encode_frame(img)
+        if self.fb and self.fb.buffer:
+            # Both frame formats are row major, so just copy the changed rows
+            with self.metrics.timer(g15metrics.STAGE_WRITE):
+                row_bytes = self.fb.get_fixed_info().line_length
+                for y, h in damage:
+                    start = y * row_bytes
+                    end = ( y + h ) * row_bytes
+                    self.fb.buffer[start:end] = buf[start:end]
+        return True
+            
+    def _encode_frame(self, img):
         width = img.get_width()
         height = img.get_height()
-        character_width = width / 8
         fixed = self.fb.get_fixed_info()
-        padding = fixed.line_length - character_width
-        file_str = StringIO()
         
         if self.get_model_name() == g15driver.MODEL_G19:
-            try:
-                back_surface = cairo.ImageSurface (4, width, height)
-            except Exception as e:
-                logger.debug("Could not create ImageSurface. Trying earlier API.", exc_info = e)
-                # Earlier version of Cairo
-                back_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, width, height)
-            back_context = cairo.Context (back_surface)
-            back_context.set_source_surface(img, 0, 0)
-            back_context.set_operator (cairo.OPERATOR_SOURCE);
-            back_context.paint()
-                
-            if back_surface.get_format() == cairo.FORMAT_ARGB32:
-                """
-                If the creation of the type 4 image failed (i.e. earlier version of Cairo)
-                then we have to convert it ourselves. This is slow. 
-                
-                TODO Replace with C routine 
-                """
-                file_str = StringIO()
-                data = back_surface.get_data()
-                for i in range(0, len(data), 4):
-                    r = ord(data[i + 2])
-                    g = ord(data[i + 1])
-                    b = ord(data[i + 0])
-                    file_str.write(self.rgb_to_uint16(r, g, b))             
-                buf = file_str.getvalue()
-            else:   
-                buf = str(back_surface.get_data())
+            if self.rgb565_encoder is None:
+                self.rgb565_encoder = g15frame.RGB565Encoder(width, height)
+            if g15frame.has_numpy():
+                buf = self.rgb565_encoder.encode(img)
+            else:
+                try:
+                    back_surface = cairo.ImageSurface (4, width, height)
+                except Exception as e:
+                    logger.debug("Could not create ImageSurface. Trying earlier API.", exc_info = e)
+                    # Earlier version of Cairo
+                    back_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, width, height)
+                back_context = cairo.Context (back_surface)
+                back_context.set_source_surface(img, 0, 0)
+                back_context.set_operator (cairo.OPERATOR_SOURCE);
+                back_context.paint()
+
+                if back_surface.get_format() == cairo.FORMAT_ARGB32:
+                    """
+                    If the creation of the type 4 image failed (i.e. earlier version of Cairo)
+                    and NumPy is not available, we have to convert it ourselves. This is slow.
+                    """
+                    buf = self.rgb565_encoder.encode(back_surface)
+                else:
+                    buf = back_surface.get_data()
         else:
             width, height = self.get_size()
-            arrbuf = array.array('B', self.empty_buf)
+            if self.mono_packer is None or self.mono_packer.line_length != fixed.line_length:
+                # The framebuffer wants the least significant bit first, and may pad each row
+                self.mono_packer = g15frame.MonoPacker(width, height, threshold = 170, msb_first = False,
+                                                       line_length = fixed.line_length)
             
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
-            
-            '''
-            Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            colours dithered. It would be nice if Cairo could do this :( Any suggestions?
-            ''' 
-            pil_img = Image.frombuffer("RGBA", (width, height), argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            pil_img = pil_img.point(lambda i: i >= 250,'1')
-            
-            # Invert the screen if required
-            if g15_invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-            
-            # Data is 160x43, 1 byte per pixel. Will have value of 0 or 1.
-            width, height = self.get_size()
-            data = list(pil_img.getdata())
-            fixed = self.fb.get_fixed_info()
-            v = 0
-            b = 1
-            
-            # TODO Replace with C routine
-            for row in range(0, height):
-                for col in range(0, width):
-                    if data[( row * width ) + col]:
-                        v += b
-                    b = b << 1
-                    if b == 256:
-                        # Full byte
-                        b = 1          
-                        i = row * fixed.line_length + col / 8
-                        arrbuf[i] = v   
-                        v = 0 
-            buf = arrbuf.tostring()
-                
-        if self.fb and self.fb.buffer:
-            self.fb.buffer[0:len(buf)] = buf
+            # Threshold and pack the surface straight to the framebuffer format. Pixels are 
+            # lit for dark colours, unless the LCD is inverted
+            self.mono_packer.invert = g15_invert_control.value == 0
+            buf = self.mono_packer.encode(img)
+        return buf
             
     def process_svg(self, document):  
         if self.get_bpp() == 1:
@@ -1242,11 +1147,7 @@ class Driver(g15driver.AbstractDriver):
             if logger.isEnabledFor(logging.DEBUG):
                 self.fb.dump()
             self.var_info = self.fb.get_var_info()
-                    
-            # Create an empty string buffer for use with monochrome LCD
-            self.empty_buf = ""
-            for i in range(0, self.fb.get_fixed_info().smem_len):
-                self.empty_buf += chr(0)
+
             
         # Connect to DBUS        
         system_bus = dbus.SystemBus()
@@ -1260,9 +1161,8 @@ It should be launched automatically if Gnome15 is installed correctly.")
         
         # Centre the joystick by default
         if self.joy_mode in [ g15uinput.JOYSTICK, g15uinput.DIGITAL_JOYSTICK ]:
-            g15uinput.emit(self.joy_mode, g15uinput.ABS_X, g15uinput.JOYSTICK_CENTER, False)
-            g15uinput.emit(self.joy_mode, g15uinput.ABS_Y, g15uinput.JOYSTICK_CENTER, False)
-            g15uinput.syn(self.joy_mode)
+            g15uinput.emit_all([ (self.joy_mode, g15uinput.ABS_X, g15uinput.JOYSTICK_CENTER),
+                                 (self.joy_mode, g15uinput.ABS_Y, g15uinput.JOYSTICK_CENTER) ])
         
     def _on_disconnect(self):
         if not self.is_connected():
@@ -1294,6 +1194,10 @@ It should be launched automatically if Gnome15 is installed correctly.")
     
     def _stop_receiving_keys(self):
         if self.key_thread != None:            
+            for dev in self.key_thread.devices:
+                if isinstance(dev, ForwardDevice):
+                    dev.stick.stop()
+                    
             # Configure the keymap
             logger.info("Resetting keymap settings back to the way they were")
             self._set_keymap(self.original_keymap)
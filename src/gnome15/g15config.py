@@ -1532,7 +1532,7 @@ class G15Config:
             self._load_profile_list()
         
     def _copy_profile(self, widget):
-        dupe_profile = g15profile.get_profile(self.selected_device, self.selected_profile.id)
+        dupe_profile = g15profile.get_profile(self.selected_device, self.selected_profile.id).copy()
         dialog = self.widget_tree.get_object("CopyProfileDialog") 
         dialog.set_transient_for(self.main_window)
         
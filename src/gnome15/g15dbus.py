@@ -17,6 +17,7 @@
 import dbus.service
 from gnome15 import g15globals
 from . import g15theme
+from . import g15text
 from gnome15.util import g15scheduler as g15scheduler
 from gnome15.util import g15gconf as g15gconf
 from gnome15.util import g15cairo as g15cairo
@@ -67,6 +68,12 @@ class AbstractG15DBUSService(dbus.service.Object):
                     GLib.idle_add(self.KeysPressed, p)
                 return True
             
+    def is_consuming_keys(self, keys, state):
+        for k in keys:
+            if k in self._reserved_keys:
+                return True
+        return False
+            
     def _set_receive_actions(self, enabled):
         if enabled and self in self._screen.key_handler.action_listeners:
             raise Exception("Already receiving actions")
@@ -427,6 +434,49 @@ class G15DBUSScreenService(AbstractG15DBUSService):
     @dbus.service.method(SCREEN_IF_NAME, in_signature='b')
     def SetReceiveActions(self, enabled):
         self._set_receive_actions(enabled)
+        
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='as')
+    def GetMetricStages(self):
+        return self._screen.metrics.get_stage_names()
+        
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='s', out_signature='a{sd}')
+    def GetMetrics(self, stage):
+        return self._metric_values(self._screen.metrics.get_stats(stage))
+        
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='a{sd}')
+    def GetMetricCounters(self):
+        return dict(( k, float(v) ) for k, v in self._screen.metrics.get_counters().items())
+        
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='as')
+    def GetQueueNames(self):
+        return sorted(g15scheduler.get_queue_stats().keys())
+        
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='s', out_signature='a{sd}')
+    def GetQueueMetrics(self, queue_name):
+        stats = g15scheduler.get_queue_stats().get(queue_name)
+        if stats is None:
+            raise Exception("No queue named %s" % queue_name)
+        values = {}
+        for k in [ "workers", "max_size", "depth", "running", "queued", "executed", "coalesced", "dropped" ]:
+            values[k] = float(stats[k])
+        for h in [ "wait", "run" ]:
+            for k, v in self._metric_values(stats[h]).items():
+                values["%s_%s" % ( h, k )] = v
+        return values
+        
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='s')
+    def GetMetricsReport(self):
+        lines = [ self._screen.metrics.get_report() ]
+        for queue_name, stats in sorted(g15scheduler.get_queue_stats().items()):
+            lines.append("queue:%-14s n=%-5d wait p50 <= %4.0fms p90 <= %4.0fms max %6.1fms, dropped %d" % \
+                         ( queue_name, stats["wait"]["count"], stats["wait"]["p50"], stats["wait"]["p90"], stats["wait"]["max"], stats["dropped"] ))
+        for cache_name, stats in [ ( "surfaces", g15theme.surface_cache.get_stats() ), ( "text", g15text.get_stats() ) ]:
+            lines.append("cache:%-14s hits=%-7d misses=%d" % ( cache_name, stats["hits"], stats["misses"] ))
+        return "\n".join(lines)
+        
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='')
+    def ResetMetrics(self):
+        self._screen.metrics.reset()
     
     """
     DBUS Signals
@@ -502,6 +552,9 @@ class G15DBUSScreenService(AbstractG15DBUSService):
     def _cycle_screens_option_changed(self, client, connection_id, entry, *args):
         self.CyclingChanged(entry.value.get_bool())
     
+    def _metric_values(self, stats):
+        return dict(( k, float(stats[k]) ) for k in [ "count", "total", "mean", "max", "p50", "p90", "p99" ] if k in stats)
+    
     def _get_dimmable_controls(self):
         controls = []
         for c in self._screen.driver.get_controls():
@@ -681,6 +681,19 @@ class AbstractDriver(object):
         """
         raise NotImplementedError( "Not implemented" )
     
+    def paint_damaged(self, image, damage):
+        """
+        Repaint only the rows of the screen that have changed since the last
+        frame. Drivers that can write partial frames should override this and
+        return True, the default just repaints the whole screen.
+        
+        Keyword arguments:
+        image        -- surface to paint
+        damage       -- list of ( y, height ) tuples of changed rows
+        """
+        self.paint(image)
+        return False
+    
     
     def update_control(self, control):
         """
@@ -19,7 +19,9 @@ This module deals with handling raw key presses from the driver, and turning the
 into Macros or actions. The different types of macro are handled accordingly, as well
 as the repetition functions.
 
-All key events are handled on a queue (one per instance of a key handler). 
+All key events are handled on a queue (one per instance of a key handler). The
+exception is keys that are simply mapped to a uinput key, these are emitted
+straight from the thread the driver delivered them on.
 
 """
 
@@ -32,9 +34,54 @@ from . import g15driver
 from . import g15actions
 from . import g15uinput
 from . import g15screen
+from gnome15.util import g15metrics
+import time
 
 import logging
 logger = logging.getLogger(__name__)
+
+class MacroTable():
+    """
+    The macros that may be activated in one memory bank of a profile, with
+    those inherited from base profiles already merged in. Each list is also
+    indexed by key, so a key event only needs to look at the macros that 
+    use that key.
+    """
+    
+    def __init__(self, uinput_macros, normal_macros, held_macros, direct_macros = None):
+        """
+        Constructor
+        
+        Keyword arguments:
+        uinput_macros        -- uinput macros (any state)
+        normal_macros        -- other macros activated on key up or down
+        held_macros          -- other macros activated on key held
+        direct_macros        -- dictionary of key to (uinput device type, code) 
+                                for keys that may be dispatched directly
+        """
+        self.direct_macros = direct_macros if direct_macros is not None else {}
+        self.uinput_macros = uinput_macros
+        self.normal_macros = normal_macros
+        self.held_macros = held_macros
+        self.uinput_by_key = self._index(uinput_macros)
+        self.normal_by_key = self._index(normal_macros)
+        self.held_by_key = self._index(held_macros)
+        
+    def get_uinput_macros(self, key = None):
+        return self.uinput_macros if key is None else self.uinput_by_key.get(key, [])
+        
+    def get_normal_macros(self, key = None):
+        return self.normal_macros if key is None else self.normal_by_key.get(key, [])
+        
+    def get_held_macros(self, key = None):
+        return self.held_macros if key is None else self.held_by_key.get(key, [])
+        
+    def _index(self, macros):
+        index = {}
+        for m in macros:
+            for k in set(m.keys):
+                index.setdefault(k, []).append(m)
+        return index
    
 class KeyState():
     """
@@ -79,7 +126,9 @@ class G15KeyHandler():
         
         """
         List of callbacks invoked for raw key handling. Normally plugins shouldn't
-        use this, use actions instead
+        use this, use actions instead. Handlers that may take keys for themselves
+        should also provide is_consuming_keys(keys, state_id), see 
+        _is_consuming_keys()
         """
         self.key_handlers = []
         
@@ -88,11 +137,11 @@ class G15KeyHandler():
         self.__conf_client = self.__screen.conf_client
         self.__repeat_macros = []
         self.__macro_repeat_timer = None
-        self.__uinput_macros = []
-        self.__normal_macros = []
-        self.__normal_held_macros = []
+        self.__macro_table = MacroTable([], [], [])
+        self.__macro_tables = {}
         self.__notify_handles = []
         self.__key_states = {}
+        self.__direct_down = {}
         
     def get_key_states(self):
         # Get the current state of the keys
@@ -129,16 +178,22 @@ class G15KeyHandler():
         """
         This function starts processing of the provided keys, turning them
         into macros, actions and handling repetition. The key event will be
-        placed on the queue, leaving this function to return immediately
+        placed on the queue, leaving this function to return immediately. Keys
+        that are simply mapped to a uinput key are emitted before returning.
         
         Keyword arguments:
         keys            --    list of keys to process
         state_id           -- key state ID (g15driver.KEY_STATE_UP, _DOWN and _HELD)
         """
-        g15scheduler.execute(self.queue_name, "KeyReceived", self._do_key_received, keys, state_id)
+        received = time.time()
+        keys, direct_keys = self._dispatch_direct(keys, state_id, received)
+        if len(direct_keys) > 0:
+            g15scheduler.execute(self.queue_name, "DirectKeyReceived", self._do_direct_key_received, direct_keys, state_id)
+        if len(keys) > 0:
+            g15scheduler.execute(self.queue_name, "KeyReceived", self._do_key_received, keys, state_id, received)
             
     def memory_bank_changed(self, bank):
-        self._reload_active_macros()
+        self.__macro_table = self._get_macro_table()
         
     """
     Callbacks
@@ -156,19 +211,125 @@ class G15KeyHandler():
     """
         
     def _reload_active_macros(self):
-        self.__normal_held_macros = []
-        self.__normal_macros = []
-        self.__uinput_macros = []
-        self._build_macros()
+        # Any profile may be the base of the active one, so throw away all tables
+        self.__macro_tables = {}
+        self.__macro_table = self._get_macro_table()
+        
+    def _get_macro_table(self):
+        """
+        Get the macro table for the active profile and current memory bank,
+        building it if this combination has not been used since the
+        profiles last changed.
+        """
+        profile = g15profile.get_active_profile(self.__screen.device)
+        if profile is None:
+            return MacroTable([], [], [])
+        bank = self.__screen.get_memory_bank()
+        table_key = ( profile.id, bank )
+        table = self.__macro_tables.get(table_key)
+        if table is None:
+            table = self._build_macros(profile, bank)
+            self.__macro_tables[table_key] = table
+        return table
+        
+    def _dispatch_direct(self, keys, state_id, received):
+        """
+        Emit uinput events for keys that are simply mapped to a uinput key,
+        without going through the queue. This is called on the driver's 
+        thread, so only uses the current macro table (which is replaced, never
+        modified) and the record of which keys were pressed this way. 
+        
+        Direct dispatch is not used while any key handler may consume the keys
+        (e.g. the visible page handles keys itself, or a macro is being
+        recorded), but a release is always sent directly if the press was.
+        Returns a tuple of the keys that still need normal handling, and those
+        that were dispatched.
+        
+        Keyword arguments:
+        keys        --    list of keys
+        state_id    --    key state (g15driver.KEY_STATE_UP or _DOWN)
+        received    --    time the keys were received
+        """
+        direct_macros = self.__macro_table.direct_macros
+        if state_id == g15driver.KEY_STATE_DOWN:
+            if len(direct_macros) == 0:
+                return keys, []
+            if self._is_consuming_keys(keys, state_id):
+                return keys, []
+        elif state_id != g15driver.KEY_STATE_UP or len(self.__direct_down) == 0:
+            return keys, []
+            
+        remaining = []
+        direct_keys = []
+        events = []
+        for key in keys:
+            if state_id == g15driver.KEY_STATE_DOWN:
+                target = direct_macros.get(key)
+                if target is not None:
+                    self.__direct_down[key] = target
+                    events.append(( target[0], target[1], 1 ))
+            else:
+                target = self.__direct_down.pop(key, None)
+                if target is not None:
+                    events.append(( target[0], target[1], 0 ))
+            if target is None:
+                remaining.append(key)
+            else:
+                direct_keys.append(key)
+                
+        if len(events) > 0:
+            g15uinput.emit_all(events)
+            self.__screen.metrics.record(g15metrics.STAGE_KEY_DIRECT, time.time() - received)
+        return remaining, direct_keys
+        
+    def _is_consuming_keys(self, keys, state_id):
+        """
+        Get if any key handler may consume the keys, in which case they must
+        not be dispatched directly. This is called on the driver's thread, so
+        handlers' is_consuming_keys() must be quick and not block. A handler
+        without is_consuming_keys() is only ever given keys after they have
+        been dispatched.
+        
+        Keyword arguments:
+        keys        --    list of keys
+        state_id    --    key state (g15driver.KEY_STATE_UP, _DOWN and _HELD)
+        """
+        for h in self.key_handlers:
+            if hasattr(h, "is_consuming_keys") and h.is_consuming_keys(keys, state_id):
+                return True
+        return False
+        
+    def _do_direct_key_received(self, keys, state_id):
+        """
+        Update the key states and let the key handlers know about keys that
+        have already been emitted by direct dispatch. The keys are not used by
+        any other macro or action, so nothing else needs to be done.
         
-    def _do_key_received(self, keys, state_id):
+        Keyword arguments:
+        keys        --    list of keys
+        state_id    --    key state (g15driver.KEY_STATE_UP or _DOWN)
+        """
+        consumed = self._handle_key(keys, state_id, post=False)
+        for key in keys:
+            self._configure_key_state(key, state_id)
+        consumed = self._handle_key(keys, state_id, post=True) or consumed
+        self._clear_released_key_states()
+        if consumed:
+            self.__screen.redraw()
+        
+    def _do_key_received(self, keys, state_id, received = None):
         """
         Actual handling of key events.
         
         Keyword arguments:
         keys        --    list of keys
         state_id    --    key state (g15driver.KEY_STATE_UP, _DOWN and _HELD)
+        received    --    time the keys were received from the driver, or 
+                          None for generated events (i.e. held)
         """
+        if received is not None:
+            self.__screen.metrics.record(g15metrics.STAGE_KEY_QUEUED, time.time() - received)
+            
                
         """
         See if the screen itself, or the plugins, want to handle the key. This
@@ -177,8 +338,10 @@ class G15KeyHandler():
         that want to take over key handling, such as screensaver which 
         disables all keys while it is active.
         """ 
+        consumed = False
         try:
             if self._handle_key(keys, state_id, post=False):
+                consumed = True
                 return  
             
             """
@@ -197,45 +360,53 @@ class G15KeyHandler():
                     a press of the Macro key equals a "press" of the virtual key,
                     a release of the Macro key equals a "release" of the virtual key etc.  
                     """
-                    self._handle_uinput_macros()
+                    self._handle_uinput_macros(key)
                     
                     """
                     Now the ordinary macros, processed on key_up
                     """
-                    self._handle_normal_macros()
+                    if self._handle_normal_macros(key):
+                        consumed = True
                     
                     """
                     Now the actions
                     """
-                    self._handle_actions()
+                    if self._handle_actions():
+                        consumed = True
                 
             """
             Now do the legacy 'post' handling.
             """
-            if not self._handle_key(keys, state_id, post=True):
-                pass
+            if self._handle_key(keys, state_id, post=True):
+                consumed = True
                     
-            """
-            When ALL keys are UP, clear out the state 
-            """
-            up = 0
-            for k, v in list(self.__key_states.items()):
-                if v.state_id == g15driver.KEY_STATE_UP:
-                    up += 1
-            if up > 0 and up == len(self.__key_states):
-                self.__key_states = {}
+            self._clear_released_key_states()
         finally:
             """
-            Always redraw the current page on key presses
+            Redraw the current page if anything other than a uinput macro 
+            handled the key
             """
-            self.__screen.redraw()
+            if consumed:
+                self.__screen.redraw()
+            
+    def _clear_released_key_states(self):
+        """
+        When ALL keys are UP, clear out the state 
+        """
+        up = 0
+        for k, v in list(self.__key_states.items()):
+            if v.state_id == g15driver.KEY_STATE_UP:
+                up += 1
+        if up > 0 and up == len(self.__key_states):
+            self.__key_states = {}
             
     def _handle_actions(self):
         """
         This handles the default action bindings. The actions may have
         already re-mapped as a macro, in which case they will be ignored 
-        here.
+        here. Returns True if any action was activated.
         """
+        performed = False
         action_keys = self.__screen.driver.get_action_keys()
         if action_keys:
             for action in action_keys:
@@ -248,15 +419,20 @@ class G15KeyHandler():
                         f += 1
                 if f == len(binding.keys):
                     self._action_performed(binding)
+                    performed = True
                     for k in binding.keys:
                         self.__key_states[k].consume_until_release = True
+        return performed
         
-    def _handle_normal_macros(self):
+    def _handle_normal_macros(self, key = None):
         """
         First check for any KEY_STATE_HELD macros. We do these first so KEY_STATE_UP
-        macros don't consume the key states
+        macros don't consume the key states. Only macros that use the key that
+        changed need to be checked. Returns True if any macro was activated.
         """        
-        for m in self.__normal_held_macros:
+        handled = False
+        table = self.__macro_table
+        for m in table.get_held_macros(key):
             held = []
             for k in m.keys:
                 if k in self.__key_states:
@@ -266,13 +442,14 @@ class G15KeyHandler():
                         
             if len(held) == len(m.keys):
                 self._handle_macro(m, g15driver.KEY_STATE_HELD, held)
+                handled = True
         
         
         """
         Search for all the non-uinput macros that would be activated by the
         current key state. In this case, KEY_STATE_UP macros are looked for
         """
-        for m in self.__normal_macros:
+        for m in table.get_normal_macros(key):
             up = []
             held = []
             down = []
@@ -288,19 +465,24 @@ class G15KeyHandler():
                         
             if len(up) == len(m.keys):
                 self._handle_macro(m, g15driver.KEY_STATE_UP, up)
+                handled = True
             if len(down) == len(m.keys):
                 self._handle_macro(m, g15driver.KEY_STATE_DOWN, down)
+                handled = True
             if len(held) == len(m.keys):
                 self._handle_macro(m, g15driver.KEY_STATE_HELD, held)
+                handled = True
+        return handled
                 
             
-    def _handle_uinput_macros(self):
+    def _handle_uinput_macros(self, key = None):
         """
         Search for all the uinput macros that would be activated by the
-        current key state, and emit events of the same type.
+        current key state, and emit events of the same type. If a key is
+        provided, only macros that use that key are checked.
         """
         uinput_repeat = False
-        for m in self.__uinput_macros:
+        for m in self.__macro_table.get_uinput_macros(key):
             down = []
             up = []
             held = []
@@ -382,76 +564,98 @@ class G15KeyHandler():
             
             return True
                 
-    def _get_all_macros(self, profile = None, macro_list = None, macro_keys = None, mapped_to_key = False, state = None):
+    def _get_all_macros(self, profile = None, mapped_to_key = False, state = None):
         """
         Get all macros, including those in parent profiles. By default, the
         "root" is the active profile
         
-        Keyword argumentsL
+        Keyword arguments:
         profile        -- root profile or None for active profile
-        macro_list     -- list to append macros to.
         mapped_to_key  -- boolean indicator whether to only find UINPUT type macros
+        state          -- key state the macros are activated on (defaults to KEY_STATE_UP)
         """
         if profile is None:
             profile = g15profile.get_active_profile(self.__screen.device)
-        if macro_list is None:
-            macro_list = []
-        if macro_keys is None:
-            macro_keys = []
-            
         if state == None:
             state = g15driver.KEY_STATE_UP
-             
-        bank = self.__screen.get_memory_bank()
-        for m in profile.macros[state][bank - 1]:
-            if not m.key_list_key in macro_keys:
-                if ( not mapped_to_key and not m.is_uinput() ) or \
-                    ( mapped_to_key and m.is_uinput() ):
-                    macro_list.append(m)
-                    macro_keys.append(m.key_list_key)
-        if profile.base_profile is not None:
+        return [ m for macro_state, m in self._resolve_macros(profile, self.__screen.get_memory_bank()) \
+                 if macro_state == state and m.is_uinput() == mapped_to_key ]
+    
+    def _resolve_macros(self, profile, bank):
+        """
+        Get the macros of a memory bank as a list of ( key state, macro ),
+        with those from the profile taking precedence over those with the same
+        keys inherited from its base profiles.
+        
+        Keyword arguments:
+        profile        -- profile
+        bank           -- memory bank number
+        """
+        resolved = []
+        seen = { g15driver.KEY_STATE_UP : set(),
+                 g15driver.KEY_STATE_DOWN : set(),
+                 g15driver.KEY_STATE_HELD : set() }
+        visited = set()
+        while profile is not None and not profile.id in visited:
+            visited.add(profile.id)
+            for state in [ g15driver.KEY_STATE_UP, g15driver.KEY_STATE_DOWN, g15driver.KEY_STATE_HELD ]:
+                for m in profile.macros[state][bank - 1]:
+                    if not m.key_list_key in seen[state]:
+                        seen[state].add(m.key_list_key)
+                        resolved.append(( state, m ))
+            if profile.base_profile is None or profile.base_profile == "":
+                break
             profile = g15profile.get_profile(self.__screen.device, profile.base_profile)
-            if profile is not None:
-                self._get_all_macros(profile, macro_list, macro_keys, mapped_to_key, state)
-        return macro_list
+        return resolved
     
-    def _build_macros(self, profile = None, macro_keys = None, held_macro_keys = None, down_macro_keys = None):
-        if profile is None:
-            profile = g15profile.get_active_profile(self.__screen.device)
-        if macro_keys is None:
-            macro_keys = []
-        if held_macro_keys is None:
-            held_macro_keys = []
-        if down_macro_keys is None:
-            down_macro_keys = []
-            
-        bank = self.__screen.get_memory_bank()
-        for m in profile.macros[g15driver.KEY_STATE_UP][bank - 1]:
-            if not m.key_list_key in macro_keys:
-                if m.is_uinput():
-                    self.__uinput_macros.append(m)
-                else:
-                    self.__normal_macros.append(m)
-                macro_keys.append(m.key_list_key)
-                
-        for m in profile.macros[g15driver.KEY_STATE_DOWN][bank - 1]:
-            if not m.key_list_key in down_macro_keys:
-                if m.is_uinput():
-                    self.__uinput_macros.append(m)
-                else:
-                    self.__normal_macros.append(m)
-                down_macro_keys.append(m.key_list_key)
-                
-        for m in profile.macros[g15driver.KEY_STATE_HELD][bank - 1]:
-            if not m.key_list_key in held_macro_keys:
+    def _build_macros(self, profile, bank):
+        """
+        Build the macro table for a memory bank of a profile
+        
+        Keyword arguments:
+        profile        -- profile
+        bank           -- memory bank number
+        """
+        uinput_macros = []
+        normal_macros = []
+        held_macros = []
+        for state, m in self._resolve_macros(profile, bank):
+            if state == g15driver.KEY_STATE_HELD:
                 if not m.is_uinput():
-                    self.__normal_held_macros.append(m)
-                held_macro_keys.append(m.key_list_key)
-                
-        if profile.base_profile is not None:
-            profile = g15profile.get_profile(self.__screen.device, profile.base_profile)
-            if profile is not None:
-                self._build_macros(profile, macro_keys, held_macro_keys, down_macro_keys)
+                    held_macros.append(m)
+            elif m.is_uinput():
+                uinput_macros.append(m)
+            else:
+                normal_macros.append(m)
+        return MacroTable(uinput_macros, normal_macros, held_macros,
+                          self._get_direct_macros(uinput_macros, normal_macros + held_macros))
+    
+    def _get_direct_macros(self, uinput_macros, other_macros):
+        """
+        Find the keys that may be dispatched directly. These are single keys
+        mapped to a uinput key with the default repeat behaviour (press on
+        key down, release on key up), that are not used by any other macro or
+        action binding.
+        
+        Keyword arguments:
+        uinput_macros        -- uinput macros
+        other_macros         -- all other macros
+        """
+        used = {}
+        for m in uinput_macros + other_macros:
+            for k in set(m.keys):
+                used[k] = used.get(k, 0) + 1
+        action_keys = self.__screen.driver.get_action_keys()
+        if action_keys:
+            for binding in action_keys.values():
+                for k in binding.keys:
+                    used[k] = used.get(k, 0) + 1
+        direct_macros = {}
+        for m in uinput_macros:
+            if len(m.keys) == 1 and used[m.keys[0]] == 1 and \
+                    m.repeat_mode == g15profile.REPEAT_WHILE_HELD and m.repeat_delay == -1:
+                direct_macros[m.keys[0]] = ( m.type, m.get_uinput_code() )
+        return direct_macros
                 
     def _check_key_state(self, new_state_id, key_state):
         """
@@ -18,6 +18,7 @@ import dbus
 from gnome15.util import g15scheduler as g15scheduler
 from gnome15.util import g15cairo as g15cairo
 from gnome15.util import g15icontools as g15icontools
+from gnome15.util import g15metrics as g15metrics
 from . import g15theme
 from . import g15screen
 import sys
@@ -288,7 +289,8 @@ class G15RefreshingPlugin(G15PagePlugin):
         self._reschedule_refresh()
 
     def _do_refresh(self):
-        self.refresh()
+        with self.screen.metrics.timer(g15metrics.STAGE_PLUGIN_PREFIX + self.page_id):
+            self.refresh()
         self.screen.redraw(self.page)
     
 class G15MenuPlugin(G15Plugin):
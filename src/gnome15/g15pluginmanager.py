@@ -398,6 +398,24 @@ class G15Plugins():
                 return True 
         return False
     
+    def is_consuming_keys(self, keys, state):
+        """
+        Get if any plugin may consume the provided key event in handle_key(). 
+        Plugins that handle keys but do not say when they consume them with
+        their own is_consuming_keys() are assumed to always consume them.
+        
+        Keyword arguments:
+        keys -- list of keys
+        state -- key state
+        """
+        for plugin in list(self.started):
+            if hasattr(plugin, 'is_consuming_keys'):
+                if plugin.is_consuming_keys(keys, state):
+                    return True
+            elif hasattr(plugin, 'handle_key'):
+                return True
+        return False
+    
     def activate(self, callback=None, plugin=None):
         """
         Activate all plugins that currently started.
@@ -28,6 +28,7 @@ from gnome15.util import g15convert as g15convert
 from gnome15.util import g15gconf as g15gconf
 from gnome15.util import g15os as g15os
 from gnome15.util import g15icontools as g15icontools
+from gnome15.util import g15scheduler as g15scheduler
 from . import g15globals
 from . import g15actions
 from . import g15devices
@@ -39,8 +40,13 @@ import os.path
 import stat
 import pyinotify
 import logging
+from threading import RLock
+from collections import deque
 import re
 import zipfile
+import pickle
+import hashlib
+import atexit
 from io import StringIO
  
 logger = logging.getLogger(__name__)
@@ -55,7 +61,8 @@ to be informed when macro profiles change
 profile_listeners = []
 
 wm = pyinotify.WatchManager()
-mask = pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_ATTRIB  # watched events
+mask = pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_ATTRIB | \
+       pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM  # watched events
 
 # Create macro profiles directory
 conf_dir = os.path.join(g15globals.user_config_dir, "macro_profiles")
@@ -74,9 +81,16 @@ class EventHandler(pyinotify.ProcessEvent):
             id_no = path.split(".")[0]
             return ( id_no, device_uid )
     
-    def _notify(self, event):
+    def _notify(self, event, deleted = False):
         ids = self._get_profile_ids(event)
         if ids:
+            # Bring the registry up to date before telling anyone
+            registry = _registries.get(ids[1])
+            if registry is not None:
+                if deleted:
+                    registry.remove(event.pathname)
+                elif not _is_own_write(event.pathname):
+                    registry.reload(event.pathname)
             for profile_listener in profile_listeners:
                 profile_listener(ids[0], ids[1])
         
@@ -88,15 +102,291 @@ class EventHandler(pyinotify.ProcessEvent):
         
     def process_IN_ATTRIB(self, event):
         self._notify(event)
+        
+    def process_IN_MOVED_TO(self, event):
+        self._notify(event)
 
     def process_IN_DELETE(self, event):
-        self._notify(event)
+        self._notify(event, True)
+        
+    def process_IN_MOVED_FROM(self, event):
+        self._notify(event, True)
+        
+class WindowNameMatcher(object):
+    """
+    Finds the first profile whose window name appears in an application name,
+    in a single pass over the application name however many profiles there
+    are (an Aho-Corasick automaton over the lower-cased window names).
+    """
+    
+    def __init__(self, profiles):
+        """
+        Constructor
+        
+        Keyword arguments:
+        profiles        -- profiles in priority order
+        """
+        self.profiles = profiles
+        self.goto = [ {} ]
+        self.fail = [ 0 ]
+        
+        # Lowest index of the profiles whose pattern ends at each state (or None)
+        self.best = [ None ]
+        for index, profile in enumerate(profiles):
+            state = 0
+            for ch in profile.window_name.lower():
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                state = next_state
+            if self.best[state] is None:
+                self.best[state] = index
+                
+        # Breadth first, so the fail state of a parent is done before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                f = self.fail[state]
+                while f and not ch in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[next_state] = f if f != next_state else 0
+                if self.best[f] is not None and ( self.best[next_state] is None or self.best[f] < self.best[next_state] ):
+                    self.best[next_state] = self.best[f]
+                    
+    def match(self, application_name):
+        """
+        Get the first profile matching an application name, or None
+        
+        Keyword arguments:
+        application_name        -- application name
+        """
+        best = None
+        state = 0
+        goto = self.goto
+        fail = self.fail
+        for ch in application_name.lower():
+            while state and not ch in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            found = self.best[state]
+            if found is not None and ( best is None or found < best ):
+                best = found
+                if best == 0:
+                    break
+        return self.profiles[best] if best is not None else None
+        
+class ProfileRegistry(object):
+    """
+    Holds every profile available to a device, so each profile file is only
+    parsed when it first seen or when it changes. The EventHandler keeps the
+    registry up to date with the files in the user's profile directory. 
+    Directories added by plugins are only scanned once.
+    """
+    
+    def __init__(self, device):
+        """
+        Constructor
+        
+        Keyword arguments:
+        device        -- device
+        """
+        self.device = device
+        self.lock = RLock()
+        self.profiles = {}
+        self.scanned_dirs = []
+        self._reindex()
+        
+    def get(self, profile_id):
+        """
+        Get a profile given its ID. If more than one directory has a profile
+        with this ID, the one from the first directory is returned.
+        
+        Keyword arguments:
+        profile_id        -- profile ID
+        """
+        self.lock.acquire()
+        try:
+            self._scan()
+            return self.by_id.get(str(profile_id))
+        finally:
+            self.lock.release()
+            
+    def get_by_name(self, name):
+        self.lock.acquire()
+        try:
+            self._scan()
+            return self.by_name.get(name)
+        finally:
+            self.lock.release()
+            
+    def get_all(self, model_id = None):
+        """
+        Get all profiles (in directory order) for a model
+        
+        Keyword arguments:
+        model_id        -- model ID, or None for the device's model
+        """
+        self.lock.acquire()
+        try:
+            self._scan()
+            return list(self.by_model.get(model_id if model_id is not None else self.device.model_id, []))
+        finally:
+            self.lock.release()
+            
+    def match_window_name(self, application_name):
+        """
+        Get the first profile that should be activated when an application
+        gets focus (not including the default profile), or None. Results are
+        remembered until the profiles change.
+        
+        Keyword arguments:
+        application_name        -- window or application name
+        """
+        self.lock.acquire()
+        try:
+            self._scan()
+            if application_name in self.match_cache:
+                return self.match_cache[application_name]
+            if self.matcher is None:
+                default_profile = self.by_id.get("0", self.by_id.get("Default"))
+                self.matcher = WindowNameMatcher([ p for p in self.by_model.get(self.device.model_id, []) \
+                                                   if p.activate_on_focus and len(p.window_name) > 0 and p != default_profile ])
+            if len(self.match_cache) >= MATCH_CACHE_SIZE:
+                self.match_cache.clear()
+            profile = self.matcher.match(application_name)
+            self.match_cache[application_name] = profile
+            return profile
+        finally:
+            self.lock.release()
+            
+    def reload(self, path):
+        """
+        Parse a single profile file again
+        
+        Keyword arguments:
+        path        -- path of profile file
+        """
+        if not os.path.exists(path):
+            self.remove(path)
+            return
+        profile_id = ".".join(os.path.basename(path).split(".")[:-1])
+        try:
+            profile = G15Profile(self.device, profile_id, file_path = path)
+        except Exception as e:
+            logger.warning("Failed to load profile %s, keeping last good version", path, exc_info = e)
+            return
+        self.put(path, profile)
+        
+    def put(self, path, profile):
+        self.lock.acquire()
+        try:
+            self.profiles[path] = profile
+            self._reindex()
+        finally:
+            self.lock.release()
+            
+    def remove(self, path):
+        self.lock.acquire()
+        try:
+            if path in self.profiles:
+                del self.profiles[path]
+                self._reindex()
+        finally:
+            self.lock.release()
+            
+    def invalidate_dir(self, profile_dir):
+        """
+        Forget everything loaded from a directory, so it will be scanned again
+        when next needed
+        
+        Keyword arguments:
+        profile_dir        -- directory
+        """
+        self.lock.acquire()
+        try:
+            for path in list(self.profiles.keys()):
+                if os.path.dirname(path) == profile_dir:
+                    del self.profiles[path]
+            if profile_dir in self.scanned_dirs:
+                self.scanned_dirs.remove(profile_dir)
+            self._reindex()
+        finally:
+            self.lock.release()
+        
+    def _scan(self):
+        changed = False
+        for profile_dir in get_all_profile_dirs(self.device):
+            if profile_dir in self.scanned_dirs:
+                continue
+            self.scanned_dirs.append(profile_dir)
+            if os.path.exists(profile_dir):
+                for profile in os.listdir(profile_dir):
+                    if not profile.startswith(".") and profile.endswith(".macros"):
+                        path = "%s/%s" % ( profile_dir, profile )
+                        if not path in self.profiles:
+                            profile_id = ".".join(profile.split(".")[:-1])
+                            try:
+                                self.profiles[path] = G15Profile(self.device, profile_id, file_path = path)
+                                changed = True
+                            except Exception as e:
+                                logger.warning("Failed to load profile %s", path, exc_info = e)
+        if changed:
+            self._reindex()
+            
+    def _reindex(self):
+        by_id = {}
+        by_name = {}
+        by_model = {}
+        dirs = get_all_profile_dirs(self.device)
+        def dir_index(path):
+            d = os.path.dirname(path)
+            return dirs.index(d) if d in dirs else len(dirs)
+        for path in sorted(self.profiles.keys(), key = dir_index):
+            profile = self.profiles[path]
+            if not profile.id in by_id:
+                by_id[profile.id] = profile
+            for model_id in profile.models:
+                by_model.setdefault(model_id, []).append(profile)
+                if model_id == self.device.model_id and not profile.name in by_name:
+                    by_name[profile.name] = profile
+        self.by_id = by_id
+        self.by_name = by_name
+        self.by_model = by_model
+        self.matcher = None
+        self.match_cache = {}
+        
+_registries = {}
+_registries_lock = RLock()
+
+def get_registry(device):
+    """
+    Get the profile registry for a device, creating it if required.
+    
+    Keyword arguments:
+    device        -- device
+    """
+    _registries_lock.acquire()
+    try:
+        registry = _registries.get(device.uid)
+        if registry is None:
+            registry = ProfileRegistry(device)
+            _registries[device.uid] = registry
+        return registry
+    finally:
+        _registries_lock.release()
 
 notifier = pyinotify.ThreadedNotifier(wm, EventHandler())
 notifier.name = "ProfilePyInotify"
 notifier.setDaemon(True)
 notifier.start()
-wdd = wm.add_watch(conf_dir, mask, rec=True)
+wdd = wm.add_watch(conf_dir, mask, rec=True, auto_add=True)
 
 
 '''
@@ -131,6 +421,33 @@ Defaults
 """
 DEFAULT_REPEAT_DELAY = -1.0
 
+"""
+Maximum number of application names to remember the matching profile for
+"""
+MATCH_CACHE_SIZE = 256
+
+"""
+Parsed profiles are kept here, so they may be loaded without parsing the
+profile file again as long as it has not changed. SNAPSHOT_VERSION must be
+increased whenever the snapshot contents change.
+"""
+snapshot_dir = os.path.join(g15globals.user_cache_dir, "macro_profiles")
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PROFILE_ATTRIBUTES = [ "version", "name", "icon", "background", "author",
+                                "window_name", "models", "plugins_mode", "selected_plugins",
+                                "activate_on_focus", "send_delays", "fixed_delays",
+                                "base_profile", "press_delay", "release_delay",
+                                "launch_pattern", "monitor", "activate_on_launch",
+                                "mkey_color" ]
+SNAPSHOT_MACRO_ATTRIBUTES = [ "type", "macro", "name", "repeat_mode", "repeat_delay" ]
+
+"""
+Profile files are written in the background, SAVE_DELAY seconds after the
+last save, so a burst of changes only results in one write
+"""
+PROFILE_WRITER_QUEUE = "ProfileWriter"
+SAVE_DELAY = 1.0
+
 
 __profile_dirs = []
 
@@ -142,6 +459,7 @@ def add_profile_dir(profile_dir):
     profile_dir    -- profile directory to register
     '''
     __profile_dirs.append(profile_dir)
+    _invalidate_profile_dir(profile_dir)
 
 def remove_profile_dir(profile_dir):
     '''
@@ -151,6 +469,124 @@ def remove_profile_dir(profile_dir):
     profile_dir    -- profile directory to de-register
     '''
     __profile_dirs.remove(profile_dir)
+    _invalidate_profile_dir(profile_dir)
+    
+def _invalidate_profile_dir(profile_dir):
+    for registry in list(_registries.values()):
+        registry.invalidate_dir(profile_dir)
+    
+def flush_writes(path = None):
+    """
+    Write profile changes that are waiting to be written now, rather than
+    when the save delay expires.
+    
+    Keyword arguments:
+    path        -- only write this profile file, or None for all
+    """
+    _writes_lock.acquire()
+    try:
+        paths = [ path ] if path is not None else list(_pending_writes.keys())
+    finally:
+        _writes_lock.release()
+    for p in paths:
+        _do_write(p)
+        
+def _queue_write(path, text):
+    """
+    Write the contents of a profile file after SAVE_DELAY. If the profile is
+    saved again before then, only the latest contents are written.
+    
+    Keyword arguments:
+    path        -- profile file
+    text        -- new contents
+    """
+    _writes_lock.acquire()
+    try:
+        pending = _pending_writes.get(path)
+        if pending is not None:
+            pending[0].cancel()
+        timer = g15scheduler.queue(PROFILE_WRITER_QUEUE, "WriteProfile", SAVE_DELAY, _do_write, path)
+        _pending_writes[path] = ( timer, text )
+    finally:
+        _writes_lock.release()
+        
+def _cancel_write(path):
+    """
+    Forget about any write waiting for a profile file. Returns True if there
+    was one.
+    
+    Keyword arguments:
+    path        -- profile file
+    """
+    _writes_lock.acquire()
+    try:
+        pending = _pending_writes.pop(path, None)
+        if pending is not None:
+            pending[0].cancel()
+        return pending is not None
+    finally:
+        _writes_lock.release()
+        
+def _do_write(path):
+    # Only one write at a time, so a newer save is never overwritten by an
+    # older one. The pending writes lock is not held during the I/O, so saving
+    # does not have to wait for the disk.
+    _io_lock.acquire()
+    try:
+        _writes_lock.acquire()
+        try:
+            pending = _pending_writes.pop(path, None)
+            if pending is None:
+                return
+            pending[0].cancel()
+        finally:
+            _writes_lock.release()
+        dir_name = os.path.dirname(path)
+        if not os.path.exists(dir_name):
+            os.mkdir(dir_name)
+        tmp_file = "%s.tmp" % path
+        with codecs.open(tmp_file, "w", "utf8") as configfile:
+            configfile.write(pending[1])
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        os.rename(tmp_file, path)
+        file_stat = os.stat(path)
+        _writes_lock.acquire()
+        try:
+            _own_writes[path] = ( file_stat.st_mtime_ns, file_stat.st_size )
+        finally:
+            _writes_lock.release()
+    except Exception as e:
+        logger.error("Failed to write profile %s", path, exc_info = e)
+    finally:
+        _io_lock.release()
+        
+def _is_own_write(path):
+    """
+    Get if a profile file is exactly as this process last wrote it, in which
+    case the registry already holds the profile and it need not be reloaded.
+    
+    Keyword arguments:
+    path        -- profile file
+    """
+    _writes_lock.acquire()
+    try:
+        written = _own_writes.get(path)
+    finally:
+        _writes_lock.release()
+    if written is None:
+        return False
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return False
+    return written == ( file_stat.st_mtime_ns, file_stat.st_size )
+
+_pending_writes = {}
+_own_writes = {}
+_writes_lock = RLock()
+_io_lock = RLock()
+atexit.register(flush_writes)
     
 def get_profile_by_name(device, name):
     """
@@ -162,9 +598,7 @@ def get_profile_by_name(device, name):
     device        -- device associated with profile
     name          -- profile name to find
     """
-    for profile in get_profiles(device):
-        if profile.name == name:
-            return profile
+    return get_registry(device).get_by_name(name)
 
 def get_profiles(device):
     '''
@@ -173,18 +607,7 @@ def get_profiles(device):
     Keyword arguments:
     device        -- device associated with profiles
     '''
-    profiles = []
-    for profile_dir in get_all_profile_dirs(device):
-        if os.path.exists(profile_dir):
-            for profile in os.listdir(profile_dir):
-                if not profile.startswith(".") and profile.endswith(".macros"):
-                    profile_id = ".".join(profile.split(".")[:-1])
-                    profile_object = G15Profile(device, profile_id, \
-                                               file_path = "%s/%s" % \
-                                               ( profile_dir, profile ))
-                    if device.model_id in profile_object.models:
-                        profiles.append(profile_object)
-                        
+    profiles = get_registry(device).get_all()
     if len(profiles) == 0:
         return [ create_default(device) ]
                         
@@ -238,17 +661,15 @@ def generate_profile_id():
 def get_profile(device, profile_id):
     """
     Get a profile given the device it is associated with and it's ID. The
-    profile will be fully loaded on return. The object returned will be a 
-    new instance.
+    profile is shared with everything else in this process that has looked
+    it up. Use G15Profile.copy() if the copy is to be changed without being
+    saved.
     
     Keyword arguments:
     device        -- device associated with profile
     profile_id    -- ID of profile to load
     """
-    for profile_dir in get_all_profile_dirs(device):
-        path = "%s/%s.macros" % ( profile_dir, profile_id )
-        if os.path.exists(path):
-            return G15Profile(device, profile_id, file_path = path);
+    return get_registry(device).get(profile_id)
 
 def get_active_profile(device):
     """
@@ -379,7 +800,7 @@ def find_profile_for_command(args, device):
         
     logger.info("Processed command '%s'", command_line)
     
-    for p in get_profiles(device):
+    for p in get_registry(device).get_all():
         if p.can_launch(command_line):
             return p
         
@@ -440,9 +861,8 @@ class G15Macro(object):
         self.repeat_mode = REPEAT_WHILE_HELD
         self.type = MACRO_SCRIPT
         self.repeat_delay = DEFAULT_REPEAT_DELAY 
-        section_name = "m%d" % self.memory
-        if not self.profile.parser.has_section(section_name):
-            self.profile.parser.add_section(section_name)
+        self.compiled_script = None
+        self.profile._add_section("m%d" % self.memory)
             
     def is_uinput(self):
         """
@@ -492,6 +912,7 @@ class G15Macro(object):
         Save this macro. This triggers the whole profile that contains the
         macro to be saved as well.
         """
+        self.compiled_script = None
         self._store()
         self.profile.save()
         
@@ -679,8 +1100,9 @@ class G15Profile(object):
         
         self.device = device
         self.read_only = False
-        self.parser = configparser.ConfigParser({
+        self._parser = configparser.ConfigParser({
                                                      })        
+        self._parser_data = None
         self.name = None
         self.icon = None
         self.background = None
@@ -709,6 +1131,20 @@ class G15Profile(object):
         
         self.load(self.filename)
         
+    @property
+    def parser(self):
+        """
+        The parser holding the profile file contents. When the profile was 
+        loaded from a snapshot, this is only created when first needed (i.e.
+        when the profile is being edited).
+        """
+        if self._parser is None:
+            self._parser = configparser.ConfigParser({
+                                                     })
+            self._parser.read_dict(self._parser_data)
+            self._parser_data = None
+        return self._parser
+        
     def can_launch(self, command_line):
         """
         Test if this profile can launch a command with the provided arguments,
@@ -730,7 +1166,7 @@ class G15Profile(object):
         Keyword arguments:
         filename    --    file to save copy to
         """
-        profile_copy = get_profile(self.device, self.id)
+        profile_copy = self.copy()
         
         archive_file = zipfile.ZipFile(filename, "w", compression = zipfile.ZIP_DEFLATED)
         try:
@@ -849,6 +1285,9 @@ class G15Profile(object):
                         macro._store()
                 
         self._write(filename)
+        if filename == self.filename:
+            # Other users in this process see the change now, rather than when inotify notices
+            get_registry(self.device).put(self.filename, self)
         
     def set_id(self, profile_id):
         self.id = str(profile_id)
@@ -895,7 +1334,25 @@ class G15Profile(object):
         """
         Delete this macro profile
         """
-        os.remove(self.filename)
+        _io_lock.acquire()
+        try:
+            # A new profile may be deleted before it was ever written
+            _cancel_write(self.filename)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+        finally:
+            _io_lock.release()
+        snapshot_path = self._get_snapshot_path(self.filename)
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        get_registry(self.device).remove(self.filename)
+        
+    def copy(self):
+        """
+        Get a new instance of this profile loaded from disk, for when changes
+        to it should not be seen by other users of the registry until saved.
+        """
+        return G15Profile(self.device, self.id, file_path = self.filename)
         
     def delete_macro(self, activate_on, memory, keys):
         """
@@ -1016,8 +1473,17 @@ class G15Profile(object):
         
     def load(self, filename = None, fd = None):
         """
-        Load the profile from disk
+        Load the profile from disk. If the file has not changed since it was
+        last parsed, the snapshot taken then is used instead.
         """
+        
+        file_stat = None
+        if fd is None and isinstance(filename, str) and filename in _pending_writes:
+            flush_writes(filename)
+        if fd is None and isinstance(filename, str) and os.path.exists(filename):
+            file_stat = os.stat(filename)
+            if self._load_snapshot(filename, file_stat):
+                return
                  
         # Initial values
         self.macros = { g15driver.KEY_STATE_UP: [],
@@ -1093,6 +1559,9 @@ class G15Profile(object):
                         macro_obj = G15Macro(self, i, key_list_key, activate_on)
                         macro_obj._load()
                         memory_macros.append(macro_obj)
+                        
+        if file_stat is not None:
+            self._save_snapshot(filename, file_stat)
         
     def get_sorted_macros(self, activate_on, memory_number):
         """
@@ -1120,6 +1589,93 @@ class G15Profile(object):
     def _comparator(self, o1, o2):
         return o1.compare(o2)
                     
+    def _add_section(self, section_name):
+        # Snapshots always contain all bank sections, so no need to parse now
+        if self._parser is not None and not self._parser.has_section(section_name):
+            self._parser.add_section(section_name)
+            
+    def _get_snapshot_path(self, filename):
+        return os.path.join(snapshot_dir, "%s.pickle" % hashlib.md5(os.path.abspath(filename).encode("utf-8")).hexdigest())
+    
+    def _load_snapshot(self, filename, file_stat):
+        """
+        Load the profile from its snapshot if there is one that was taken of
+        the current contents of the profile file. Returns True if the snapshot
+        was used.
+        
+        Keyword arguments:
+        filename        -- profile file
+        file_stat       -- result of stat() on the profile file
+        """
+        snapshot_path = self._get_snapshot_path(filename)
+        if not os.path.exists(snapshot_path):
+            return False
+        try:
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.debug("Could not read profile snapshot %s", snapshot_path, exc_info = e)
+            return False
+        if not isinstance(snapshot, dict) or snapshot.get("snapshot_version") != SNAPSHOT_VERSION or \
+                snapshot.get("path") != os.path.abspath(filename) or \
+                snapshot.get("mtime") != file_stat.st_mtime_ns or \
+                snapshot.get("size") != file_stat.st_size:
+            return False
+        
+        self.read_only = not file_stat[0] & stat.S_IWRITE
+        self._parser = None
+        self._parser_data = snapshot["parser"]
+        for name in SNAPSHOT_PROFILE_ATTRIBUTES:
+            setattr(self, name, snapshot["profile"][name])
+        self.macros = {}
+        for activate_on, banks in snapshot["macros"].items():
+            self.macros[activate_on] = []
+            for i, bank in enumerate(banks):
+                memory_macros = []
+                for key_list_key, values in bank:
+                    macro_obj = G15Macro(self, i + 1, key_list_key, activate_on)
+                    for name, value in zip(SNAPSHOT_MACRO_ATTRIBUTES, values):
+                        setattr(macro_obj, name, value)
+                    memory_macros.append(macro_obj)
+                self.macros[activate_on].append(memory_macros)
+        return True
+    
+    def _save_snapshot(self, filename, file_stat):
+        """
+        Write a snapshot of the profile as just parsed from the profile file.
+        The snapshot is written to a temporary file and renamed, so readers
+        never see a partial one.
+        
+        Keyword arguments:
+        filename        -- profile file
+        file_stat       -- result of stat() on the profile file before parsing
+        """
+        parser = self.parser
+        parser_data = { "DEFAULT" : dict(parser.defaults()) }
+        for section_name in parser.sections():
+            parser_data[section_name] = dict(( k, v ) for k, v in parser.items(section_name, raw = True) \
+                                             if not k in parser_data["DEFAULT"] or parser_data["DEFAULT"][k] != v)
+        snapshot = { "snapshot_version" : SNAPSHOT_VERSION,
+                     "path" : os.path.abspath(filename),
+                     "mtime" : file_stat.st_mtime_ns,
+                     "size" : file_stat.st_size,
+                     "parser" : parser_data,
+                     "profile" : dict(( name, getattr(self, name) ) for name in SNAPSHOT_PROFILE_ATTRIBUTES),
+                     "macros" : dict(( activate_on, [ [ ( m.key_list_key, [ getattr(m, name) for name in SNAPSHOT_MACRO_ATTRIBUTES ] ) \
+                                                         for m in bank ] for bank in banks ] ) \
+                                     for activate_on, banks in self.macros.items()) }
+        snapshot_path = self._get_snapshot_path(filename)
+        tmp_path = "%s.%d.tmp" % ( snapshot_path, os.getpid() )
+        try:
+            g15os.mkdir_p(snapshot_dir)
+            with open(tmp_path, "wb") as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, snapshot_path)
+        except Exception as e:
+            logger.debug("Could not write profile snapshot %s", snapshot_path, exc_info = e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        
     def _remove_if_exists(self, name, section = "DEFAULT"):
         if self.parser.has_option(section, name):
             self.parser.remove_option(section, name)
@@ -1149,18 +1705,9 @@ class G15Profile(object):
             raise Exception("Cannot save a profile without a filename or an id.")
         
         if isinstance(save_file, str):
-            dir_name = os.path.dirname(save_file)
-            if not os.path.exists(dir_name):
-                os.mkdir(dir_name)
-            tmp_file = "%s.tmp" % save_file
-            with open(tmp_file, 'w') as configfile:
-                self.parser.write(configfile)
-            os.rename(tmp_file, save_file)
-            fhandle = open(save_file, 'a')
-            try:
-                os.utime(save_file, None)
-            finally:
-                fhandle.close()
+            text = StringIO()
+            self.parser.write(text)
+            _queue_write(save_file, text.getvalue())
         else:
             self.parser.write(save_file)
         
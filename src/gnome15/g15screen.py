@@ -41,6 +41,10 @@ Paint stages
 BACKGROUND_PAINTER = 0
 FOREGROUND_PAINTER = 1
 
+# Default maximum number of frames per second to paint, depending on the type of LCD
+MAX_FPS_COLOUR = 30
+MAX_FPS_MONO = 15
+
 """
 Simple colors
 """
@@ -51,6 +55,8 @@ from gnome15.util import g15scheduler as g15scheduler
 from gnome15.util import g15pythonlang as g15pythonlang
 from gnome15.util import g15gconf as g15gconf
 from gnome15.util import g15cairo as g15cairo
+from gnome15.util import g15frame as g15frame
+from gnome15.util import g15metrics as g15metrics
 from gnome15.util import g15icontools as g15icontools
 from . import g15profile
 from . import g15globals
@@ -253,6 +259,130 @@ class Painter():
         raise Exception("Not implemented")
     
     
+class RedrawScheduler():
+    """
+    Merges redraw requests and limits how often frames are painted. Requests
+    made while a redraw is pending are merged with it, so a burst of requests
+    (e.g. from key presses) results in a single frame. If the last frame was
+    painted less than 1 / max_fps seconds ago, the redraw is delayed until it
+    is due.
+    """
+    
+    def __init__(self, screen, max_fps = MAX_FPS_COLOUR):
+        self.screen = screen
+        self.max_fps = max_fps
+        self.lock = RLock()
+        self.pending = {}
+        self.scheduled = False
+        self.timer = None
+        self.last_frame = 0
+        self.requested = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.frames = 0
+        
+    def request(self, page, direction, transitions, redraw_content):
+        """
+        Request a redraw. If a redraw of the same page is already pending, the two
+        are merged.
+        
+        Keyword arguments:
+        page            -- page to redraw (None for the current page)
+        direction       -- transition direction
+        transitions     -- whether transitions are allowed
+        redraw_content  -- whether the page content should be repainted
+        """
+        self.lock.acquire()
+        try:
+            self.requested += 1
+            if page in self.pending:
+                self.coalesced += 1
+                _, o_transitions, o_redraw_content = self.pending[page]
+                self.pending[page] = ( direction, transitions or o_transitions, redraw_content or o_redraw_content )
+            else:
+                self.pending[page] = ( direction, transitions, redraw_content )
+            if not self.scheduled:
+                self.scheduled = True
+                delay = self.last_frame + ( 1.0 / self.max_fps ) - time.time() if self.max_fps > 0 else 0
+                if delay > 0:
+                    self.timer = g15scheduler.queue(REDRAW_QUEUE, "redraw", delay, self._flush)
+                else:
+                    g15scheduler.execute(REDRAW_QUEUE, "redraw", self._flush)
+        finally:
+            self.lock.release()
+            
+    def clear(self):
+        """
+        Forget all pending requests, and cancel a delayed redraw. Should be
+        called when the redraw queue is cleared.
+        """
+        self.lock.acquire()
+        try:
+            self.dropped += len(self.pending)
+            self.pending = {}
+            self.scheduled = False
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
+            
+    def get_stats(self):
+        """
+        Get a dictionary of the scheduler's counters
+        """
+        self.lock.acquire()
+        try:
+            return { "max_fps" : self.max_fps,
+                     "queue_depth" : len(self.pending),
+                     "requested" : self.requested,
+                     "coalesced" : self.coalesced,
+                     "dropped" : self.dropped,
+                     "frames" : self.frames }
+        finally:
+            self.lock.release()
+            
+    def _flush(self):
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = {}
+            self.scheduled = False
+            self.timer = None
+            if len(pending) == 0:
+                return
+            self.last_frame = time.time()
+            self.frames += 1
+        finally:
+            self.lock.release()
+        
+        # A redraw of the visible page covers any other request
+        current_page = self.screen._get_next_page_to_display()
+        visible = [ pending[p] for p in pending if p is None or p == current_page ]
+        if len(visible) > 0:
+            self._count(coalesced = len(pending) - 1)
+            self.screen._do_redraw(None, visible[-1][0],
+                                   True in [ v[1] for v in visible ],
+                                   True in [ v[2] for v in visible ])
+            return
+        
+        # Otherwise only pages that paint on the panel need anything drawing,
+        # and one frame is enough for all of them
+        panel = [ p for p in pending if p.panel_painter is not None ]
+        self._count(coalesced = max(0, len(panel) - 1), dropped = len(pending) - len(panel))
+        if len(panel) > 0:
+            page = panel[-1]
+            direction, transitions, _ = pending[page]
+            self.screen._do_redraw(page, direction, transitions, False)
+            
+    def _count(self, coalesced = 0, dropped = 0):
+        self.lock.acquire()
+        try:
+            self.coalesced += coalesced
+            self.dropped += dropped
+        finally:
+            self.lock.release()
+    
 class G15Screen():
     
     def __init__(self, plugin_manager_module, service, device):
@@ -273,6 +403,9 @@ class G15Screen():
         self.attention_message = g15globals.name
         self.attention = False
         self.splash = None
+        self.frame_diff = None
+        self.metrics = g15metrics.get_metrics(device.uid)
+        self.redraw_scheduler = RedrawScheduler(self)
         self.reschedule_lock = RLock()        
         self.last_error = None
         self.loading_complete = False
@@ -315,10 +448,7 @@ class G15Screen():
             choose_profile = None
             # Active window has changed, see if we have a profile that matches it
             if application_name is not None:
-                for profile in g15profile.get_profiles(self.device):
-                    if not profile.get_default() and profile.activate_on_focus and len(profile.window_name) > 0 and application_name.lower().find(profile.window_name.lower()) != -1:
-                        choose_profile = profile 
-                        break
+                choose_profile = g15profile.get_registry(self.device).match_window_name(application_name)
                 
             # No applicable profile found. Look for a default profile, and see if it is set to activate by default
             active_profile = g15profile.get_active_profile(self.device)
@@ -904,6 +1034,20 @@ class G15Screen():
         if self.plugins.handle_key(keys, state_id, post=post):
             return True
         
+    def is_consuming_keys(self, keys, state_id):
+        """
+        Do not call. This is invoked by the key handler (on the driver's thread)
+        to find out if handle_key() may consume the keys.
+        
+        Keyword arguments:
+        keys        --    list of keys
+        state_id    --    key state ID (g15driver.KEY_STATED_UP, _DOWN and _HELD)
+        """
+        visible = self.get_visible_page()
+        if visible != None and len(visible.key_handlers) > 0:
+            return True
+        return self.plugins.is_consuming_keys(keys, state_id)
+        
     def action_performed(self, binding):
         if binding.action == g15driver.MEMORY_1:
             self.set_memory_bank(1)
@@ -940,6 +1084,9 @@ class G15Screen():
         self.height = self.driver.get_size()[1]
         
         self.surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+        self.frame_diff = g15frame.FrameDiff(self.height, ( self.width * self.driver.get_bpp() + 7 ) // 8, self.metrics)
+        self.redraw_scheduler.max_fps = g15gconf.get_int_or_default(self.conf_client, "/apps/gnome15/%s/max_fps" % self.device.uid,
+                                                                    MAX_FPS_MONO if self.driver.get_bpp() == 1 else MAX_FPS_COLOUR)
         self.size = (self.width, self.height)
         self.available_size = (0, 0, self.size[0], self.size[1])
         
@@ -958,6 +1105,9 @@ class G15Screen():
         control_id = entry.get_key().split("/")[-1]
         control = self.driver.get_control(control_id)
         control.set_from_configuration(self.driver.device, self.conf_client)
+        if self.frame_diff is not None:
+            # The driver may now output the same frame differently (e.g. inverted)
+            self.frame_diff.reset()
         if self.visible_page:
             self.visible_page.mark_dirty()
         
@@ -1137,10 +1287,12 @@ class G15Screen():
     
     def cycle_to(self, page, transitions=True):
         g15scheduler.clear_jobs(REDRAW_QUEUE)
+        self.redraw_scheduler.clear()
         g15scheduler.execute(REDRAW_QUEUE, "cycleTo", self._do_cycle_to, page, transitions)
             
     def cycle(self, number, transitions=True):
         g15scheduler.clear_jobs(REDRAW_QUEUE)
+        self.redraw_scheduler.clear()
         g15scheduler.execute(REDRAW_QUEUE, "doCycle", self._do_cycle, number, transitions)
             
     def redraw(self, page=None, direction="up", transitions=True, redraw_content=True, queue=True):
@@ -1149,7 +1301,7 @@ class G15Screen():
         else:
             logger.debug("Redrawing current page")
         if queue:
-            g15scheduler.execute(REDRAW_QUEUE, "redraw", self._do_redraw, page, direction, transitions, redraw_content)
+            self.redraw_scheduler.request(page, direction, transitions, redraw_content)
         else:
             self._do_redraw(page, direction, transitions, redraw_content)
             
@@ -1304,6 +1456,7 @@ class G15Screen():
                 return
             
             surface = self.surface
+            frame_started = time.time()
             
             painters = sorted(self.painters, key=lambda painter: painter.z_order)
             
@@ -1320,9 +1473,11 @@ class G15Screen():
             self.clear_canvas(canvas)
             
             # Background painters
+            painters_started = time.time()
             for painter in painters:
                 if painter.place == BACKGROUND_PAINTER:
                     painter.paint(canvas)
+            painters_time = time.time() - painters_started
                     
             old_page = None
             if visible_page != self.visible_page:            
@@ -1355,7 +1510,8 @@ class G15Screen():
                     self.content_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
                     content_canvas = cairo.Context(self.content_surface)
                     self.configure_canvas(content_canvas)
-                    self.visible_page.paint(content_canvas)
+                    with self.metrics.timer(g15metrics.STAGE_PAGE):
+                        self.visible_page.paint(content_canvas)
                 
                 tx = self.available_size[0]
                 ty = self.available_size[1]
@@ -1384,22 +1540,32 @@ class G15Screen():
             Glass pane (components a bit like foreground painters in that
             they paint over the top of pages
             """
+            painters_started = time.time()
             self.glass_pane.paint(canvas)
 
             # Foreground painters                
             for painter in painters:
                 if painter.place == FOREGROUND_PAINTER:
                     painter.paint(canvas)
+            self.metrics.record(g15metrics.STAGE_PAINTERS, painters_time + time.time() - painters_started)
                     
             # Run any transitions
             if transitions and self.transition_function != None and self.old_canvas != None:
                 self.transition_function(self.old_surface, surface, old_page, self.visible_page, direction)
+                self.frame_diff.reset()
                 
             # Now apply any global transformations and paint
             if self.painter_function != None:
+                self.frame_diff.reset()
                 self.painter_function(surface)
             else:
-                self.driver.paint(surface)
+                # Only send the frame if it differs from the last one sent
+                damage = self.frame_diff.diff(surface)
+                if damage is None:
+                    logger.debug("Frame unchanged, not painting")
+                elif self.driver.paint_damaged(surface, damage):
+                    self.frame_diff.damage_written(damage)
+            self.metrics.record(g15metrics.STAGE_FRAME, time.time() - frame_started)
                 
             self.old_canvas = canvas
             self.old_surface = surface
@@ -79,6 +79,10 @@ VERSION = g15globals.version
 SERVICE_QUEUE = "serviceQueue"
 MACRO_HANDLER_QUEUE = "macroHandler"
 
+# How often (ms) to poll wnck for the active application. Backs off while it is unchanged
+WNCK_POLL_MIN = 500
+WNCK_POLL_MAX = 2000
+
 special_X_keysyms = {
     ' ' : "space",
     '\t' : "Tab",
@@ -150,17 +154,22 @@ class MacroHandler(object):
     
     def __init__(self):        
         self.buffered_executions = []
+        self.executions = []
         self.cancelled = False
         self.use_x_test = None
         self.x_test_available = None
         self.window = None
+        self.local_dpy = None
+        self.keysym_cache = {}
+        self.keycode_cache = {}
         
     def cancel(self):
         """
-        Cancel the currently running macro script if any. This script may
+        Cancel the currently running macro scripts if any. A script may
         not immediately be cancelled if there are un-interuptable tasks running.  
         """
         self.cancelled = True
+        g15scheduler.queue(MACRO_HANDLER_QUEUE, "CancelMacro", 0, self._do_cancel)
         
     def handle_key(self, keys, state_id, post):
         """
@@ -344,6 +353,10 @@ class MacroHandler(object):
             self.cancel()
             return True 
         
+    def _do_cancel(self):
+        for execution in list(self.executions):
+            execution.cancel()
+        
     def _do_handle_key(self, keys, state_id, post):
         for b in list(self.buffered_executions):
             if b.handle_key(keys, state_id, post):
@@ -352,11 +365,38 @@ class MacroHandler(object):
                 so continue execution
                 """        
                 self.buffered_executions.remove(b)        
-                wait_for_state = b.execute()
-                if wait_for_state:
-                    self.buffered_executions.append(b)
+                b.execute()
+        
+    def _check_keymap(self):
+        """
+        Drain any events queued on the local display, looking for keyboard
+        mapping changes. When the mapping changes, Xlib's own keycode tables
+        are refreshed and the resolved keycodes are discarded so they are 
+        looked up again using the new layout.
+        """
+        if self.local_dpy is None:
+            return
+        while self.local_dpy.pending_events() > 0:
+            event = self.local_dpy.next_event()
+            if event.type == Xlib.X.MappingNotify and event.request in [ Xlib.X.MappingKeyboard, Xlib.X.MappingModifier ]:
+                logger.info("Keyboard mapping changed, clearing keycode cache")
+                self.local_dpy.refresh_keyboard_mapping(event)
+                self.keycode_cache.clear()
         
     def _get_keysym(self, ch) :
+        """
+        Get the X keysym for a character. Keysyms do not depend on the 
+        keyboard layout, so they are only ever looked up once.
+        
+        Keyword arguments:
+        ch        -- character to convert
+        """
+        keysym = self.keysym_cache.get(ch)
+        if keysym is None:
+            keysym = self.keysym_cache[ch] = self._lookup_keysym(ch)
+        return keysym
+        
+    def _lookup_keysym(self, ch) :
         keysym = Xlib.XK.string_to_keysym(ch)
         if keysym == 0 :
             # Unfortunately, although this works to get the correct keysym
@@ -370,11 +410,19 @@ class MacroHandler(object):
     def _char_to_keycodes(self, ch):
         """
         Convert a character from a string into an X11 keycode when possible.
+        The result is cached until the keyboard mapping changes. Returns a
+        tuple of (keycode, shift mask).
         
         Keyword arguments:
         ch        -- character to convert
         """    
-        self.init_xtest()
+        key = self.keycode_cache.get(ch)
+        if key is None:
+            self.init_xtest()
+            key = self.keycode_cache[ch] = self._lookup_keycodes(ch)
+        return key
+        
+    def _lookup_keycodes(self, ch):
         shift_mask = 0
         
         if str(ch).startswith("["):
@@ -409,6 +457,7 @@ class MacroHandler(object):
         # Get the latest focused window if not using XTest
         self.cancelled = False
         self.init_xtest()
+        self._check_keymap()
         if self.virtual_keyboard is None and ( not self.use_x_test or not self.x_test_available ):
             self.window = self.local_dpy.get_input_focus()._data["focus"]; 
         
@@ -418,32 +467,138 @@ class MacroHandler(object):
         elif macro.type == g15profile.MACRO_SIMPLE:
             self.send_simple_macro(macro)
         else:
-            executor = MacroScriptExecution(macro, self)
-            wait_for_state = executor.execute()
-            if wait_for_state:
-                self.buffered_executions.append(executor)
+            MacroScriptExecution(macro, self).execute()
             
+"""
+Macro script opcodes
+"""
+OP_GOTO = 0
+OP_DELAY = 1
+OP_RELEASE_GAP = 2
+OP_PRESS = 3
+OP_RELEASE = 4
+OP_UPRESS = 5
+OP_URELEASE = 6
+OP_PRESS_DELAY = 7
+OP_WAIT = 8
+
+class CompiledMacroScript(object):
+    """
+    A macro script turned into a list of opcodes, with goto labels resolved
+    to opcode indexes and uinput key names resolved to codes. Problems with
+    the script are logged once when it is compiled, and the offending lines
+    are left out.
+    """
+    
+    def __init__(self, macro):
+        """
+        Constructor
+        
+        Keyword arguments:
+        macro        -- macro to compile
+        """
+        self.source = macro.macro
+        self.ops = []
+        labels = {}
+        gotos = []
+        for macro_text in self.source.split("\n"):
+            split = macro_text.split(" ")
+            op = split[0].lower()
+            if len(split) < 2:
+                if len(macro_text) > 0:
+                    logger.error("Insufficient arguments in macro script. '%s'", macro_text)
+                continue
+            val = split[1]
+            if op == "label":
+                # Labels point at the next opcode
+                labels[val.lower()] = len(self.ops)
+            elif op == "goto":
+                gotos.append(( len(self.ops), val.lower() ))
+                self.ops.append(( OP_GOTO, None ))
+            elif op == "delay":
+                try:
+                    self.ops.append(( OP_DELAY, float(val) / 1000.0 ))
+                except ValueError:
+                    logger.error("Invalid delay in macro script. '%s'", macro_text)
+            elif op == "press":
+                self.ops.append(( OP_RELEASE_GAP, None ))
+                self.ops.append(( OP_PRESS, val ))
+                self.ops.append(( OP_PRESS_DELAY, None ))
+            elif op == "release":
+                self.ops.append(( OP_RELEASE, val ))
+            elif op in [ "upress", "urelease" ]:
+                if len(split) < 3:
+                    logger.error("Invalid operation in macro script. '%s'", macro_text)
+                elif not val in g15uinput.capabilities:
+                    logger.error("Unknown uinput key %s.", val)
+                elif op == "upress":
+                    self.ops.append(( OP_RELEASE_GAP, None ))
+                    self.ops.append(( OP_UPRESS, ( split[2], g15uinput.capabilities[val] ) ))
+                    self.ops.append(( OP_PRESS_DELAY, None ))
+                else:
+                    self.ops.append(( OP_URELEASE, ( split[2], g15uinput.capabilities[val] ) ))
+            elif op == "wait":
+                val = val.lower()
+                if val == "release":
+                    if macro.activate_on == g15driver.KEY_STATE_UP:
+                        logger.error("WaitRelease cannot be used with macros that activate on release")
+                    else:
+                        self.ops.append(( OP_WAIT, g15driver.KEY_STATE_UP ))
+                elif val == "hold":
+                    if macro.activate_on == g15driver.KEY_STATE_DOWN:
+                        self.ops.append(( OP_WAIT, g15driver.KEY_STATE_HELD ))
+                    else:                        
+                        logger.error("WaitHold cannot be used with macros that activate on hold or release")
+                else:                        
+                    logger.error("Wait may only have an argument of release or hold")
+            else:
+                logger.error("Invalid operation in macro script. '%s'", macro_text)
+                
+        for index, label in gotos:
+            if label in labels:
+                self.ops[index] = ( OP_GOTO, labels[label] )
+            else:
+                logger.warning("Unknown goto label %s in macro script. Ignoring", label)
+                
+def get_compiled_script(macro):
+    """
+    Get the compiled script for a macro, compiling it if it has not been
+    compiled since it was loaded, saved or changed.
+    
+    Keyword arguments:
+    macro        -- macro
+    """
+    compiled = macro.compiled_script
+    if compiled is None or compiled.source != macro.macro:
+        compiled = CompiledMacroScript(macro)
+        macro.compiled_script = compiled
+    return compiled
+
 class MacroScriptExecution(object):
+    """
+    Runs a compiled macro script. Delays are not slept through, instead the
+    rest of the script is queued to run when the delay is up, so any number
+    of scripts may be running at once on the macro handler queue. Delays are
+    measured from when the previous one was due, so the time taken sending
+    key events does not add up over a long script.
+    """
     
     def __init__(self, macro, handler):
         self.macro = macro
         self.handler = handler
-        self.l = -1
-        self.macros = self.macro.macro.split("\n")
+        self.ops = get_compiled_script(macro).ops
+        self.pc = 0
         self.wait_for_state = -2
         self.wait_for_keys = []
         self.down = 0
         self.all_keys_up = False
         self.cancelled = False
-        
-        # First parse to get where the labels are
-        self.labels = {}
-        for l in range(0, len(self.macros)):
-            macro_text = self.macros[l]
-            split = macro_text.split(" ")
-            op = split[0].lower()
-            if op == "label" and len(op) > 1:
-                self.labels[split[1].lower()] = l
+        self.timer = None
+        self.due = time.time()
+        profile = macro.profile
+        self.press_delay = 0.0 if not profile.fixed_delays else ( float(profile.press_delay) / 1000.0 )
+        self.release_delay = 0.0 if not profile.fixed_delays else ( float(profile.release_delay) / 1000.0 )
+        self.script_delays = profile.send_delays and not profile.fixed_delays
                 
     def handle_key(self, keys, state_id, post):
         
@@ -453,7 +608,8 @@ class MacroScriptExecution(object):
          """
         if state_id == self.wait_for_state or state_id == g15driver.KEY_STATE_UP and self.wait_for_state == g15driver.KEY_STATE_HELD:
             for k in keys:
-                self.wait_for_keys.remove(k)
+                if k in self.wait_for_keys:
+                    self.wait_for_keys.remove(k)
                 
         if len(self.wait_for_keys) == 0:
             # All keys are now in the required state
@@ -464,92 +620,118 @@ class MacroScriptExecution(object):
                 # Make a note of the fact all triggering keys are now up
                 self.all_keys_up = True
             return True
+        
+    def cancel(self):
+        """
+        Stop running the script. Any keys the script has pressed will still be
+        released before it stops.
+        """
+        self.cancelled = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            g15scheduler.queue(MACRO_HANDLER_QUEUE, "MacroScript", 0, self._resume)
                 
     def execute(self):
+        """
+        Start running the script, or continue it after waiting for keys.
+        """
+        self.due = time.time()
+        self.handler.executions.append(self)
+        self._run()
+        
+    def _resume(self):
+        self.timer = None
+        self._run()
+        
+    def _run(self):
+        """
+        Run ops until the script blocks on a delay or wait, or finishes. 
+        Consecutive uinput events that are not separated by an actual wait
+        are written as a single batch with one SYN, although a key will 
+        never be pressed and released within the same batch.
+        """
+        batch = []
+        try:
+            self._run_ops(batch)
+        finally:
+            self._flush(batch)
+            
+    def _run_ops(self, batch):
+        ops = self.ops
         while True:
             if self.down == 0 and ( self.handler.cancelled or self.cancelled ):
                 logger.warning("Macro cancelled")
                 break
-            self.l += 1
-            if self.l == len(self.macros):
+            if self.pc >= len(ops):
                 break
-            macro_text = self.macros[self.l]
-            split = macro_text.split(" ")
-            op = split[0].lower()
-            if len(split) > 1:
-                val = split[1]
-                if op == "goto":
-                    val = val.lower()
-                    if val in self.labels:
-                        self.l = self.labels[val]
-                    else:
-                        logger.warning("Unknown goto label %s in macro script. Ignoring", val)
-                elif op == "delay":
-                    if not self.handler.cancelled and self.macro.profile.send_delays and not self.macro.profile.fixed_delays:
-                        time.sleep(float(val) / 1000.0 if not self.macro.profile.fixed_delays else self.macro.profile.delay_amount)
-                elif op == "press":
-                    if self.down > 0:
-                        self.handler.release_delay(self.macro)
-                    self.handler.send_string(val, True)
-                    self.down += 1
-                    self.handler.press_delay(self.macro)
-                elif op == "release":
-                    self.handler.send_string(val, False)
-                    self.down -= 1
-                elif op == "upress":
-                    if len(split) < 3:                        
-                        logger.error("Invalid operation in macro script. '%s'", macro_text)
-                    else:
-                        if self.down > 0:
-                            self.handler.release_delay(self.macro)
-                        self.down += 1
-                        self._send_uinput(split[2], val, 1)
-                        self.handler.press_delay(self.macro)
-                elif op == "urelease":
-                    if len(split) < 3:                        
-                        logger.error("Invalid operation in macro script. '%s'", macro_text)
-                    else:
-                        self.down -= 1
-                        self._send_uinput(split[2], val, 0)
-                elif op == "wait":
-                    if self.all_keys_up:
-                        logger.warning("All keys for the macro %s are already up, " \
-                                    "the rest of the script will be ignored", self.macro.name)
-                        return False
-                    else:
-                        val = val.lower()
-                        if val == "release":
-                            if self.macro.activate_on == g15driver.KEY_STATE_UP:
-                                logger.error("WaitRelease cannot be used with macros that activate on release")
-                            else:
-                                self.wait_for_state = g15driver.KEY_STATE_UP
-                                self.wait_for_keys = list(self.macro.keys)
-                                return True
-                        elif val == "hold":
-                            if self.macro.activate_on == g15driver.KEY_STATE_DOWN:
-                                self.wait_for_state = g15driver.KEY_STATE_HELD
-                                self.wait_for_keys = list(self.macro.keys)
-                                return True
-                            else:                        
-                                logger.error("WaitHold cannot be used with macros that activate on hold or release")
-                        else:                        
-                            logger.error("Wait may only have an argument of release or hold")
-                elif op == "label":
-                    # Ignore label / comment
-                    pass
-                else:
-                    logger.error("Invalid operation in macro script. '%s'", macro_text)
-                
-            else:
-                if len(split) > 0:
-                    logger.error("Insufficient arguments in macro script. '%s'", macro_text)
-                    
+            code, val = ops[self.pc]
+            self.pc += 1
+            if batch and ( code in ( OP_PRESS, OP_RELEASE ) or \
+                           ( code in ( OP_UPRESS, OP_URELEASE ) and \
+                             any(e[0] == val[0] and e[1] == val[1] for e in batch) ) ):
+                self._flush(batch)
+            if code == OP_GOTO:
+                if val is not None:
+                    self.pc = val
+            elif code == OP_DELAY:
+                if self.script_delays and not self.cancelled and not self.handler.cancelled and self._delay(val):
+                    return
+            elif code == OP_RELEASE_GAP:
+                if self.down > 0 and self._delay(self.release_delay):
+                    return
+            elif code == OP_PRESS_DELAY:
+                if self._delay(self.press_delay):
+                    return
+            elif code == OP_PRESS:
+                self.handler.send_string(val, True)
+                self.down += 1
+            elif code == OP_RELEASE:
+                self.handler.send_string(val, False)
+                self.down -= 1
+            elif code == OP_UPRESS:
+                self.down += 1
+                batch.append(( val[0], val[1], 1 ))
+            elif code == OP_URELEASE:
+                self.down -= 1
+                batch.append(( val[0], val[1], 0 ))
+            elif code == OP_WAIT:
+                if self.all_keys_up:
+                    logger.warning("All keys for the macro %s are already up, " \
+                                "the rest of the script will be ignored", self.macro.name)
+                    break
+                self.wait_for_state = val
+                self.wait_for_keys = list(self.macro.keys)
+                self._finished()
+                self.handler.buffered_executions.append(self)
+                return
+        self._finished()
+        
+    def _flush(self, batch):
+        if batch:
+            g15uinput.emit_all(batch)
+            del batch[:]
+        
+    def _delay(self, delay):
+        """
+        Schedule the rest of the script to run after a delay. False is returned
+        if there is no need to wait (because the script is running late)
         
-    def _send_uinput(self, target, val, state):
-        if val in g15uinput.capabilities:
-            g15uinput.emit(target, g15uinput.capabilities[val], state, True)
-        else:                        
-            logger.error("Unknown uinput key %s.", val)
+        Keyword arguments:
+        delay        -- delay in seconds
+        """
+        if delay <= 0:
+            return False
+        self.due += delay
+        wait = self.due - time.time()
+        if wait <= 0:
+            return False
+        self.timer = g15scheduler.queue(MACRO_HANDLER_QUEUE, "MacroScript", wait, self._resume)
+        return True
+    
+    def _finished(self):
+        if self in self.handler.executions:
+            self.handler.executions.remove(self)
 
 class G15Service(g15desktop.G15AbstractService):
     
@@ -571,6 +753,7 @@ class G15Service(g15desktop.G15AbstractService):
         self.stopping = False
         self.window_title_listener = None
         self.active_application_name = None
+        self._wnck_poll_interval = WNCK_POLL_MIN
         self.active_window_title = None
         self.ignore_next_sigint = False
         self.debug_svg = False
@@ -759,10 +942,14 @@ class G15Service(g15desktop.G15AbstractService):
                     logger.info("Active application is now %s", self.active_application_name)
                     for screen in self.screens:
                         screen.set_active_application_name(active_application_name)
+                    self._wnck_poll_interval = WNCK_POLL_MIN
+                else:
+                    # Nothing changed, so poll less often until something does
+                    self._wnck_poll_interval = min(WNCK_POLL_MAX, int(self._wnck_poll_interval * 1.5))
         except Exception as e:
             logger.warning("Failed to activate profile for active window", exc_info = e)
             
-        GObject.timeout_add(500, self._check_active_application_with_wnck)
+        GObject.timeout_add(self._wnck_poll_interval, self._check_active_application_with_wnck)
         
     def _check_state_of_all_devices(self, quickly = False):
         logger.info("Checking state of %d devices", len(self.devices))
@@ -0,0 +1,175 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Emulation of a mouse, digital joystick or direction keys using the G13's
+analogue stick. This is shared by the drivers that support the G13, which
+supply stick positions relative to the centre (i.e. in the range -128 to 127).
+
+All the per-position work (the dead zone given by the calibration value and
+the acceleration curve for mouse movement) is done once when the emulator is
+created or the calibration changes, so handling a position is just a table
+lookup. Mouse movement is repeated on a timer only while the stick is
+deflected, and stops as soon as it returns to the dead zone.
+"""
+
+from threading import RLock
+from gnome15 import g15uinput
+from gnome15.util import g15scheduler
+
+import logging
+logger = logging.getLogger(__name__)
+
+"""
+Range of positions the drivers supply, relative to the centre
+"""
+POSITION_MIN = -128
+POSITION_MAX = 127
+
+class StickEmulator(object):
+    """
+    Translates stick positions into directions, digital joystick values and
+    relative mouse movement.
+    """
+
+    def __init__(self, name, calibration, max_step = 5, divisor = 1, interval = 0.05):
+        """
+        Constructor
+
+        Keyword arguments:
+        name        --    name used for the mouse move timer
+        calibration --    distance from the centre the stick must move before
+                          it is considered deflected
+        max_step    --    largest relative movement for a single tick
+        divisor     --    distance past the dead zone needed to move one step
+        interval    --    time between mouse movement ticks (seconds)
+        """
+        self.name = name
+        self.max_step = max_step
+        self.divisor = divisor
+        self.interval = interval
+        self.lock = RLock()
+        self.move_x = 0
+        self.move_y = 0
+        self.timer = None
+        self.generation = 0
+        self.set_calibration(calibration)
+
+    def set_calibration(self, calibration):
+        """
+        Set the size of the dead zone and rebuild the lookup tables.
+
+        Keyword arguments:
+        calibration --    distance from the centre the stick must move before
+                          it is considered deflected
+        """
+        self.calibration = calibration
+        low_val = g15uinput.JOYSTICK_CENTER - calibration
+        high_val = g15uinput.JOYSTICK_CENTER + calibration
+        directions = []
+        steps = []
+        for pos in range(POSITION_MIN, POSITION_MAX + 1):
+            if pos < low_val:
+                directions.append(-1)
+                steps.append(-min(self.max_step, ( low_val - pos ) // self.divisor))
+            elif pos > high_val:
+                directions.append(1)
+                steps.append(min(self.max_step, ( pos - high_val ) // self.divisor))
+            else:
+                directions.append(0)
+                steps.append(0)
+        self._directions = directions
+        self._steps = steps
+
+    def direction(self, pos):
+        """
+        Get which side of the dead zone a position is on. -1 is returned for
+        left or up, 1 for right or down and 0 when inside the dead zone.
+
+        Keyword arguments:
+        pos        --    position on one axis, relative to the centre
+        """
+        return self._directions[self._index(pos)]
+
+    def digital(self, pos):
+        """
+        Get the digital joystick value for a position on one axis.
+
+        Keyword arguments:
+        pos        --    position on one axis, relative to the centre
+        """
+        d = self._directions[self._index(pos)]
+        if d < 0:
+            return g15uinput.JOYSTICK_MIN
+        elif d > 0:
+            return g15uinput.JOYSTICK_MAX
+        return g15uinput.JOYSTICK_CENTER
+
+    def move(self, x, y):
+        """
+        Set the stick position for mouse emulation. If the stick is outside
+        of the dead zone, the pointer is moved immediately and then repeatedly
+        until the stick is centred again.
+
+        Keyword arguments:
+        x        --    horizontal position, relative to the centre
+        y        --    vertical position, relative to the centre
+        """
+        with self.lock:
+            self.move_x = self._steps[self._index(x)]
+            self.move_y = self._steps[self._index(y)]
+            if self.move_x == 0 and self.move_y == 0:
+                self._cancel()
+            elif self.timer is None:
+                self._tick(self.generation)
+
+    def stop(self):
+        """
+        Stop any mouse movement.
+        """
+        with self.lock:
+            self.move_x = 0
+            self.move_y = 0
+            self._cancel()
+
+    """
+    Private
+    """
+
+    def _index(self, pos):
+        return max(POSITION_MIN, min(pos, POSITION_MAX)) - POSITION_MIN
+
+    def _cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            # A tick that has already fired must not start a new chain
+            self.generation += 1
+
+    def _tick(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            events = []
+            if self.move_x != 0:
+                events.append((g15uinput.MOUSE, g15uinput.REL_X, self.move_x))
+            if self.move_y != 0:
+                events.append((g15uinput.MOUSE, g15uinput.REL_Y, self.move_y))
+            if len(events) == 0:
+                self.timer = None
+                return
+            g15uinput.emit_all(events)
+            self.timer = g15scheduler.schedule(self.name, self.interval, self._tick, generation)
@@ -22,10 +22,23 @@ from gi.repository import GObject
 
 import cairo
 import logging
+from threading import RLock
+from collections import OrderedDict
 logger = logging.getLogger(__name__)
 
 # Shared pango context
 pango_context = PangoCairo.FontMap.get_default().create_context()
+
+# Maximum number of shaped layouts each text handler keeps
+LAYOUT_CACHE_SIZE=32
+
+# Font descriptions and metrics shared by all text handlers, keyed by font description string and absolute size 
+_font_descriptions = {}
+_font_metrics = {}
+
+_stats_lock = RLock()
+_hits = 0
+_misses = 0
  
 """
 Handles drawing and measuring of text on a screen. 
@@ -41,6 +54,23 @@ def new_text(screen = None):
         return G15PangoText(screen.driver.get_antialias())
     else:
         return G15PangoText(True)
+    
+def get_stats():
+    """
+    Get the hit and miss counts of the text layout caches of all text handlers.
+    """
+    with _stats_lock:
+        return { "hits" : _hits,
+                 "misses" : _misses }
+    
+def _count(hit):
+    global _hits
+    global _misses
+    with _stats_lock:
+        if hit:
+            _hits += 1
+        else:
+            _misses += 1
 
 class G15Text(object):
     
@@ -71,42 +101,38 @@ class G15Text(object):
             fo.set_hint_metrics(cairo.HINT_METRICS_OFF)            
     
 class G15PangoText(G15Text):
+    """
+    Text handler that uses Pango. Shaped layouts are kept, keyed by everything
+    that affects their shape (font, alignment, wrapping, width and text), so
+    text that is the same as in a previous frame is not laid out again. A 
+    layout is only re-shaped if it is drawn on a canvas with a different 
+    transformation or font options.
+    """
     
     def __init__(self, antialias):
         G15Text.__init__(self, antialias)
         PangoCairo.context_set_font_options(pango_context, self._create_font_options())   
-        self.__pango_cairo_context = None
+        self.canvas = None
         self.valign = Pango.Alignment.CENTER
         self.__layout = Pango.Layout.new(pango_context)
+        self.__layouts = OrderedDict()
         
     def set_canvas(self, canvas):           
         G15Text.set_canvas(self, canvas)
-        self.__layout = PangoCairo.create_layout(self.canvas)
-        self.__pango_cairo_context = self.__layout.get_context()
-        PangoCairo.context_set_font_options(self.__pango_cairo_context, self._create_font_options())
+        if self.__layout.get_context() is not pango_context:
+            PangoCairo.update_layout(self.canvas, self.__layout)
         
     def set_attributes(self, text, bounds = None, wrap = None, align = Pango.Alignment.LEFT, width = None, spacing = None, \
             font_desc = None, font_absolute_size = None, attributes = None,
             weight = None, style = None, font_pt_size = None,
             valign = None, pxwidth = None):
         
-        logger.debug("Text: %s, bounds = %s, wrap = %s, align = %s, width = %s, " \
-                     "attributes = %s, spacing = %s, font_desc = %s, weight = %s, " \
-                     "style = %s, valign = %s, pxwidth = %s, font_absolute_size = %s, font_pt_size = %s",
-                     str(text),
-                     str(bounds),
-                     str(wrap),
-                     str(align),
-                     str(width),
-                     str(attributes),
-                     str(spacing),
-                     str(font_desc),
-                     str(weight),
-                     str(style),
-                     str(valign),
-                     str(pxwidth),
-                     str(font_absolute_size),
-                     str(font_pt_size))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Text: %s, bounds = %s, wrap = %s, align = %s, width = %s, " \
+                         "attributes = %s, spacing = %s, font_desc = %s, weight = %s, " \
+                         "style = %s, valign = %s, pxwidth = %s, font_absolute_size = %s, font_pt_size = %s",
+                         text, bounds, wrap, align, width, attributes, spacing, font_desc, weight,
+                         style, valign, pxwidth, font_absolute_size, font_pt_size)
  
         G15Text.set_attributes(self, text, bounds)
         self.valign = valign
@@ -118,26 +144,62 @@ class G15PangoText(G15Text):
             font_desc_name += " %s" % style
         if font_pt_size:
             font_desc_name += " " + str(font_pt_size)
-        font_desc = Pango.FontDescription.from_string(font_desc_name)
-        if font_absolute_size is not None:
-            font_desc.set_absolute_size(font_absolute_size)
-        self.__layout.set_font_description(font_desc)        
+        if pxwidth != None:
+            width = int(Pango.SCALE * pxwidth)
+        
+        # Layouts with attribute lists are not cached, they cannot be compared
+        key = None
+        if attributes is None and self.canvas is not None:
+            key = ( font_desc_name, font_absolute_size, align, spacing, width, wrap, text )
+            layout = self.__layouts.get(key)
+            if layout is not None:
+                _count(True)
+                self.__layouts.move_to_end(key)
+                PangoCairo.update_layout(self.canvas, layout)
+                self.__layout = layout
+                self.metrics = _font_metrics[( font_desc_name, font_absolute_size )]
+                return
+            _count(False)
+        
+        if self.canvas is None:
+            layout = Pango.Layout.new(pango_context)
+        else:
+            layout = PangoCairo.create_layout(self.canvas)
+            PangoCairo.context_set_font_options(layout.get_context(), self._create_font_options())
+        
+        font_key = ( font_desc_name, font_absolute_size )
+        font_description = _font_descriptions.get(font_key)
+        if font_description is None:
+            font_description = Pango.FontDescription.from_string(font_desc_name)
+            if font_absolute_size is not None:
+                font_description.set_absolute_size(font_absolute_size)
+            _font_descriptions[font_key] = font_description
+        layout.set_font_description(font_description)        
         
         if align != None:
-            self.__layout.set_alignment(align)
+            layout.set_alignment(align)
         if spacing != None:
-            self.__layout.set_spacing(spacing)
+            layout.set_spacing(spacing)
         if width != None:
-            self.__layout.set_width(width)
-        if pxwidth != None:
-            self.__layout.set_width(int(Pango.SCALE * pxwidth))
+            layout.set_width(width)
         if wrap:
-            self.__layout.set_wrap(wrap)
+            layout.set_wrap(wrap)
         if attributes:
-            self.__layout.set_attributes(attributes)
+            layout.set_attributes(attributes)
             
-        self.__layout.set_text(text, -1)
-        self.metrics = pango_context.get_metrics(self.__layout.get_font_description())
+        layout.set_text(text, -1)
+        self.__layout = layout
+        
+        metrics = _font_metrics.get(font_key)
+        if metrics is None:
+            metrics = pango_context.get_metrics(font_description)
+            _font_metrics[font_key] = metrics
+        self.metrics = metrics
+        
+        if key is not None:
+            self.__layouts[key] = layout
+            if len(self.__layouts) > LAYOUT_CACHE_SIZE:
+                self.__layouts.popitem(last = False)
         
     def measure(self):
         text_extents = self.__layout.get_extents()[1]
@@ -156,8 +218,8 @@ class G15PangoText(G15Text):
                 if y == None:
                     y = self.bounds[1]
 
-                self.__pango_cairo_context.rectangle(self.bounds[0] - 1, self.bounds[1] - 1, self.bounds[2] + 2, self.bounds[3] + 2)
-                self.__pango_cairo_context.clip()
+                self.canvas.rectangle(self.bounds[0] - 1, self.bounds[1] - 1, self.bounds[2] + 2, self.bounds[3] + 2)
+                self.canvas.clip()
 
                 if self.valign == Pango.Alignment.RIGHT:
                     y += self.bounds[3] - ( self.metrics.get_ascent()  / 1000.0 )
@@ -45,6 +45,7 @@ from gi.repository import Rsvg as rsvg
 import os
 import cairo
 import sys
+import math
 from . import g15driver
 from . import g15globals
 from . import g15screen
@@ -53,6 +54,7 @@ from gnome15.util import g15scheduler as g15scheduler
 from . import g15text
 from . import g15locale
 from gnome15.util import g15cairo as g15cairo
+from gnome15.util import g15metrics as g15metrics
 from gnome15.util import g15svg as g15svg
 from gnome15.util import g15icontools as g15icontools
 import xml.sax.saxutils as saxutils
@@ -62,16 +64,23 @@ import logging
 import time
 logger = logging.getLogger(__name__)
 from string import Template
+from copy import copy
 from copy import deepcopy
 from io import StringIO
 from io import BytesIO
 from lxml import etree
 from threading import RLock
+from collections import OrderedDict
+import itertools
+import bisect
 import configparser
 
 BASE_PX=18.0
 DEBUG_SVG=False
 
+# Maximum number of bytes of rendered theme bitmaps to keep
+SURFACE_CACHE_SIZE=16 * 1024 * 1024
+
 # The color in SVG theme files that by default gets replaced with the current 'highlight' color
 DEFAULT_HIGHLIGHT_COLOR="#ff0000"
 
@@ -143,12 +152,177 @@ def get_themes(model_id, plugin_module):
     return themes
             
 class Render(object):
-    def __init__(self, document, properties, text_boxes, attributes, processing_result):
+    def __init__(self, document, properties, text_boxes, attributes, processing_result, scroll_boxes = None):
         self.document = document
         self.properties = properties
         self.text_boxes = text_boxes
         self.attributes = attributes
         self.processing_result = processing_result
+        self.scroll_boxes = scroll_boxes if scroll_boxes is not None else {}
+        self.background = None
+        self.strips = None
+        self.draw_keys = None
+        
+class CompiledTemplate(object):
+    """
+    A copy of a theme's document that has had all of the processing that does
+    not depend on theme properties (relative image paths, shadows, highlight
+    colour and default style) applied. Each render starts with a copy of this
+    rather than the original document. The key is the driver colours the
+    template was compiled with.
+    
+    The geometry of the template's elements is indexed, and the positions of
+    the clipped text elements (and their clip rectangles) are recorded, so
+    these need not be searched for or calculated again for each render.
+    """
+    def __init__(self, document, key, clipped_text):
+        self.document = document
+        self.key = key
+        self.geometry = g15svg.GeometryIndex(document.getroot())
+        self.clipped_text = clipped_text
+        
+    def find_clipped_text(self, root):
+        """
+        Get the clipped text elements, and their clip rectangles, in a copy of
+        the template's document. The clip rectangle will be None if the
+        template had no clip rectangle for the element.
+        
+        Keyword arguments:
+        root        -- root of copied document
+        """
+        return [ ( g15svg.find_path(root, text_path),
+                   g15svg.find_path(root, rect_path) if rect_path is not None else None )
+                 for text_path, rect_path in self.clipped_text ]
+        
+class SurfaceCache(object):
+    """
+    Least recently used cache of rendered theme bitmaps, limited by the total
+    size of their pixel data. The first element of each key is the id of the
+    theme that owns the entry, so all of a theme's entries can be invalidated
+    at once.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = RLock()
+        self._entries = OrderedDict()
+        self._owners = {}
+        
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            surface = self._entries.get(key)
+            if surface is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return surface
+        finally:
+            self.lock.release()
+        
+    def put(self, key, surface):
+        size = surface.get_stride() * surface.get_height()
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = surface
+            self._owners.setdefault(key[0], set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        finally:
+            self.lock.release()
+            
+    def invalidate(self, owner):
+        self.lock.acquire()
+        try:
+            for key in list(self._owners.get(owner, ())):
+                self._remove(key)
+        finally:
+            self.lock.release()
+            
+    def get_stats(self):
+        return { "entries" : len(self._entries),
+                 "size" : self.size,
+                 "max_size" : self.max_bytes,
+                 "hits" : self.hits,
+                 "misses" : self.misses,
+                 "evictions" : self.evictions }
+            
+    def _remove(self, key):
+        surface = self._entries.pop(key)
+        self.size -= surface.get_stride() * surface.get_height()
+        keys = self._owners[key[0]]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self._owners[key[0]]
+        
+class SharedDocument(object):
+    """
+    A loaded and processed theme document that is shared by all of the themes
+    created with shared = True for the same SVG file and driver (for example,
+    all of the items in a menu), along with the template compiled from it.
+    Themes that have a python portion never share their document.
+    """
+    def __init__(self, document):
+        self.document = document
+        self.compiled = None
+        
+surface_cache = SurfaceCache(SURFACE_CACHE_SIZE)
+theme_ids = itertools.count()
+paint_frames = itertools.count()
+shared_documents = {}
+shared_documents_lock = RLock()
+
+"""
+Returned by _freeze() for values that cannot be represented in a cache key
+"""
+UNCACHEABLE = object()
+
+def _freeze(value):
+    """
+    Get a hashable value to represent a theme property or attribute value in
+    a cache key. Lists, tuples, sets and dictionaries are frozen (recursively)
+    by their contents, so changing one in place gives a different key. Objects
+    that can only be compared by identity give UNCACHEABLE, as a new object
+    may be created with the same id as one that has been freed.
+    
+    Keyword arguments:
+    value        -- value to freeze
+    """
+    if value is None or isinstance(value, ( str, bytes, int, float, complex )):
+        return value
+    if isinstance(value, ( list, tuple )):
+        frozen = tuple(_freeze(v) for v in value)
+        return UNCACHEABLE if any(v is UNCACHEABLE for v in frozen) else frozen
+    if isinstance(value, ( set, frozenset )):
+        frozen = frozenset(_freeze(v) for v in value)
+        return UNCACHEABLE if UNCACHEABLE in frozen else ( "set", frozen )
+    if isinstance(value, dict):
+        frozen = frozenset(( _freeze(k), _freeze(v) ) for k, v in value.items())
+        return UNCACHEABLE if any(k is UNCACHEABLE or v is UNCACHEABLE for k, v in frozen) else ( "dict", frozen )
+    if type(value).__hash__ is None or type(value).__hash__ is object.__hash__:
+        return UNCACHEABLE
+    return value
+
+def _freeze_items(values):
+    """
+    Get a hashable value to represent theme properties, attributes or draw
+    keys in a cache key, or None if any of the values cannot be.
+    
+    Keyword arguments:
+    values        -- dictionary or tuple of values
+    """
+    frozen = _freeze(values)
+    return None if frozen is UNCACHEABLE else frozen
         
 class ScrollState(object):
     
@@ -178,8 +352,16 @@ class ScrollState(object):
     def do_transform(self):
         self.val = self.adjust + self.original
         self.transform_elements()
+        
+    def get_offset(self):
+        """
+        Get how far the scrolled text is currently displaced from where it is
+        drawn in its text strip, as an ( x, y ) tuple.
+        """
+        raise Exception("Not implemented")
             
 class HorizontalScrollState(ScrollState):
+    vertical = False
     
     def __init__(self, element = None):
         ScrollState.__init__(self)
@@ -191,16 +373,21 @@ class HorizontalScrollState(ScrollState):
         for e in self.other_elements:
             e.set("x", str(int(self.val)))
             
-    def __next__(self):
-        ScrollState.next(self)
+    def get_offset(self):
+        return ( int(self.val) - int(self.original), 0 )
                 
 class VerticalWrapScrollState(ScrollState):
+    vertical = True
+    
     def __init__(self, text_box):
         ScrollState.__init__(self)
         self.text_box = text_box
             
     def transform_elements(self):
         self.text_box.base = self.val
+        
+    def get_offset(self):
+        return ( 0, -self.val )
 
 class TextBox(object):
     def __init__(self):
@@ -215,6 +402,18 @@ class TextBox(object):
         self.transforms = []
         self.base = 0
         
+class TextStrip(object):
+    """
+    Scrolling text rendered once, unclipped, to its own surface. Each scroll
+    step then just paints the surface clipped to the text's clip bounds at
+    the current scroll offset.
+    """
+    def __init__(self, surface, x, y, clip):
+        self.surface = surface
+        self.x = x
+        self.y = y
+        self.clip = clip
+        
 class LayoutManager(object):
     def __init__(self):
         pass
@@ -285,6 +484,18 @@ class Component(object):
         self.showing = True
         self.activatable = False
         self.scrollbar = None
+        self.generation = 0
+        
+        # Set on the root component while a frame is being painted
+        self.paint_frame = None
+        self.frame_properties = None
+        
+        # What was worked out about this component for the current frame, and its painted subtree
+        self._frame = None
+        self._frame_properties = None
+        self._frame_key = None
+        self._surface = None
+        self._surface_key = None
         
     def set_scrollbar(self, scrollbar):
         self.scrollbar = scrollbar
@@ -308,7 +519,10 @@ class Component(object):
         return self.showing
     
     def set_showing(self, showing):
-        self.showing = showing
+        if showing != self.showing:
+            self.showing = showing
+            if self.parent is not None:
+                self.parent.on_child_showing(self)
         
     def get_showing_count(self):
         i = 0
@@ -346,6 +560,7 @@ class Component(object):
             self.get_tree_lock().release()
         
     def mark_dirty(self):
+        self.generation += 1
         if self.theme is not None:
             self.theme.mark_dirty()
         for c in self.get_children():
@@ -518,6 +733,15 @@ class Component(object):
         """
         pass
     
+    def get_draw_key(self):
+        """
+        Get a value that changes whenever draw() would adjust the document 
+        differently. Components that override draw() should override this
+        too, otherwise their parent's theme will only be processed again
+        when it is marked dirty or its properties change.
+        """
+        return None
+    
     def paint_theme(self, canvas, properties, attributes):
         """
         Paint the theme. Do not call directly, instead call paint()
@@ -536,46 +760,33 @@ class Component(object):
                 canvas.rectangle(0, 0, self.view_bounds[2], self.view_bounds[3])
                 canvas.clip()
                 
-            # Translate against the base, this allows components to be scrolled within their viewport
-            canvas.translate(0, -self.base)
-                        
-            # Draw any theme for this component
-            if self.theme is not None:
-                canvas.save()   
-                properties = self.get_theme_properties()
-                
-                # Add some common properties
-                if self.get_root().focused_component is not None:
-                    properties['%s_focused' % self.get_root().focused_component.id ] = "true"
-                
-                screen = self.get_screen()
-                if screen:
-                    states = screen.key_handler.get_key_states()
-                    for k in states:
-                        ks = states[k]
-                        if ks.state_id == g15driver.KEY_STATE_DOWN:
-                            properties['key_%s' % k ] = True
-                        elif ks.state_id == g15driver.KEY_STATE_HELD:
-                            properties['key_%s_held' % k ] = True
-                
-                self.paint_theme(canvas, properties, self.get_theme_attributes())
-                canvas.restore()
-                
-            # Layout any children
-            if self.layout_manager != None:
-                self.layout_manager.layout(self)
-                
-            # Paint children
-            for c in self._children:
-                if c.is_showing():
-                    canvas.save()
-                    if not self.do_clip or c.view_bounds is None or self.overlaps(self.view_bounds, c.view_bounds):
-                        c.paint(canvas)
-                    canvas.restore()
+            size = self._get_surface_size(canvas)
+            key = self._get_paint_key() if size is not None else None
+            if key is None:
+                self._surface = None
+                self._surface_key = None
+                self._paint_view(canvas)
+            else:
+                # Nothing in this subtree has changed since it was last painted, reuse the surface
+                if self._surface is None or self._surface_key != key:
+                    self._surface = self._render_surface(canvas, size)
+                    self._surface_key = key
+                canvas.set_source_surface(self._surface, 0, 0)
+                canvas.paint()
             
             canvas.restore()
         finally:
             self.get_tree_lock().release()
+            
+    def clear_surfaces(self):
+        """
+        Free the cached surfaces of this component and all of its children.
+        They will be rendered again the next time they are painted.
+        """
+        self._surface = None
+        self._surface_key = None
+        for c in self._children:
+            c.clear_surfaces()
         
     def overlaps(self, bounds1, bounds2):
         return bounds2[1] >= ( self.base - bounds2[3] ) and bounds2[1] < ( self.base + bounds1[3] )
@@ -602,10 +813,190 @@ class Component(object):
            
     def notify_remove(self):
         self.remove_all_children()
+        
+    def on_child_showing(self, child):
+        """
+        Called when one of this component's children is shown or hidden.
+        
+        Keyword arguments:
+        child        -- child that has been shown or hidden
+        """
+        pass
     
     '''
     Private
     '''
+    def _paint_view(self, canvas):
+        """
+        Paint the theme and children. The canvas has already been translated
+        and clipped to this component's bounds.
+        
+        Keyword arguments:
+        canvas        -- canvas to paint on
+        """
+        # Translate against the base, this allows components to be scrolled within their viewport
+        canvas.translate(0, -self.base)
+                    
+        # Draw any theme for this component
+        if self.theme is not None:
+            canvas.save()   
+            self.paint_theme(canvas, self._get_paint_properties(), self.get_theme_attributes())
+            canvas.restore()
+            
+        self._paint_children(canvas)
+        
+    def _get_paint_properties(self):
+        """
+        Get the theme properties, with the properties common to all components
+        (focus and key states) added. These are only worked out once per frame.
+        """
+        root = self.get_root()
+        if root.paint_frame is not None and self._frame == root.paint_frame and self._frame_properties is not None:
+            return self._frame_properties
+        properties = self.get_theme_properties()
+        
+        # Add some common properties
+        common = root.frame_properties if root.paint_frame is not None else None
+        if common is None:
+            common = {}
+            if root.focused_component is not None:
+                common['%s_focused' % root.focused_component.id ] = "true"
+            
+            screen = self.get_screen()
+            if screen:
+                states = screen.key_handler.get_key_states()
+                for k in states:
+                    ks = states[k]
+                    if ks.state_id == g15driver.KEY_STATE_DOWN:
+                        common['key_%s' % k ] = True
+                    elif ks.state_id == g15driver.KEY_STATE_HELD:
+                        common['key_%s_held' % k ] = True
+            if root.paint_frame is not None:
+                root.frame_properties = common
+        properties.update(common)
+        
+        if root.paint_frame is not None:
+            if self._frame != root.paint_frame:
+                self._frame = root.paint_frame
+                self._frame_key = None
+            self._frame_properties = properties
+        return properties
+    
+    def _get_paint_key(self):
+        """
+        Get a key that changes whenever anything this component would paint
+        changes, or None if that cannot be known. The key includes the
+        component's and its theme's generation (which mark_dirty() changes),
+        the theme properties and attributes, the base, and the bounds and keys 
+        of the children that would be painted. So if a single child changes, 
+        only it and its ancestors get new keys.
+        """
+        root = self.get_root()
+        if root.paint_frame is not None and self._frame == root.paint_frame and self._frame_key is not None:
+            return self._frame_key[0]
+        key = self._calculate_paint_key()
+        if root.paint_frame is not None:
+            if self._frame != root.paint_frame:
+                self._frame = root.paint_frame
+                self._frame_properties = None
+            # Wrapped, so that a key of None is also remembered
+            self._frame_key = ( key, )
+        return key
+    
+    def _calculate_paint_key(self):
+        # Components that paint themselves cannot be cached
+        if type(self).paint not in _CACHEABLE_PAINTS or type(self).paint_theme is not Component.paint_theme:
+            return None
+        
+        theme_key = None
+        if self.theme is not None:
+            # Scrolling text changes every step, and python that paints over the theme may paint anything
+            if ( self.theme.is_scroll_required() and self.get_allow_scrolling() ) or \
+                    ( self.theme.instance is not None and hasattr(self.theme.instance, 'paint_foreground') ):
+                return None
+            properties = _freeze_items(self._get_paint_properties())
+            attributes = _freeze_items(self.get_theme_attributes())
+            if properties is None or attributes is None:
+                return None
+            theme_key = ( self.theme.cache_id,
+                          self.theme.generation,
+                          self.theme.variant,
+                          self.theme._get_color_key(),
+                          properties,
+                          attributes )
+        
+        children = []
+        for c in self._get_painted_children():
+            child_key = c._get_paint_key()
+            if child_key is None:
+                return None
+            children.append(( c.view_bounds, child_key ))
+        draw_key = _freeze(self.get_draw_key())
+        if draw_key is UNCACHEABLE:
+            return None
+        return ( self.generation, theme_key, draw_key, self.base, self.view_bounds, tuple(children) )
+    
+    def _get_painted_children(self):
+        """
+        Get the children that would be painted by _paint_children().
+        """
+        return [ c for c in self._children if c.is_showing() ]
+    
+    def _get_surface_size(self, canvas):
+        """
+        Get the size of surface to cache this component's painted subtree in, or
+        None if it should not be cached. Only components that have children to
+        paint are cached (themes cache their own bitmaps), and the canvas must
+        only be translated by whole pixels.
+        
+        Keyword arguments:
+        canvas        -- canvas that has been translated to the component's bounds
+        """
+        if self.view_bounds is None or len(self._children) == 0:
+            return None
+        xx, yx, xy, yy, x0, y0 = canvas.get_matrix()
+        if xx != 1 or yy != 1 or xy != 0 or yx != 0 or x0 != int(x0) or y0 != int(y0):
+            return None
+        size = ( int(math.ceil(self.view_bounds[2])), int(math.ceil(self.view_bounds[3])) )
+        if size[0] <= 0 or size[1] <= 0:
+            return None
+        return size
+    
+    def _render_surface(self, canvas, size):
+        """
+        Paint the theme and children to a new surface.
+        
+        Keyword arguments:
+        canvas        -- canvas the surface will be painted on
+        size          -- size of surface
+        """
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
+        context = cairo.Context(surface)
+        context.set_antialias(canvas.get_antialias())
+        context.set_font_options(canvas.get_font_options())
+        self._paint_view(context)
+        return surface
+    
+    def _paint_children(self, canvas):
+        """
+        Layout and paint the children. The canvas has already been translated
+        to this component's bounds (less any base).
+        
+        Keyword arguments:
+        canvas        -- canvas to paint on
+        """
+        # Layout any children
+        if self.layout_manager != None:
+            self.layout_manager.layout(self)
+            
+        # Paint children
+        for c in self._children:
+            if c.is_showing():
+                canvas.save()
+                if not self.do_clip or c.view_bounds is None or self.overlaps(self.view_bounds, c.view_bounds):
+                    c.paint(canvas)
+                canvas.restore()
+        
     def _check_has_parent(self):
 #        if not self.parent:
 #            raise Exception("%s must be added to a parent before children can be added to it." % self.id)
@@ -781,7 +1172,13 @@ class G15Page(Component):
         if self.painter != None:
             self.painter(canvas)
             
-        Component.paint(self, canvas)
+        self.paint_frame = next(paint_frames)
+        self.frame_properties = None
+        try:
+            Component.paint(self, canvas)
+        finally:
+            self.paint_frame = None
+            self.frame_properties = None
             
         # Paint the canvas
         if self.buffer != None:
@@ -873,6 +1270,7 @@ class G15Page(Component):
             self.on_shown()
         
     def _do_on_hidden(self):
+        self.clear_surfaces()
         for l in self.on_hidden_listeners:
             l()
         if self.on_hidden:
@@ -921,8 +1319,23 @@ class Scrollbar(Component):
         
     def draw(self, theme, element):
         self._configure_track_and_bounds(theme, element)
+        
+    def get_draw_key(self):
+        return tuple(self.values_callback()) if self.values_callback is not None else None
 
 class Menu(Component):
+    """
+    A vertical list of MenuItem components, one of which may be selected.
+    
+    By default the menu is 'virtual'. The position of each item is kept in an
+    index that is only rebuilt when items are added, removed, shown or
+    hidden, and only the items that are in view are laid out and painted. 
+    Items that decide whether they are showing themselves (by overriding 
+    is_showing()) cause the index to be rebuilt every time it is used. 
+    Setting 'virtual' to False, or using a layout manager other than a 
+    single column grid, lays out and paints the items like any other 
+    component.
+    """
     def __init__(self, component_id):
         Component.__init__(self, component_id)
         self.selected = None
@@ -932,6 +1345,10 @@ class Menu(Component):
         self.do_clip = True
         self.layout_manager = GridLayoutManager(1)
         self.scroll_timer = None
+        self.virtual = True
+        self._offsets = None
+        self._offsets_static = False
+        self._base_frame = None
         
     def set_scrollbar(self, scrollbar):
         scrollbar.values_callback = self.get_scroll_values
@@ -974,19 +1391,25 @@ class Menu(Component):
     
     def add_child(self, child, index = -1):
         Component.add_child(self, child, index)
+        self._offsets = None
         self.select_first()
         self._recalc_scroll_values()
         self.centre_on_selected()
     
     def remove_child(self, child):
         Component.remove_child(self, child)
+        self._offsets = None
         self.select_first()
         self._recalc_scroll_values()
         self.centre_on_selected()
+        
+    def on_child_showing(self, child):
+        self._offsets = None
     
     def set_children(self, children):
         was_selected = self.selected
         Component.set_children(self, children)
+        self._offsets = None
         if was_selected in self.get_children():
             self.selected = was_selected
         else:
@@ -994,11 +1417,7 @@ class Menu(Component):
         self.centre_on_selected()
             
     def centre_on_selected(self):
-        y = 0
-        c = self.get_children()
-        for r in range(0, self._get_selected_index()):
-            if c[r].is_showing():
-                y += self.get_item_height(c[r], True)
+        y = self._get_offsets()[max(0, self._get_selected_index())]
         self.base = max(0, y - ( self.view_bounds[3] / 2 ))
         self._recalc_scroll_values()
         self.get_root().redraw()
@@ -1017,19 +1436,30 @@ class Menu(Component):
         g15screen.check_on_redraw()
         self.get_tree_lock().acquire()
         try:    
+            self._update_base()
+            Component.paint(self, canvas)
+        finally:
+            self.get_tree_lock().release()
             
+    def _update_base(self):
+        """
+        Move the base towards the position that makes the selected item visible.
+        This is done once per frame, before the menu is painted, or before its
+        key is calculated (as the menu is not painted if its parent's cached
+        surface can be used).
+        """
+        frame = self.get_root().paint_frame
+        if frame is not None and frame == self._base_frame:
+            return
+        self._base_frame = frame
+        self.get_tree_lock().acquire()
+        try:    
             self.select_first()                 
             
-            # Get the Y position of the selected item
-            y = 0 
+            # Get the Y position of the selected item. Only items that are "showing" are included
             selected_y = -1
-            for item in self.get_children():
-                # Only include items that are "showing"
-                if item.is_showing():
-                    ih = self.get_item_height(item, True)
-                    if item == self.selected:
-                        selected_y = y
-                    y += ih
+            if self.selected is not None and self.selected.is_showing():
+                selected_y = self._get_offsets()[self.index_of_child(self.selected)]
                     
             new_base = self.base
                     
@@ -1063,22 +1493,39 @@ class Menu(Component):
                     self.scroll_timer = g15scheduler.schedule("ScrollTo", self.get_screen().service.animation_delay, self.get_root().redraw)
                 else:
                     self.get_root().redraw()
-            
-            Component.paint(self, canvas)
         finally:
             self.get_tree_lock().release()
         
     def get_items_per_page(self):
         self.get_tree_lock().acquire()
         try:
-            total_size = 0
-            for item in self.get_children():
-                total_size += self.get_item_height(item, True)            
-            avg_size = total_size / self.get_child_count()
+            showing = self.get_showing_count()
+            total_size = self._get_offsets()[-1]
+            if showing == 0 or total_size == 0:
+                return 1
+            avg_size = total_size / showing
             return int(self.view_bounds[3] / avg_size)
         finally:
             self.get_tree_lock().release()
             
+    def mark_dirty(self):
+        """
+        Mark the menu's theme as dirty, and the items' themes as needing to be
+        processed again. The items' rendered bitmaps are kept. They are cached
+        by their theme properties and the driver colours, so a row is only
+        painted from the cache when it is in the same state (e.g. selected or
+        not) and colours it was rendered in.
+        """
+        self.generation += 1
+        if self.theme is not None:
+            self.theme.mark_dirty()
+        for c in self.get_children():
+            c.generation += 1
+            if c.theme is not None:
+                c.theme.dirty = True
+            if c.get_child_count() > 0:
+                c.mark_dirty()
+            
     def action_performed(self, binding):
         if self.is_visible():
             if binding.action == g15driver.NEXT_SELECTION:
@@ -1147,12 +1594,70 @@ class Menu(Component):
     Private
     '''
     
-    def _recalc_scroll_values(self):
-        max_val = 0
-        for item in self.get_children():
-            if item.is_showing():
-                max_val += self.get_item_height(item, True)
+    def _is_virtual(self):
+        return self.virtual and type(self.layout_manager) is GridLayoutManager and \
+            self.layout_manager.columns == 1
+    
+    def _get_offsets(self):
+        """
+        Get the Y position of each item, followed by the total height of all
+        items. Items that are not showing take up no space.
+        """
+        offsets = self._offsets
+        if offsets is None or not self._offsets_static:
+            offsets = []
+            static = True
+            y = 0
+            for item in self._children:
+                offsets.append(y)
+                if type(item).is_showing is not Component.is_showing:
+                    static = False
+                if item.is_showing():
+                    y += self.get_item_height(item, True)
+            offsets.append(y)
+            self._offsets = offsets
+            self._offsets_static = static
+        return offsets
+    
+    def _calculate_paint_key(self):
+        self._update_base()
+        return Component._calculate_paint_key(self)
+    
+    def _get_visible_range(self):
+        offsets = self._get_offsets()
+        first = max(0, bisect.bisect_right(offsets, self.base) - 1)
+        last = min(len(self._children), bisect.bisect_left(offsets, self.base + self.view_bounds[3]))
+        return first, last
+    
+    def _get_painted_children(self):
+        if not self._is_virtual():
+            return Component._get_painted_children(self)
+        first, last = self._get_visible_range()
+        return [ c for c in self._children[first:last] if c.is_showing() ]
+    
+    def _paint_children(self, canvas):
+        if not self._is_virtual():
+            Component._paint_children(self, canvas)
+            return
+        
+        # Only layout and paint the items that are in view
+        offsets = self._get_offsets()
+        children = self._children
+        first, last = self._get_visible_range()
+        for i in range(first, last):
+            c = children[i]
+            if c.is_showing():
+                bounds = c.view_bounds
+                if bounds is None:
+                    logger.warning("No bounds on component %s", c.id)
+                else:
+                    c.view_bounds = ( 0, offsets[i], bounds[2], bounds[3] )
+                canvas.save()
+                c.paint(canvas)
+                canvas.restore()
                 
+    def _recalc_scroll_values(self):
+        max_val = self._get_offsets()[-1]
         self.scroll_values = max(max_val, self.view_bounds[3]), self.view_bounds[3], self.base
     
     def _check_selected(self):
@@ -1279,7 +1784,7 @@ class MenuItem(Component):
         self.activatable = activatable
         
     def on_configure(self):        
-        self.set_theme(G15Theme(self.parent.get_theme().dir, "menu-entry" if self.group else "menu-child-entry"))
+        self.set_theme(G15Theme(self.parent.get_theme().dir, "menu-entry" if self.group else "menu-child-entry", shared = True))
         
     def get_theme_properties(self):     
         return {
@@ -1304,7 +1809,7 @@ class MenuSeparator(MenuItem):
         MenuItem.__init__(self, id)
         
     def on_configure(self):
-        self.set_theme(G15Theme(self.parent.get_theme().dir, "menu-separator"))
+        self.set_theme(G15Theme(self.parent.get_theme().dir, "menu-separator", shared = True))
     
 class DBusMenuItem(MenuItem):
     def __init__(self, id, dbus_menu_entry):
@@ -1433,8 +1938,11 @@ class ConfirmationScreen(G15Page):
             self.get_screen().key_handler.action_listeners.remove(self)
             self.callback(self.arg)  
                 
+# Component paint() implementations whose output is covered by Component._get_paint_key()
+_CACHEABLE_PAINTS = ( Component.paint, G15Page.paint, Menu.paint )
+        
 class G15Theme(object):    
-    def __init__(self, dir_path, variant = None, svg_text = None, prefix = None, auto_dirty = True, translation = None):
+    def __init__(self, dir_path, variant = None, svg_text = None, prefix = None, auto_dirty = True, translation = None, shared = False):
         self.translation = translation
         self.plugin = None
         if isinstance(dir_path, ThemeDefinition):
@@ -1461,7 +1969,15 @@ class G15Theme(object):
         self.component = None
         self.auto_dirty = auto_dirty
         self.render = None
+        self.cache_id = next(theme_ids)
+        self.generation = 0
+        self.compiled = None
+        self.shared = shared
+        self.shared_document = None
+        self.svg_text_cache = None
+        self.svg_handle = None
         self.scroll_state = {}
+        self.strip_cache = {}
         self.nsmap = {
             'sodipodi': 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
             'cc': 'http://web.resource.org/cc/',
@@ -1506,6 +2022,7 @@ class G15Theme(object):
                 
             if self.page is None:
                 self.document = None
+                self.shared_document = None
                 self.screen = None
                 self.text = None
                 self.driver = None
@@ -1514,6 +2031,7 @@ class G15Theme(object):
                 self.screen = self.page.get_screen()
                 self.text = g15text.new_text(self.screen)
                 self.driver = self.screen.driver
+                self.shared_document = None
                 if self.dir != None:
                     self.theme_name = os.path.basename(self.dir)
                     prefix_path = self.prefix if self.prefix != None else os.path.basename(os.path.dirname(self.dir)).replace("-", "_")+ "_" + self.theme_name + "_"
@@ -1533,7 +2051,10 @@ class G15Theme(object):
                     actual_variant = os.path.splitext(os.path.basename(path))[0]
                     self.translation = g15locale.get_translation(actual_variant, self.dir)
                     
-                    self.document = etree.parse(path)
+                    if self.shared and module is None:
+                        self._load_shared_document(path)
+                    else:
+                        self.document = etree.parse(path)
                     
                         
                     # Give the python portion of the theme chance to initialize
@@ -1548,8 +2069,11 @@ class G15Theme(object):
                 else:
                     raise Exception("Must either supply theme directory or SVG text")
                     
-                self.process_svg()
+                if self.shared_document is None:
+                    self.process_svg()
                 self.bounds = g15svg.get_bounds(self.document.getroot())
+            self.compiled = None
+            surface_cache.invalidate(self.cache_id)
         finally:
             self.render_lock.release()
         
@@ -1689,12 +2213,30 @@ class G15Theme(object):
     
     def mark_dirty(self):
         self.dirty = True
+        self.generation += 1
+        surface_cache.invalidate(self.cache_id)
             
     def draw(self, canvas, properties = {}, attributes = {}):
         if self.render != None and self.auto_dirty:
             if self.render.properties != properties or self.render.attributes != attributes or \
                list(self.render.properties.values()) != list(properties.values()) or list(self.render.attributes.values()) != list(attributes.values()):
                 self.dirty = True
+                
+        # Child components that adjust the document may need it processing again
+        draw_keys = self._get_draw_keys()
+        if self.render != None and self.render.draw_keys != draw_keys:
+            self.dirty = True
+                
+        # If this exact output has been rendered before, just paint that
+        cache_key = self._get_surface_cache_key(canvas, properties, attributes, draw_keys)
+        if cache_key is not None:
+            surface = surface_cache.get(cache_key)
+            if surface is not None:
+                if self.dirty:
+                    # The current render is for different properties, so must be rebuilt if it is needed
+                    self.render = None
+                self._paint_surface(canvas, surface)
+                return self.render.document if self.render is not None else None
         
         if self.render == None or self.dirty:
             self.render_lock.acquire()
@@ -1704,8 +2246,10 @@ class G15Theme(object):
             
             self.text.set_canvas(canvas)
             
+            processing_started = time.time()
             try:
-                document = deepcopy(self.document)
+                compiled = self._get_compiled_template()
+                document = deepcopy(compiled.document)
                 processing_result = None
                 
                 # Give the python portion of the theme chance to draw stuff under the SVG
@@ -1716,19 +2260,17 @@ class G15Theme(object):
                         logger.debug("Error painting background", exc_info = e)
                     
                 root = document.getroot()
+                clipped_text = compiled.find_clipped_text(root)
                          
                 # Process the SVG         
                 self._process_deletes(root, properties)
                 self._process_components(root)
                 self._set_progress_bars(root, properties) 
-                self._set_relative_image_paths(root)
                 self._convert_image_urls(root, properties)
-                self._do_shadow("shadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_BACKGROUND, (255, 255,255)), root)
-                self._do_shadow("reverseshadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_FOREGROUND, (0, 0, 0)), root)
-                self._set_highlight_color(root)
                 
                 text_boxes = []
-                self._handle_text_boxes(root, text_boxes, properties, canvas)        
+                scroll_boxes = {}
+                self._handle_text_boxes(root, clipped_text, text_boxes, scroll_boxes, properties, canvas)        
                     
                 # Pass the SVG document to the SVG processor if there is one
                 if self.svg_processor != None:
@@ -1744,16 +2286,21 @@ class G15Theme(object):
                     except Exception as e:
                         logger.debug("Error processing SVG", exc_info = e)
                     
-                self._set_default_style(root)
-                    
-                self.render = Render(document, properties, text_boxes, attributes, processing_result)
+                self.render = Render(document, properties, text_boxes, attributes, processing_result, scroll_boxes)
+                self.render.draw_keys = draw_keys
                 self.dirty = False
             finally:
                 self.render_lock.release()
+            self.screen.metrics.record(g15metrics.STAGE_THEME, time.time() - processing_started)
         else:
             self.text.set_canvas(canvas)
             
-        self._render_document(canvas, self.render)
+        if cache_key is not None and not self.is_scroll_required():
+            surface = self._rasterize(canvas, self.render, cache_key[-1])
+            surface_cache.put(cache_key, surface)
+            self._paint_surface(canvas, surface)
+        elif not self._paint_scroll(canvas, self.render):
+            self._render_document(canvas, self.render)
         return self.render.document
             
     def is_scroll_required(self):
@@ -1773,6 +2320,326 @@ class G15Theme(object):
     Private
     """
     
+    def _get_compiled_template(self):
+        """
+        Get the compiled template for the current driver colours, compiling it
+        if the colours have changed or the document has been reloaded.
+        """
+        key = self._get_color_key()
+        background, foreground, highlight = key
+        shared = self.shared_document
+        if ( self.compiled is None or self.compiled.key != key ) and shared is not None:
+            compiled = shared.compiled
+            if compiled is not None and compiled.key == key:
+                self.compiled = compiled
+        if self.compiled is None or self.compiled.key != key:
+            logger.debug("Compiling theme template for %s (variant %s)", self.dir, self.variant)
+            document = deepcopy(self.document)
+            root = document.getroot()
+            self._set_relative_image_paths(root)
+            self._do_shadow("shadow", background, root)
+            self._do_shadow("reverseshadow", foreground, root)
+            self._set_highlight_color(root)
+            self._set_default_style(root)
+            clipped_text = []
+            for element in root.xpath('//svg:text[@clip-path]',namespaces=self.nsmap):
+                clip_path_node = self._get_clip_path_element(element)
+                if clip_path_node is not None:
+                    rect = self.get_element_by_tag("rect", clip_path_node)
+                    clipped_text.append(( g15svg.get_path(element), g15svg.get_path(rect) if rect is not None else None ))
+            self.compiled = CompiledTemplate(document, key, clipped_text)
+            if shared is not None:
+                shared.compiled = self.compiled
+        return self.compiled
+        
+    def _get_color_key(self):
+        """
+        Get the driver colours the template is compiled with, as a tuple of
+        background, foreground and highlight (or None if there is no highlight).
+        """
+        driver = self.screen.driver
+        background = driver.get_color_as_hexrgb(g15driver.HINT_BACKGROUND, (255, 255,255))
+        foreground = driver.get_color_as_hexrgb(g15driver.HINT_FOREGROUND, (0, 0, 0))
+        highlight = driver.get_color_as_hexrgb(g15driver.HINT_HIGHLIGHT, (255, 0, 0 )) \
+            if driver.get_control_for_hint(g15driver.HINT_HIGHLIGHT) else None
+        return ( background, foreground, highlight )
+        
+    def _load_shared_document(self, path):
+        """
+        Use the shared copy of the document at the given path, loading and
+        processing it if this is the first theme to use it.
+        
+        Keyword arguments:
+        path        -- path of SVG file
+        """
+        key = ( path, self.driver.get_model_name(), self.screen.service.disable_svg_glow )
+        shared_documents_lock.acquire()
+        try:
+            shared = shared_documents.get(key)
+            if shared is None:
+                self.document = etree.parse(path)
+                self.process_svg()
+                shared = SharedDocument(self.document)
+                shared_documents[key] = shared
+            self.document = shared.document
+            self.shared_document = shared
+        finally:
+            shared_documents_lock.release()
+    
+    def _get_draw_keys(self):
+        """
+        Get the draw keys of the child components that adjust this theme's
+        document when it is processed.
+        """
+        if self.component is None:
+            return ()
+        return tuple(( child_id, c.get_draw_key() ) for child_id, c in self.component.child_map.items() \
+                     if type(c).draw is not Component.draw)
+    
+    def _get_surface_cache_key(self, canvas, properties, attributes, draw_keys = ()):
+        """
+        Get the key to use for the rendered bitmap cache, or None if this render
+        cannot be cached. This is the case while text is scrolling, when the
+        theme's python code paints over the SVG itself, when the canvas
+        is transformed by anything other than a whole pixel translation, or
+        when a property, attribute or draw key is an object that cannot be
+        compared by value.
+        
+        Keyword arguments:
+        canvas        -- canvas that will be drawn on
+        properties    -- theme properties
+        attributes    -- theme attributes
+        draw_keys     -- draw keys of child components
+        """
+        if self.is_scroll_required():
+            return None
+        size = self._get_raster_size(canvas)
+        if size is None:
+            return None
+        frozen_properties = _freeze_items(properties)
+        frozen_attributes = _freeze_items(attributes)
+        frozen_draw_keys = _freeze_items(draw_keys)
+        if frozen_properties is None or frozen_attributes is None or frozen_draw_keys is None:
+            return None
+        return ( self.cache_id,
+                 self.variant,
+                 self._get_color_key(),
+                 frozen_properties,
+                 frozen_attributes,
+                 frozen_draw_keys,
+                 size )
+        
+    def _get_raster_size(self, canvas):
+        """
+        Get the size of surface the theme should be rendered to if its output
+        can be painted as a bitmap, or None if it must be rendered directly on
+        to the canvas. 
+        
+        Keyword arguments:
+        canvas        -- canvas that will be drawn on
+        """
+        if self.bounds is None or \
+                ( self.instance is not None and hasattr(self.instance, 'paint_foreground') ):
+            return None
+        xx, yx, xy, yy, x0, y0 = canvas.get_matrix()
+        if xx != 1 or yy != 1 or xy != 0 or yx != 0 or x0 != int(x0) or y0 != int(y0):
+            return None
+        size = ( int(math.ceil(self.bounds[0] + self.bounds[2])), int(math.ceil(self.bounds[1] + self.bounds[3])) )
+        if size[0] <= 0 or size[1] <= 0:
+            return None
+        return size
+    
+    def _paint_scroll(self, canvas, render):
+        """
+        Paint a render that contains scrolling text. Everything but the scrolling
+        text is rendered once to a background surface, and each piece of
+        scrolling text to its own strip surface. Both are kept until the next
+        time the document is processed, so a scroll step is just a few clipped
+        paints. False is returned if the render cannot be painted this way, and
+        must be rendered in full instead.
+        
+        Keyword arguments:
+        canvas        -- canvas to paint on
+        render        -- render to paint
+        """
+        if len(render.scroll_boxes) == 0:
+            return False
+        for id in render.scroll_boxes:
+            if id not in self.scroll_state:
+                return False
+        size = self._get_raster_size(canvas)
+        if size is None:
+            return False
+        
+        if render.background is None:
+            started = time.time()
+            strip_cache = {}
+            strips = {}
+            for id, text_box in render.scroll_boxes.items():
+                scroll_item = self.scroll_state[id]
+                key = self._get_strip_key(id, text_box, scroll_item)
+                strip = self.strip_cache.get(key)
+                if strip is None:
+                    if scroll_item.vertical:
+                        strip = self._render_vertical_strip(canvas, text_box, scroll_item)
+                    else:
+                        strip = self._render_horizontal_strip(canvas, render, id, text_box, scroll_item)
+                strip_cache[key] = strip
+                strips[id] = strip
+            self.strip_cache = strip_cache
+            render.strips = strips
+            render.background = self._render_scroll_background(canvas, render, size)
+            self.screen.metrics.record(g15metrics.STAGE_THEME, time.time() - started)
+        
+        self._paint_surface(canvas, render.background)
+        for id, strip in render.strips.items():
+            x, y = self.scroll_state[id].get_offset()
+            canvas.save()
+            canvas.rectangle(strip.clip[0], strip.clip[1], strip.clip[2], strip.clip[3])
+            canvas.clip()
+            canvas.set_source_surface(strip.surface, strip.x + x, strip.y + y)
+            canvas.paint()
+            canvas.restore()
+        return True
+    
+    def _get_strip_key(self, id, text_box, scroll_item):
+        return ( id,
+                 scroll_item.vertical,
+                 text_box.text,
+                 tuple(sorted(text_box.css.items())),
+                 text_box.normal_shadow,
+                 text_box.reverse_shadow,
+                 text_box.clip,
+                 text_box.bounds,
+                 scroll_item.range,
+                 scroll_item.original,
+                 self.compiled.key if self.compiled is not None else None )
+    
+    def _render_scroll_background(self, canvas, render, size):
+        """
+        Render everything but the scrolling text to a new surface.
+        
+        Keyword arguments:
+        canvas        -- canvas the surface will be painted on
+        render        -- render containing the scrolling text
+        size          -- size of surface
+        """
+        document = deepcopy(render.document)
+        root = document.getroot()
+        for id in render.scroll_boxes:
+            if not self.scroll_state[id].vertical:
+                element = self.get_element(id, root)
+                if element is not None:
+                    element.getparent().remove(element)
+        scroll_text_boxes = list(render.scroll_boxes.values())
+        text_boxes = [ t for t in render.text_boxes if not t in scroll_text_boxes ]
+        return self._rasterize(canvas, Render(document, render.properties, text_boxes,
+                                              render.attributes, render.processing_result), size)
+    
+    def _render_horizontal_strip(self, canvas, render, id, text_box, scroll_item):
+        """
+        Render a horizontally scrolling text element on its own, unclipped
+        and at its original position. The strip is wide enough to cover the
+        clip bounds at either end of the scroll range.
+        
+        Keyword arguments:
+        canvas        -- canvas the strip will be painted on
+        render        -- render containing the text element
+        id            -- ID of text element
+        text_box      -- text box describing the text element
+        scroll_item   -- scroll state of the text element
+        """
+        document = deepcopy(render.document)
+        element = self.get_element(id, document.getroot())
+        
+        # Only keep the text element itself, the elements it is contained in and definitions
+        child = element
+        parent = element.getparent()
+        while parent is not None:
+            for sibling in list(parent):
+                if sibling is not child and sibling.tag != "{%s}defs" % self.nsmap["svg"]:
+                    parent.remove(sibling)
+            child = parent
+            parent = parent.getparent()
+        del element.attrib["clip-path"]
+        x = str(int(scroll_item.original))
+        for e in element.iter():
+            if e.get("x") is not None:
+                e.set("x", x)
+        
+        clip = text_box.clip
+        left = int(math.floor(clip[0] - scroll_item.range[1])) - 1
+        top = int(math.floor(clip[1])) - 1
+        right = int(math.ceil(clip[0] + clip[2] - scroll_item.range[0])) + 1
+        bottom = int(math.ceil(clip[1] + clip[3])) + 1
+        surface = self._rasterize(canvas, Render(document, render.properties, [], render.attributes, None),
+                                  ( right - left, bottom - top ), ( left, top ) )
+        return TextStrip(surface, left, top, clip)
+    
+    def _render_vertical_strip(self, canvas, text_box, scroll_item):
+        """
+        Render a vertically scrolling text box in full, from its first line to
+        its last.
+        
+        Keyword arguments:
+        canvas        -- canvas the strip will be painted on
+        text_box      -- text box to render
+        scroll_item   -- scroll state of the text box
+        """
+        clip = text_box.clip
+        strip_box = copy(text_box)
+        strip_box.base = 0
+        strip_box.clip = ( clip[0], clip[1], clip[2], max(clip[3], text_box.bounds[3]) )
+        
+        left = int(math.floor(min(clip[0], text_box.bounds[0]))) - 2
+        top = int(math.floor(min(clip[1], text_box.bounds[1]))) - 2
+        right = int(math.ceil(clip[0] + clip[2])) + 2
+        bottom = int(math.ceil(max(strip_box.clip[1] + strip_box.clip[3], text_box.bounds[1] + text_box.bounds[3]))) + 2
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, right - left, bottom - top)
+        context = cairo.Context(surface)
+        context.set_antialias(canvas.get_antialias())
+        context.set_font_options(canvas.get_font_options())
+        context.translate(-left, -top)
+        rgb = self.screen.driver.get_color_as_ratios(g15driver.HINT_FOREGROUND, ( 0, 0, 0 ))
+        bg_rgb = self.screen.driver.get_color_as_ratios(g15driver.HINT_BACKGROUND, ( 255, 255, 255 ))
+        self.text.set_canvas(context)
+        try:
+            self._render_text_box(context, strip_box, rgb, bg_rgb)
+        finally:
+            self.text.set_canvas(canvas)
+        
+        # Pango clips the text to one pixel outside of the clip bounds
+        return TextStrip(surface, left, top, ( clip[0] - 1, clip[1] - 1, clip[2] + 2, clip[3] + 2 ))
+    
+    def _rasterize(self, canvas, render, size, origin = ( 0, 0 )):
+        """
+        Render the document to a new surface with the same antialiasing and
+        font options as the canvas it will eventually be painted on.
+        
+        Keyword arguments:
+        canvas        -- canvas the surface will be painted on
+        render        -- render to draw
+        size          -- size of surface
+        origin        -- position in the theme of the surface's top left corner
+        """
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
+        context = cairo.Context(surface)
+        context.set_antialias(canvas.get_antialias())
+        context.set_font_options(canvas.get_font_options())
+        context.translate(-origin[0], -origin[1])
+        self.text.set_canvas(context)
+        try:
+            self._render_document(context, render)
+        finally:
+            self.text.set_canvas(canvas)
+        return surface
+    
+    def _paint_surface(self, canvas, surface):
+        canvas.save()
+        canvas.set_source_surface(surface, 0, 0)
+        canvas.paint()
+        canvas.restore()
+    
     def _process_components(self, root):
         """
         Find all elements that are associated with child components in the component this
@@ -1789,7 +2656,11 @@ class G15Theme(object):
                     c_class = c.get("class")
                     if c_class and "hidden-root" in c_class:
                         c.getparent().remove(c)
-                    self.component.child_map[component_id].draw(self, c)
+                    child = self.component.child_map[component_id]
+                    if type(child).draw is not Component.draw:
+                        # The component may change the geometry of its element
+                        self.compiled.geometry.invalidate(c)
+                    child.draw(self, c)
                 else:
                     logger.warning("Cannot find SVG element for component %s", component_id)
     
@@ -1834,6 +2705,7 @@ class G15Theme(object):
                     value = float(properties[property_key])
                     if value == 0:
                         value = 0.1
+                    self.compiled.geometry.invalidate(element)
                     element.set("width", str(int((bounds[2] / 100.0) * value)))
                 else:
                     logger.warning("Found progress element with an ID that doesn't exist in " + \
@@ -1913,16 +2785,24 @@ class G15Theme(object):
             root_styles["fill"] = fg_h
             root.set("style", self.format_styles(root_styles))
     
-    def _handle_text_boxes(self, root, text_boxes, properties, canvas):
+    def _handle_text_boxes(self, root, clipped_text, text_boxes, scroll_boxes, properties, canvas):
         
         # Look for text elements that have a clip path. If the rendered text is wider than
         # the clip path, then this element may be scrolled. This clipped text can also
         # be used to wrap and scroll vertical text, replacing the old 'text box' mechanism
         
-        for element in root.xpath('//svg:text[@clip-path]',namespaces=self.nsmap):
+        geometry = self.compiled.geometry
+        for element, clip_path_rect_node in clipped_text:
+            if not g15svg.is_attached(element, root):
+                # Deleted by a property
+                continue
             id = element.get("id")
-            clip_path_node = self._get_clip_path_element(element)
             vertical_wrap = "vertical-wrap" == element.get("title")
+            if clip_path_rect_node is None or not g15svg.is_attached(clip_path_rect_node, root):
+                clip_path_node = self._get_clip_path_element(element)
+                clip_path_rect_node = None
+            else:
+                clip_path_node = clip_path_rect_node.getparent()
             if clip_path_node is not None:
                 
                 t_span_node = self.get_element_by_tag("tspan", root = element)
@@ -1934,11 +2814,12 @@ class G15Theme(object):
                 if not t_span_text:
                     raise Exception("Text node had clip path, but no text/tspan->text could be found")
                 
-                clip_path_rect_node = self.get_element_by_tag("rect", clip_path_node)
+                if clip_path_rect_node is None:
+                    clip_path_rect_node = self.get_element_by_tag("rect", clip_path_node)
                 if clip_path_rect_node is None:
                     raise Exception("No svg:rect for clip %s" % str(clip_path_node))
-                clip_path_bounds = g15svg.get_actual_bounds(clip_path_rect_node, element)
-                text_bounds = g15svg.get_actual_bounds(element)
+                clip_path_bounds = geometry.get_actual_bounds(clip_path_rect_node, element)
+                text_bounds = geometry.get_actual_bounds(element)
                 
                 text_box = TextBox()            
                 text_box.text = Template(t_span_text).safe_substitute(properties) 
@@ -1956,7 +2837,7 @@ class G15Theme(object):
 #                text_width, text_height = self._get_actual_size(element, text_width, text_height)
                 text_box.bounds = ( text_bounds[0], text_bounds[1], text_width, text_height )
 
-                self._scroll_text_boxes(vertical_wrap, text_box, text_boxes, t_span_node, element)
+                self._scroll_text_boxes(vertical_wrap, text_box, text_boxes, scroll_boxes, t_span_node, element)
 
         # Find all of the  text boxes. This is a hack to get around rsvg not supporting
         # flowText completely. The SVG must contain two elements. The first must have
@@ -1977,14 +2858,14 @@ class G15Theme(object):
                 text_box.css = styles
                 text_box.wrap = True
                 text_boxes.append(text_box)
-                text_box.bounds = g15svg.get_actual_bounds(element)
+                text_box.bounds = geometry.get_actual_bounds(element)
                 text_box.clip = text_box.bounds
                 
                 # Remove the textnod SVG element
                 text_node.getparent().remove(text_node)
                 element.getparent().remove(element)
                 
-    def _scroll_text_boxes(self, vertical_wrap, text_box, text_boxes, t_span_node, element):        
+    def _scroll_text_boxes(self, vertical_wrap, text_box, text_boxes, scroll_boxes, t_span_node, element):        
         id = element.get("id")
         text_height = text_box.bounds[3]
         text_width =  text_box.bounds[2]
@@ -2000,12 +2881,12 @@ class G15Theme(object):
                     text_box.base = scroll_item.val
                 else:
                     scroll_item = VerticalWrapScrollState(text_box)
-                    scroll_item.vertical = True
                     self.scroll_state[id] = scroll_item
                     diff = text_height - clip_path_bounds[3]
                     scroll_item.range = ( 0, diff)
                 scroll_item.step = self.screen.service.scroll_amount                               
                 scroll_item.transform_elements()
+                scroll_boxes[id] = text_box
             elif id in self.scroll_state:
                 del self.scroll_state[id]
                 
@@ -2041,6 +2922,7 @@ class G15Theme(object):
                 scroll_item.step = self.screen.service.scroll_amount
                 scroll_item.other_elements = [t_span_node]
                 scroll_item.transform_elements()
+                scroll_boxes[id] = text_box
             elif id in self.scroll_state:
                 del self.scroll_state[id]      
 #            element.getparent().remove(element)
@@ -2056,6 +2938,7 @@ class G15Theme(object):
     
     def _component_removed(self):
         self.scroll_state = {}
+        self.strip_cache = {}
         self._set_component(None)
     
     def _page_visibility_changed(self):
@@ -2073,22 +2956,29 @@ class G15Theme(object):
         # use safe_substiture later on
         t = Template(xml.decode())
         xml = t.safe_substitute(encoded_properties)       
-        svg = rsvg.Handle()
-        try :
-            # write function needs bytes instead of string
-            svg.write(xml.encode())
-            if DEBUG_SVG:
-                print("------------------------------------------------------")
-                print(xml)
-                print("------------------------------------------------------")
-        except Exception as e:
-            logger.debug("Could not write SVG", exc_info = e)
-        try :
-            svg.close()
-        except Exception as e:
-            logger.debug("Could not close SVG", exc_info = e)
         
-        svg.render_cairo(canvas)
+        # Only parse the SVG again if the text has changed
+        svg = self.svg_handle
+        if svg is None or xml != self.svg_text_cache:
+            svg = rsvg.Handle()
+            try :
+                # write function needs bytes instead of string
+                svg.write(xml.encode())
+                if DEBUG_SVG:
+                    print("------------------------------------------------------")
+                    print(xml)
+                    print("------------------------------------------------------")
+            except Exception as e:
+                logger.debug("Could not write SVG", exc_info = e)
+            try :
+                svg.close()
+            except Exception as e:
+                logger.debug("Could not close SVG", exc_info = e)
+            self.svg_handle = svg
+            self.svg_text_cache = xml
+        
+        with self.screen.metrics.timer(g15metrics.STAGE_RSVG):
+            svg.render_cairo(canvas)
          
         if len(render.text_boxes) > 0:
             rgb = self.screen.driver.get_color_as_ratios(g15driver.HINT_FOREGROUND, ( 0, 0, 0 ))
@@ -284,16 +284,62 @@ def emit(target, code, value, syn=True):
     value          --    uinput value
     syn            --    emit SYN (defaults to True)
     """
+    code, value = _translate(target, code, value)
+    locks[target].acquire()
+    try:
+        uinput_devices[target].emit( code, value, syn)
+    finally:
+        locks[target].release()
+        
+def emit_all(events, syn=True):
+    """
+    Emit a batch of input events. All events are translated first, then the
+    events for each target device are written under a single acquisition of
+    that device's lock, followed by at most one SYN per device. Events for
+    the same device are written in the order they were supplied.
+    
+    Keyword arguments:
+    events         --    iterable of (target, code, value) tuples, where each
+                         element has the same meaning as for emit()
+    syn            --    emit a single SYN per device after the batch 
+                         (defaults to True)
+    """
+    batches = {}
+    order = []
+    for target, code, value in events:
+        translated = _translate(target, code, value)
+        batch = batches.get(target)
+        if batch is None:
+            batch = batches[target] = []
+            order.append(target)
+        batch.append(translated)
+        
+    for target in order:
+        device = uinput_devices[target]
+        locks[target].acquire()
+        try:
+            for code, value in batches[target]:
+                device.emit(code, value, False)
+            if syn:
+                device.syn()
+        finally:
+            locks[target].release()
+    
+def _translate(target, code, value):
+    """
+    Validate the target and translate a code (and possibly its value) into
+    the real uinput event type and code. Returns a tuple of (code, value).
+    
+    Keyword arguments:
+    target         --    The target device type (MOUSE, KEYBOARD or JOYSTICK)
+    code           --    uinput code (single code or (type, code) tuple)
+    value          --    uinput value
+    """
     if not target in DEVICE_TYPES:
         raise Exception("Invalid target. '%s' must be one of %s" % (target, str(DEVICE_TYPES)))
     
     if not isinstance(code, tuple):
         if target == MOUSE and code in [ uinput.REL_X[1], uinput.REL_Y[1] ]:
-            logger.debug("UINPUT mouse event at %s, code = %s, val = %d, syn = %s",
-                         target,
-                         code,
-                         value,
-                         str(syn))
             code = ( EV_REL, code )            
         elif ( target == JOYSTICK or target == DIGITAL_JOYSTICK ):
             """ We translate the 'virtual' uinput codes into real uinput ones """
@@ -312,24 +358,15 @@ def emit(target, code, value, syn=True):
             else:
                 """ If we are simulating a bouton press, then the event is of type EV_KEY """
                 code = (EV_KEY, code)
-            logger.debug("UINPUT joystick event at %s, code = %s, val = %d, syn = %s",
-                         target,
-                         code,
-                         value,
-                         str(syn))
         else: 
             code = ( EV_KEY, code )
-            logger.debug("UINPUT uinput keyboard event at %s, code = %s, val = %d, syn = %s",
-                         target,
-                         code,
-                         value,
-                         str(syn))
-    
-    locks[target].acquire()
-    try:
-        uinput_devices[target].emit( code, value, syn)
-    finally:
-        locks[target].release()
+            
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("UINPUT event at %s, code = %s, val = %d",
+                     target,
+                     code,
+                     value)
+    return code, value
     
 def __get_keys(prefix, exclude = None):
     l = []
@@ -394,9 +431,8 @@ def __check_devices():
             if device_type == JOYSTICK or device_type == DIGITAL_JOYSTICK:
                 syn(device_type)
                 load_calibration(device_type)
-                emit(device_type, ABS_X, JOYSTICK_CENTER, False)
-                emit(device_type, ABS_Y, JOYSTICK_CENTER, False)
-                syn(device_type)
+                emit_all([ (device_type, ABS_X, JOYSTICK_CENTER),
+                           (device_type, ABS_Y, JOYSTICK_CENTER) ])
             else:
                 emit(device_type, 0, 0)
                 emit(device_type, 0, 1)
@@ -0,0 +1,379 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Frame encoders that convert a complete cairo surface into the raw format
+expected by a device in one pass. NumPy is used when it is available,
+otherwise a slower pure Python implementation is used.
+
+Encoders keep their output buffer between frames, so the value returned by
+encode() is only valid until the next call.
+'''
+
+import array
+import sys
+import time
+import cairo
+from gnome15.util import g15metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError as e:
+    logger.debug("NumPy not available, frame encoding will be slow", exc_info = e)
+    numpy = None
+
+def _channel_table(bits, shift):
+    # Same rounding as g15convert.rgb_to_uint16, so output is identical
+    # to the per-pixel conversion this replaces
+    top = ( 1 << bits ) - 1
+    return [ min(top, ( v * ( 1 << bits ) ) // 255) << shift for v in range(256) ]
+
+RED_565 = _channel_table(5, 11)
+GREEN_565 = _channel_table(6, 5)
+BLUE_565 = _channel_table(5, 0)
+
+# ITU-R 601-2 luma weights in 16.16 fixed point (as used by PIL's 'L' conversion)
+RED_LUMA = [ v * 19595 for v in range(256) ]
+GREEN_LUMA = [ v * 38470 for v in range(256) ]
+BLUE_LUMA = [ v * 7471 + 0x8000 for v in range(256) ]
+
+def has_numpy():
+    """
+    Get if the fast (NumPy) encoders are available.
+    """
+    return numpy is not None
+
+class AbstractEncoder(object):
+    """
+    Base of all frame encoders. Takes care of getting at the ARGB32 pixel data
+    of a surface, copying it to a scratch surface if it is in any other format.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self._scratch = None
+
+    def encode(self, surface):
+        """
+        Encode the surface, returning a buffer that may be written directly to the
+        device. The buffer is re-used, so is only valid until the next call.
+
+        Keyword arguments:
+        surface        -- cairo image surface
+        """
+        surface = self._get_argb_surface(surface)
+        surface.flush()
+        return self.encode_buffer(surface.get_data(), surface.get_stride())
+
+    def encode_buffer(self, data, stride):
+        """
+        Encode raw native-endian ARGB32 pixel data (i.e. the same layout as a
+        cairo ARGB32 surface).
+
+        Keyword arguments:
+        data           -- buffer of pixel data
+        stride         -- number of bytes per row
+        """
+        raise NotImplementedError()
+
+    def _get_argb_surface(self, surface):
+        if surface.get_format() in [ cairo.FORMAT_ARGB32, cairo.FORMAT_RGB24 ] and \
+                surface.get_width() == self.width and surface.get_height() == self.height:
+            return surface
+        if self._scratch is None:
+            self._scratch = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        ctx = cairo.Context(self._scratch)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.set_source_surface(surface, 0, 0)
+        ctx.paint()
+        return self._scratch
+
+    def _pixels(self, data, stride):
+        """
+        Get a (height, width) NumPy view of native-endian 32 bit pixels
+        """
+        return numpy.frombuffer(data, dtype=numpy.uint32,
+                                count = self.height * ( stride // 4 )).reshape(self.height, stride // 4)[:, :self.width]
+
+class RGB565Encoder(AbstractEncoder):
+    """
+    Converts ARGB32 to little-endian 16 bit highcolor (5-6-5). If transpose is
+    True, the output is column major (as the G19 expects when talking to it
+    directly over USB), otherwise it is row major (as the kernel framebuffer
+    expects).
+    """
+
+    def __init__(self, width, height, transpose = False):
+        AbstractEncoder.__init__(self, width, height)
+        self.transpose = transpose
+        if numpy is not None:
+            shape = ( width, height ) if transpose else ( height, width )
+            self._red = numpy.array(RED_565, dtype='<u2')
+            self._green = numpy.array(GREEN_565, dtype='<u2')
+            self._blue = numpy.array(BLUE_565, dtype='<u2')
+            self._channel = numpy.empty(shape, dtype=numpy.uint32)
+            self._component = numpy.empty(shape, dtype='<u2')
+            self._out = numpy.empty(shape, dtype='<u2')
+            self._view = memoryview(self._out.reshape(-1).view(numpy.uint8))
+        else:
+            self._out = array.array('H', [0] * ( width * height ))
+
+    def encode_buffer(self, data, stride):
+        if numpy is None:
+            return self._encode_python(data, stride)
+        px = self._pixels(data, stride)
+        if self.transpose:
+            px = px.T
+        ch = self._channel
+        comp = self._component
+        out = self._out
+
+        numpy.right_shift(px, 16, out=ch)
+        numpy.bitwise_and(ch, 0xff, out=ch)
+        numpy.take(self._red, ch, out=out)
+
+        numpy.right_shift(px, 8, out=ch)
+        numpy.bitwise_and(ch, 0xff, out=ch)
+        numpy.take(self._green, ch, out=comp)
+        numpy.bitwise_or(out, comp, out=out)
+
+        numpy.bitwise_and(px, 0xff, out=ch)
+        numpy.take(self._blue, ch, out=comp)
+        numpy.bitwise_or(out, comp, out=out)
+        return self._view
+
+    def _encode_python(self, data, stride):
+        data = memoryview(data).cast('B')
+        red, green, blue = RED_565, GREEN_565, BLUE_565
+        out = self._out
+        width, height = self.width, self.height
+        if sys.byteorder == "little":
+            b_off, g_off, r_off = 0, 1, 2
+        else:
+            b_off, g_off, r_off = 3, 2, 1
+        for y in range(height):
+            row = y * stride
+            for x in range(width):
+                i = row + x * 4
+                v = red[data[i + r_off]] | green[data[i + g_off]] | blue[data[i + b_off]]
+                if self.transpose:
+                    out[x * height + y] = v
+                else:
+                    out[y * width + x] = v
+        if sys.byteorder == "little":
+            return memoryview(out).cast('B')
+        swapped = array.array('H', out)
+        swapped.byteswap()
+        return memoryview(swapped).cast('B')
+
+class MonoPacker(AbstractEncoder):
+    """
+    Thresholds ARGB32 to 1 bit per pixel and packs the bits. A pixel is set when
+    its luminance is at least threshold, or when it is below threshold if invert
+    is True.
+
+    Bits are packed row major. msb_first selects the bit order within each byte
+    (libg15 wants the most significant bit first, the kernel framebuffer the least
+    significant bit first). line_length is the number of bytes per output row, it
+    defaults to the smallest number that fits a row.
+    """
+
+    def __init__(self, width, height, threshold = 170, invert = False, msb_first = True, line_length = None):
+        AbstractEncoder.__init__(self, width, height)
+        self.threshold = threshold
+        self.invert = invert
+        self.msb_first = msb_first
+        self.row_bytes = ( width + 7 ) // 8
+        self.line_length = line_length if line_length is not None else self.row_bytes
+        self._out = bytearray(self.line_length * height)
+        self._view = memoryview(self._out)
+        if numpy is not None:
+            self._red = numpy.array(RED_LUMA, dtype=numpy.uint32)
+            self._green = numpy.array(GREEN_LUMA, dtype=numpy.uint32)
+            self._blue = numpy.array(BLUE_LUMA, dtype=numpy.uint32)
+            self._channel = numpy.empty((height, width), dtype=numpy.uint32)
+            self._component = numpy.empty((height, width), dtype=numpy.uint32)
+            self._luma = numpy.empty((height, width), dtype=numpy.uint32)
+            self._bits = numpy.empty((height, width), dtype=numpy.bool_)
+            self._rows = numpy.frombuffer(self._out, dtype=numpy.uint8).reshape(height, self.line_length)
+
+    def encode_buffer(self, data, stride):
+        if numpy is None:
+            return self._encode_python(data, stride)
+        px = self._pixels(data, stride)
+        ch = self._channel
+        comp = self._component
+        luma = self._luma
+
+        numpy.right_shift(px, 16, out=ch)
+        numpy.bitwise_and(ch, 0xff, out=ch)
+        numpy.take(self._red, ch, out=luma)
+
+        numpy.right_shift(px, 8, out=ch)
+        numpy.bitwise_and(ch, 0xff, out=ch)
+        numpy.take(self._green, ch, out=comp)
+        numpy.add(luma, comp, out=luma)
+
+        numpy.bitwise_and(px, 0xff, out=ch)
+        numpy.take(self._blue, ch, out=comp)
+        numpy.add(luma, comp, out=luma)
+
+        # Luma is 16.16 fixed point, so compare against the shifted threshold
+        # rather than shifting every pixel
+        if self.invert:
+            numpy.less(luma, self.threshold << 16, out=self._bits)
+        else:
+            numpy.greater_equal(luma, self.threshold << 16, out=self._bits)
+        self._rows[:, :self.row_bytes] = numpy.packbits(self._bits, axis=1,
+                                                        bitorder="big" if self.msb_first else "little")
+        return self._view
+
+    def _encode_python(self, data, stride):
+        data = memoryview(data).cast('B')
+        red, green, blue = RED_LUMA, GREEN_LUMA, BLUE_LUMA
+        out = self._out
+        threshold = self.threshold << 16
+        invert = self.invert
+        if sys.byteorder == "little":
+            b_off, g_off, r_off = 0, 1, 2
+        else:
+            b_off, g_off, r_off = 3, 2, 1
+        for y in range(self.height):
+            row = y * stride
+            out_row = y * self.line_length
+            v = 0
+            for x in range(self.width):
+                i = row + x * 4
+                lit = ( red[data[i + r_off]] + green[data[i + g_off]] + blue[data[i + b_off]] ) >= threshold
+                if lit != invert:
+                    v |= ( 0x80 >> ( x & 7 ) ) if self.msb_first else ( 1 << ( x & 7 ) )
+                if x & 7 == 7 or x == self.width - 1:
+                    out[out_row + ( x >> 3 )] = v
+                    v = 0
+        return self._view
+
+class FrameDiff(object):
+    """
+    Compares each composed frame with the previous one, so identical frames
+    need never be sent to the device, and drivers that can do so may write
+    only the rows that have changed.
+
+    bytes_per_row is the size of one row in the device's own format, and is
+    used to count how many bytes were not sent. The counts are kept in a
+    g15metrics.Metrics, so a screen can pass its own metrics and have them
+    outlive the FrameDiff (which is recreated every time the driver connects).
+    """
+
+    def __init__(self, height, bytes_per_row, metrics = None):
+        self.height = height
+        self.bytes_per_row = bytes_per_row
+        self.metrics = metrics if metrics is not None else g15metrics.Metrics("frame-diff")
+        self._previous = None
+
+    def reset(self):
+        """
+        Forget the previous frame, so the next one is sent in full. Should be
+        called whenever something other than the screen writes to the device.
+        """
+        self._previous = None
+
+    def diff(self, surface):
+        """
+        Compare the surface with the previous frame. Returns None if the frame
+        is identical, otherwise a list of ( y, height ) tuples for the spans of
+        rows that have changed.
+
+        Keyword arguments:
+        surface        -- cairo image surface
+        """
+        surface.flush()
+        stride = surface.get_stride()
+        current = bytes(surface.get_data())
+        previous = self._previous
+        self._previous = current
+        if previous is None or len(previous) != len(current):
+            self.metrics.count(g15metrics.COUNTER_FRAMES_SENT)
+            return [ ( 0, self.height ) ]
+        if current == previous:
+            self.metrics.count(g15metrics.COUNTER_FRAMES_SKIPPED)
+            self.metrics.count(g15metrics.COUNTER_BYTES_SAVED, self.bytes_per_row * self.height)
+            return None
+
+        damage = []
+        start = None
+        for y in range(self.height):
+            offset = y * stride
+            if current[offset:offset + stride] != previous[offset:offset + stride]:
+                if start is None:
+                    start = y
+            elif start is not None:
+                damage.append(( start, y - start ))
+                start = None
+        if start is not None:
+            damage.append(( start, self.height - start ))
+        self.metrics.count(g15metrics.COUNTER_FRAMES_SENT)
+        return damage
+
+    def damage_written(self, damage):
+        """
+        Record that only the damaged rows of a frame were written to the device.
+
+        Keyword arguments:
+        damage         -- list of ( y, height ) tuples returned by diff()
+        """
+        self.metrics.count(g15metrics.COUNTER_BYTES_SAVED, self.bytes_per_row * ( self.height - sum(h for _, h in damage) ))
+
+    def get_stats(self):
+        """
+        Get a dictionary of the counters
+        """
+        return { "frames_sent" : self.metrics.get_counter(g15metrics.COUNTER_FRAMES_SENT),
+                 "frames_skipped" : self.metrics.get_counter(g15metrics.COUNTER_FRAMES_SKIPPED),
+                 "bytes_saved" : self.metrics.get_counter(g15metrics.COUNTER_BYTES_SAVED) }
+
+def benchmark(encoder, frames = 100):
+    """
+    Encode a number of frames with the given encoder, and return the achieved
+    frames per second.
+
+    Keyword arguments:
+    encoder        -- encoder
+    frames         -- number of frames to encode
+    """
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, encoder.width, encoder.height)
+    ctx = cairo.Context(surface)
+    gradient = cairo.LinearGradient(0, 0, encoder.width, encoder.height)
+    gradient.add_color_stop_rgb(0, 1, 0, 0)
+    gradient.add_color_stop_rgb(0.5, 0, 1, 0)
+    gradient.add_color_stop_rgb(1, 0, 0, 1)
+    ctx.set_source(gradient)
+    ctx.paint()
+    started = time.time()
+    for _ in range(frames):
+        encoder.encode(surface)
+    taken = time.time() - started
+    return frames / taken if taken > 0 else float("inf")
+
+if __name__ == "__main__":
+    print("NumPy available: %s" % has_numpy())
+    for label, enc in [ ( "G19 RGB565 (row major)", RGB565Encoder(320, 240) ),
+                        ( "G19 RGB565 (column major)", RGB565Encoder(320, 240, transpose = True) ),
+                        ( "G15 1bpp", MonoPacker(160, 43) ) ]:
+        print("%-30s %8.1f fps" % ( label, benchmark(enc, 100 if has_numpy() else 5) ))
@@ -0,0 +1,344 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collects timings of the various stages of producing and sending a frame, and
+of other periodic work such as plugin refreshes. Samples go into rolling
+histograms, so the statistics reflect the last minute or so rather than the
+whole life of the service. Simple counters (such as the number of frames that
+did not need to be sent) are also kept, and run until the metrics are reset.
+"""
+
+import bisect
+import time
+import threading
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+# Stages recorded for each screen
+STAGE_FRAME="frame"
+STAGE_PAGE="page"
+STAGE_THEME="theme"
+STAGE_RSVG="rsvg"
+STAGE_PAINTERS="painters"
+STAGE_ENCODE="encode"
+STAGE_WRITE="write"
+STAGE_KEY_DIRECT="key-direct"
+STAGE_KEY_QUEUED="key-queued"
+STAGE_PLUGIN_PREFIX="plugin:"
+
+# Counters kept for each screen
+COUNTER_FRAMES_SENT="frames-sent"
+COUNTER_FRAMES_SKIPPED="frames-skipped"
+COUNTER_BYTES_SAVED="bytes-saved"
+
+# Rolling histograms are made up of this many slices, each covering SLICE_SECONDS
+SLICES=6
+SLICE_SECONDS=10.0
+
+class Histogram():
+    """
+    Counts samples (in seconds) into a fixed set of millisecond buckets, so
+    percentiles can be estimated cheaply without keeping every sample.
+    """
+    
+    BUCKETS = [ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000 ]
+    
+    def __init__(self):
+        self.reset()
+        
+    def reset(self):
+        self.counts = [ 0 ] * ( len(self.BUCKETS) + 1 )
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        
+    def record(self, value):
+        """
+        Record a sample
+        
+        Keyword arguments:
+        value        -- time in seconds
+        """
+        ms = value * 1000.0
+        self.counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+            
+    def merge(self, other):
+        """
+        Add the samples of another histogram to this one
+        
+        Keyword arguments:
+        other        -- histogram to merge
+        """
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+            
+    def percentile(self, pc):
+        """
+        Get the upper bound of the bucket the given percentile falls in (in
+        milliseconds). The largest sample is returned for the overflow bucket.
+        
+        Keyword arguments:
+        pc        -- percentile (0-100)
+        """
+        if self.count == 0:
+            return 0.0
+        target = self.count * pc / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c > 0:
+                return float(self.BUCKETS[i]) if i < len(self.BUCKETS) else self.max
+        return self.max
+        
+    def get_stats(self):
+        return { "count" : self.count,
+                 "mean" : self.total / self.count if self.count > 0 else 0.0,
+                 "max" : self.max,
+                 "p50" : self.percentile(50),
+                 "p90" : self.percentile(90),
+                 "p99" : self.percentile(99),
+                 "buckets" : list(zip(self.BUCKETS + [ None ], self.counts)) }
+    
+    def __str__(self):
+        return "n=%d mean=%.1fms p50<=%.0fms p90<=%.0fms p99<=%.0fms max=%.1fms" % ( self.count,
+                    self.total / self.count if self.count > 0 else 0.0,
+                    self.percentile(50), self.percentile(90), self.percentile(99), self.max )
+    
+class RollingHistogram():
+    """
+    A histogram of only the recent samples. Samples are recorded into the
+    current time slice, and slices older than the window are discarded.
+    """
+    
+    def __init__(self, slices = SLICES, slice_seconds = SLICE_SECONDS):
+        self.slices = slices
+        self.slice_seconds = slice_seconds
+        self.reset()
+        
+    def reset(self):
+        self.histograms = []
+        self.total_count = 0
+        
+    def record(self, value):
+        self._current().record(value)
+        self.total_count += 1
+        
+    def get_histogram(self):
+        """
+        Get a single histogram of all the samples in the window
+        """
+        self._expire()
+        h = Histogram()
+        for __, s in self.histograms:
+            h.merge(s)
+        return h
+    
+    def get_stats(self):
+        stats = self.get_histogram().get_stats()
+        stats["total"] = self.total_count
+        return stats
+    
+    def __str__(self):
+        return str(self.get_histogram())
+        
+    def _current(self):
+        now_slice = int(time.time() / self.slice_seconds)
+        if len(self.histograms) == 0 or self.histograms[-1][0] != now_slice:
+            self.histograms.append(( now_slice, Histogram() ))
+            self._expire(now_slice)
+        return self.histograms[-1][1]
+    
+    def _expire(self, now_slice = None):
+        if now_slice is None:
+            now_slice = int(time.time() / self.slice_seconds)
+        while len(self.histograms) > 0 and self.histograms[0][0] <= now_slice - self.slices:
+            self.histograms.pop(0)
+    
+class Timer():
+    """
+    Times a block of code and records it against a stage when done. Use in a
+    with statement.
+    """
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        
+    def __enter__(self):
+        self.started = time.time()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.record(self.stage, time.time() - self.started)
+        return False
+    
+class Metrics():
+    """
+    A named group of rolling histograms, one per stage, and counters.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.enabled = True
+        
+    def record(self, stage, seconds):
+        """
+        Record how long a stage took
+        
+        Keyword arguments:
+        stage        -- stage name
+        seconds      -- time taken
+        """
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            h = self.stages.get(stage)
+            if h is None:
+                h = RollingHistogram()
+                self.stages[stage] = h
+            h.record(seconds)
+        finally:
+            self.lock.release()
+            
+    def count(self, counter, amount = 1):
+        """
+        Add to a counter
+        
+        Keyword arguments:
+        counter      -- counter name
+        amount       -- amount to add
+        """
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+        finally:
+            self.lock.release()
+            
+    def get_counter(self, counter):
+        self.lock.acquire()
+        try:
+            return self.counters.get(counter, 0)
+        finally:
+            self.lock.release()
+            
+    def get_counters(self):
+        """
+        Get a dictionary of all counter values keyed by counter name
+        """
+        self.lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self.lock.release()
+            
+    def timer(self, stage):
+        """
+        Get a Timer that records how long a block of code took against a stage.
+        
+        Keyword arguments:
+        stage        -- stage name
+        """
+        return Timer(self, stage)
+    
+    def get_stage_names(self):
+        self.lock.acquire()
+        try:
+            return sorted(self.stages.keys())
+        finally:
+            self.lock.release()
+    
+    def get_stats(self, stage = None):
+        """
+        Get the statistics for a single stage, or a dictionary of statistics for
+        all stages keyed by stage name. Times are in milliseconds.
+        
+        Keyword arguments:
+        stage        -- stage name or None for all stages
+        """
+        self.lock.acquire()
+        try:
+            if stage is not None:
+                h = self.stages.get(stage)
+                return h.get_stats() if h is not None else RollingHistogram().get_stats()
+            return dict((k, v.get_stats()) for k, v in self.stages.items())
+        finally:
+            self.lock.release()
+        
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.stages = {}
+            self.counters = {}
+        finally:
+            self.lock.release()
+            
+    def get_report(self):
+        """
+        Get a plain text summary of all stages and counters
+        """
+        lines = []
+        for stage, stats in sorted(self.get_stats().items()):
+            lines.append("%-20s n=%-5d mean %6.1fms p50 <= %4.0fms p90 <= %4.0fms p99 <= %4.0fms max %6.1fms" % \
+                         ( stage, stats["count"], stats["mean"], stats["p50"], stats["p90"], stats["p99"], stats["max"] ))
+        for counter, value in sorted(self.get_counters().items()):
+            lines.append("%-20s %d" % ( counter, value ))
+        return "\n".join(lines)
+    
+'''
+Registry of all metrics, usually one per device
+'''
+_registry = {}
+_registry_lock = threading.Lock()
+
+def get_metrics(name):
+    """
+    Get (creating if required) the metrics with the given name. Screens use the
+    device UID.
+    
+    Keyword arguments:
+    name        -- name of metrics
+    """
+    _registry_lock.acquire()
+    try:
+        m = _registry.get(name)
+        if m is None:
+            m = Metrics(name)
+            _registry[name] = m
+        return m
+    finally:
+        _registry_lock.release()
+        
+def get_all_metrics():
+    _registry_lock.acquire()
+    try:
+        return list(_registry.values())
+    finally:
+        _registry_lock.release()
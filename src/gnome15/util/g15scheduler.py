@@ -57,5 +57,11 @@ def stop_queue(queue_name):
 def queue(queue_name, job_name, interval, function, *args):
     return scheduler.queue(queue_name, job_name, interval, function, *args)
 
+def configure_queue(queue_name, number_of_workers = 1, max_size = 0, policy = jobqueue.POLICY_DROP_NEWEST, coalesce = False):
+    scheduler.configure_queue(queue_name, number_of_workers, max_size, policy, coalesce)
+
+def get_queue_stats():
+    return scheduler.get_stats()
+
 def stop_all_schedulers():
     scheduler.stop_all()
@@ -150,3 +150,142 @@ def get_bounds(element):
         h = float(v)
     return (x, y, w, h)
 
+
+def get_path(element):
+    """
+    Get the position of an element in its document as a tuple of child
+    indexes, starting at the root. The same element can then be found in a
+    copy of the document using find_path().
+
+    Keyword arguments:
+    element        --    element to get path of
+    """
+    path = []
+    parent = element.getparent()
+    while parent is not None:
+        path.append(parent.index(element))
+        element = parent
+        parent = element.getparent()
+    path.reverse()
+    return tuple(path)
+
+def find_path(root, path):
+    """
+    Get the element at a path returned by get_path().
+
+    Keyword arguments:
+    root        --    root of document
+    path        --    tuple of child indexes
+    """
+    element = root
+    for i in path:
+        element = element[i]
+    return element
+
+def is_attached(element, root):
+    """
+    Get if an element is still part of the document with the given root (i.e.
+    neither it nor any of its ancestors have been removed).
+
+    Keyword arguments:
+    element        --    element to test
+    root           --    root of document
+    """
+    while element is not None:
+        if element is root:
+            return True
+        element = element.getparent()
+    return False
+
+class GeometryIndex(object):
+    """
+    The cumulative transform and the bounds of every element in a document
+    that has a unique ID, computed in a single pass over the document. 
+    Lookups are by ID, so the index may be used with any copy of the document 
+    it was built from, as long as the geometry of the elements looked up has
+    not changed. Anything that moves or resizes elements in a copy must first
+    invalidate() them, which removes them from the index for good.
+
+    The results are the same as the module functions, i.e. only position
+    transforms are applied to the location, and the size is as specified on
+    the element.
+    """
+
+    def __init__(self, root):
+        """
+        Constructor
+
+        Keyword arguments:
+        root        --    root of document to index
+        """
+        self._entries = {}
+        duplicates = set()
+        stack = [ ( root, cairo.Matrix() ) ]
+        while len(stack) > 0:
+            element, parent_matrix = stack.pop()
+            matrix = _apply_transforms(parent_matrix, element)
+            id = element.get("id")
+            if id is not None:
+                if id in self._entries:
+                    duplicates.add(id)
+                else:
+                    self._entries[id] = ( matrix, get_bounds(element) )
+            for child in element:
+                if isinstance(child.tag, str):
+                    stack.append(( child, matrix ))
+
+        # An ID that is used more than once cannot be looked up reliably
+        for id in duplicates:
+            del self._entries[id]
+
+    def invalidate(self, element):
+        """
+        Remove an element and all of its children from the index. Their
+        geometry will be calculated from the document on every lookup.
+
+        Keyword arguments:
+        element        --    element that has been or is about to be changed
+        """
+        for e in element.iter():
+            id = e.get("id") if isinstance(e.tag, str) else None
+            if id is not None:
+                self._entries.pop(id, None)
+
+    def get_matrix(self, element):
+        """
+        Get the cumulative transform for an element, i.e. that of the element
+        itself and all of its ancestors. The returned matrix must not be
+        modified.
+
+        Keyword arguments:
+        element        --    element, or None for the identity matrix
+        """
+        if element is None:
+            return cairo.Matrix()
+        id = element.get("id")
+        if id is not None:
+            entry = self._entries.get(id)
+            if entry is not None:
+                return entry[0]
+        return _apply_transforms(self.get_matrix(element.getparent()), element)
+
+    def get_actual_bounds(self, element, relative_to = None):
+        """
+        Indexed equivalent of get_actual_bounds().
+
+        Keyword arguments:
+        element        --    element to get bounds of
+        relative_to    --    when element is a clip path, the clipped element
+        """
+        entry = self._entries.get(element.get("id"))
+        bounds = entry[1] if entry is not None else get_bounds(element)
+        matrix = self.get_matrix(relative_to.getparent() if relative_to is not None else element)
+        t = cairo.Matrix()
+        t.translate(bounds[0], bounds[1])
+        xx, yx, xy, yy, x0, y0 = matrix.multiply(t)
+        return x0, y0, bounds[2], bounds[3]
+
+def _apply_transforms(matrix, element):
+    for t in reversed(get_transforms(element, position_only = True)):
+        matrix = matrix.multiply(t)
+    return matrix
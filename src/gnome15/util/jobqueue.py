@@ -14,18 +14,36 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import queue
 import threading
 import traceback
-import sys
+import heapq
+import itertools
+from collections import deque
 from gi.repository import GObject
 import time
 from threading import RLock
 from threading import local
+from .g15metrics import RollingHistogram
 
 # Can be adjusted to speed up time to aid debugging.
 TIME_FACTOR=1
 
+# Record where each job was queued from, so it can be logged if the job fails.
+# This is expensive, so should only be enabled when debugging.
+CAPTURE_STACKS=False
+
+# What a bounded queue does with a new job when it is full
+POLICY_DROP_NEWEST="drop-newest"
+POLICY_DROP_OLDEST="drop-oldest"
+
+# Settings for queues that are created on demand. Anything not listed (including
+# the default queue, which carries one-off jobs with arguments) gets a single
+# worker, no limit and no coalescing. Only queues that just carry refreshes,
+# where the latest one is all that matters, should be listed here.
+QUEUE_DEFAULTS = {
+    "impulseQueue" : { "number_of_workers" : 1, "max_size" : 2, "policy" : POLICY_DROP_OLDEST, "coalesce" : True }
+}
+
 # Logging
 import logging
 logger = logging.getLogger(__name__)
@@ -49,7 +67,12 @@ def is_on_queue(queue_name):
         return True
     return False
 
-class GTimer:    
+class GTimer:
+    """
+    A job that will be run on a queue after an interval. Timers do not each have
+    their own GObject timeout, instead they are all held by the scheduler's
+    TimerHeap.
+    """
     def __init__(self, scheduler, task_queue, task_name, interval, function, stack, *args):
         self.function = function
         if function == None:
@@ -60,42 +83,102 @@ class GTimer:
         self.scheduler = scheduler
         self.task_queue = task_queue
         self.task_name = task_name
-        self.source = GObject.timeout_add(int(float(interval) * 1000.0 * TIME_FACTOR), self.exec_item, function, *args)
+        self.args = args
+        self.due = time.time() + float(interval) * TIME_FACTOR
         self.complete = False
-        self.scheduler.all_jobs.append(self)
+        self.scheduler.timers.add(self)
         
-    def exec_item(self, function, *args):
+    def exec_item(self):
         try:
             logger.debug("Executing GTimer %s", str(self.task_name))
-            ji = self.task_queue.run(self.stack, function, *args)
+            self.task_queue.run(self.stack, self.function, *self.args, name = self.task_name)
             logger.debug("Executed GTimer %s", str(self.task_name))
         finally:
-            self.scheduler.all_jobs_lock.acquire()
-            try:
-                if self in self.scheduler.all_jobs:
-                    self.scheduler.all_jobs.remove(self)
-                self.complete = True
-            finally:
-                self.scheduler.all_jobs_lock.release()
-                # Destroy the timeout, don't execute this function again.
-                return False
+            self.complete = True
         
     def is_complete(self):
         return self.complete
         
     def cancel(self, *args):
-        self.scheduler.all_jobs_lock.acquire()
-        try:
-            if self in self.scheduler.all_jobs:
-                self.scheduler.all_jobs.remove(self)
-            # Check if callback function was executed, if yes this means that the timeout
-            # was automatically destroyed since the callback function returns False.
-            # Avoid thousands of warnings from source_remove().
-            if not self.is_complete():
-                GObject.source_remove(self.source)
+        if self.function is not None:
+            self.scheduler.timers.remove(self)
             logger.debug("Cancelled GTimer %s", str(self.task_name))
+        
+class TimerHeap():
+    """
+    Holds all of the pending timers of a scheduler in a heap ordered by when they
+    are due. A single GObject timeout is used, for whichever timer is due first.
+    Cancelled timers are just forgotten, and are discarded when they reach the
+    top of the heap (or when they make up most of it).
+    """
+    
+    def __init__(self):
+        self.heap = []
+        self.pending = set()
+        self.lock = RLock()
+        self.sequence = itertools.count()
+        self.source = None
+        self.source_due = None
+        
+    def __iter__(self):
+        self.lock.acquire()
+        try:
+            return iter(sorted(self.pending, key = lambda timer: timer.due))
         finally:
-            self.scheduler.all_jobs_lock.release()
+            self.lock.release()
+            
+    def __len__(self):
+        return len(self.pending)
+        
+    def add(self, timer):
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.heap, ( timer.due, next(self.sequence), timer ))
+            self.pending.add(timer)
+            if self.source_due is None or timer.due < self.source_due:
+                self._arm(timer.due)
+        finally:
+            self.lock.release()
+            
+    def remove(self, timer):
+        self.lock.acquire()
+        try:
+            self.pending.discard(timer)
+            if len(self.heap) > 64 and len(self.heap) > len(self.pending) * 2:
+                self.heap = [ e for e in self.heap if e[2] in self.pending ]
+                heapq.heapify(self.heap)
+        finally:
+            self.lock.release()
+            
+    def _arm(self, due):
+        if self.source is not None:
+            GObject.source_remove(self.source)
+        self.source_due = due
+        self.source = GObject.timeout_add(max(0, int(( due - time.time() ) * 1000.0)), self._fire)
+            
+    def _fire(self):
+        due = []
+        self.lock.acquire()
+        try:
+            self.source = None
+            self.source_due = None
+            now = time.time()
+            while len(self.heap) > 0 and ( self.heap[0][0] <= now or not self.heap[0][2] in self.pending ):
+                timer = heapq.heappop(self.heap)[2]
+                if timer in self.pending:
+                    self.pending.discard(timer)
+                    due.append(timer)
+            if len(self.heap) > 0:
+                self._arm(self.heap[0][0])
+        finally:
+            self.lock.release()
+            
+        # Just puts the jobs on their queues, so is quick
+        for timer in due:
+            timer.exec_item()
+            
+        # Destroy the timeout, don't execute this function again.
+        return False
         
 '''
 Task scheduler. Tasks may be added to the queue to execute
@@ -107,13 +190,14 @@ class JobScheduler():
     
     def __init__(self):
         self.queues = {}
-        self.all_jobs = []
-        self.all_jobs_lock = RLock()
+        self.queues_lock = RLock()
+        self.queue_config = {}
+        self.timers = TimerHeap()
         
     def print_all_jobs(self):
         print("Scheduled")
         print("------")
-        for j in self.all_jobs:
+        for j in self.timers:
             print("    %s - %s" % ( j.task_name, str(j.function)))
         print()
         print("Running")
@@ -140,28 +224,63 @@ class JobScheduler():
     
     def execute(self, queue_name, name, function, *args):
         logger.debug("Executing on queue %s", queue_name)
-        if not queue_name in self.queues:
-            self.queues[queue_name] = JobQueue(name=queue_name)   
-        self.queues[queue_name].run(self._get_stack(), function, *args)        
+        self._get_queue(queue_name).run(self._get_stack(), function, *args, name = name)
+        
+    def configure_queue(self, queue_name, number_of_workers = 1, max_size = 0, policy = POLICY_DROP_NEWEST, coalesce = False):
+        """
+        Set how a queue should be created. This must be called before anything is
+        queued on it, settings for queues that already exist are ignored.
+        
+        Keyword arguments:
+        queue_name            -- queue name
+        number_of_workers     -- number of threads that take jobs from the queue
+        max_size              -- maximum number of waiting jobs, or 0 for no limit
+        policy                -- what to do when the queue is full, POLICY_DROP_NEWEST or POLICY_DROP_OLDEST
+        coalesce              -- replace waiting jobs with the same name and function rather than queueing another
+        """
+        if queue_name in self.queues:
+            logger.warning("Queue %s already exists, configuration ignored", queue_name)
+            return
+        self.queue_config[queue_name] = { "number_of_workers" : number_of_workers,
+                                          "max_size" : max_size,
+                                          "policy" : policy,
+                                          "coalesce" : coalesce }
+        
+    def get_stats(self):
+        """
+        Get the statistics of all queues, keyed by queue name. See JobQueue.get_stats().
+        """
+        return dict((queue_name, q.get_stats()) for queue_name, q in list(self.queues.items()))
+        
+    def _get_queue(self, queue_name):
+        q = self.queues.get(queue_name)
+        if q is None:
+            self.queues_lock.acquire()
+            try:
+                q = self.queues.get(queue_name)
+                if q is None:
+                    config = self.queue_config.get(queue_name, QUEUE_DEFAULTS.get(queue_name, {}))
+                    q = JobQueue(name = queue_name, **config)
+                    self.queues[queue_name] = q
+            finally:
+                self.queues_lock.release()
+        return q
         
     def _get_stack(self):
-        try: 1/0
-        except:
-            tb = sys.exc_info()[2]
-            return traceback.extract_stack()[:-5]
+        # Capturing the stack is expensive, so is only done when debugging
+        if CAPTURE_STACKS:
+            return traceback.extract_stack()[:-2]
     
     def queue(self, queue_name, name, interval, function, *args):
         if not hasattr(function, "__call__"):
             raise Exception("Not a function")
         logger.debug("Queueing %s on %s for execution in %f", name, queue_name, interval)
-        if not queue_name in self.queues:
-            self.queues[queue_name] = JobQueue(name=queue_name)
-        
+        q = self._get_queue(queue_name)
         if interval == 0:
             # Optimisation, if this is un-timed, avoid putting on main loop
-            self.queues[queue_name].run(self._get_stack(), function, *args)
+            q.run(self._get_stack(), function, *args, name = name)
         else:
-            timer = GTimer(self, self.queues[queue_name], name, interval, function, self._get_stack(), *args)
+            timer = GTimer(self, q, name, interval, function, self._get_stack(), *args)
             logger.debug("Queued %s", name)
             return timer
 
@@ -169,22 +288,46 @@ class JobScheduler():
 class JobQueue():
     
     class JobItem():
-        def __init__(self, stack, item, args = None):
+        def __init__(self, stack, item, args = None, key = None):
             self.args = args
             self.item = item
+            self.key = key
             self.queued = time.time()
             self.started = None
             self.finished = None
             self.stack = stack
         
-    def __init__(self,number_of_workers=1, name="JobQueue"):
+    def __init__(self,number_of_workers=1, name="JobQueue", max_size = 0, policy = POLICY_DROP_NEWEST, coalesce = False):
+        """
+        Constructor
+        
+        Keyword arguments:
+        number_of_workers    -- number of threads that take jobs from this queue
+        name                 -- queue name
+        max_size             -- maximum number of waiting jobs, or 0 for no limit
+        policy               -- what to do when the queue is full, POLICY_DROP_NEWEST or POLICY_DROP_OLDEST
+        coalesce             -- when a job with the same name and function is already waiting, replace its arguments rather than queueing another
+        """
         logger.debug("Creating job queue %s with %d workers", name, number_of_workers)
-        self.work_queue = queue.Queue()
-        self.queued_jobs = []
+        self.work_queue = deque()
+        self.pending = {}
+        self.running = set()
         self.name = name
         self.stopping = False
         self.all_jobs_lock = threading.Lock()
+        self.work_available = threading.Condition(self.all_jobs_lock)
+        self.max_size = max_size
+        self.policy = policy
+        self.coalesce = coalesce
         self.number_of_workers = number_of_workers
+        
+        self.queued = 0
+        self.executed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.wait_times = RollingHistogram()
+        self.run_times = RollingHistogram()
+        
         self.threads = []
         for __ in range(number_of_workers):
             t = threading.Thread(target = self.worker)
@@ -195,80 +338,176 @@ class JobQueue():
             
     def print_all_jobs(self):
         print("Queue %s" % self.name)
-        for s in self.queued_jobs:
+        self.all_jobs_lock.acquire()
+        try:
+            jobs = list(self.running) + list(self.work_queue)
+        finally:
+            self.all_jobs_lock.release()
+        for s in jobs:
             print("     %s - %s" % (str(s.item), str(s.queued)))
+        stats = self.get_stats()
+        print("     Workers: %d, Waiting: %d, Queued: %d, Executed: %d, Coalesced: %d, Dropped: %d" % \
+              ( stats["workers"], stats["depth"], stats["queued"], stats["executed"], stats["coalesced"], stats["dropped"] ))
+        print("     Wait: %s" % str(self.wait_times))
+        print("     Run: %s" % str(self.run_times))
+        
+    def get_stats(self):
+        """
+        Get statistics about this queue. Wait and run times are in milliseconds.
+        """
+        self.all_jobs_lock.acquire()
+        try:
+            return { "name" : self.name,
+                     "workers" : self.number_of_workers,
+                     "max_size" : self.max_size,
+                     "policy" : self.policy,
+                     "coalesce" : self.coalesce,
+                     "depth" : len(self.work_queue),
+                     "running" : len(self.running),
+                     "queued" : self.queued,
+                     "executed" : self.executed,
+                     "coalesced" : self.coalesced,
+                     "dropped" : self.dropped,
+                     "wait" : self.wait_times.get_stats(),
+                     "run" : self.run_times.get_stats() }
+        finally:
+            self.all_jobs_lock.release()
+            
+    def reset_stats(self):
+        self.all_jobs_lock.acquire()
+        try:
+            self.queued = 0
+            self.executed = 0
+            self.coalesced = 0
+            self.dropped = 0
+            self.wait_times.reset()
+            self.run_times.reset()
+        finally:
+            self.all_jobs_lock.release()
             
     def stop(self):
         logger.info("Stopping queue %s", self.name)
         self.stopping = True
         self.clear()
-        for i in range(0, self.number_of_workers):
-            self.work_queue.put(self.JobItem("Stopping", self._dummy))
+        self.all_jobs_lock.acquire()
+        try:
+            self.work_available.notify_all()
+        finally:
+            self.all_jobs_lock.release()
         logger.info("Stopped queue %s", self.name)
-        
-    def _dummy(self):
-        pass
             
     def clear(self):
-        jobs = self.work_queue.qsize()
-        if jobs > 0:
-            logger.info("Clearing queue %s as it has %d jobs", self.name, jobs)
-            try :
-                while True:
-                    item = self.work_queue.get_nowait()
-                    logger.debug("Removed func = %s, args = %s, queued = %s, " \
-                                 "started = %s, finished = %s",
+        self.all_jobs_lock.acquire()
+        try:
+            jobs = len(self.work_queue)
+            if jobs > 0:
+                logger.info("Clearing queue %s as it has %d jobs", self.name, jobs)
+                for item in self.work_queue:
+                    logger.debug("Removed func = %s, args = %s, queued = %s", 
                                  str(item.item),
                                  str(item.args),
-                                 str(item.queued),
-                                 str(item.started),
-                                 str(item.finished))
-                    if item in self.queued_jobs:
-                        self.queued_jobs.remove(item)
-            except queue.Empty as e:
-                logger.debug("The queue is already empty", exc_info = e)
-                pass
-            logger.info("Cleared queue %s", self.name)
+                                 str(item.queued))
+                self.work_queue.clear()
+                self.pending.clear()
+                logger.info("Cleared queue %s", self.name)
+        finally:
+            self.all_jobs_lock.release()
             
-    def run(self, stack, item, *args):
+    def run(self, stack, item, *args, **kwargs):
+        """
+        Queue a function to run on one of this queue's workers. None is returned
+        if the job was dropped.
+        
+        Keyword arguments:
+        stack        -- where the job was queued from (for debugging), or None
+        item         -- function to run
+        args         -- arguments to pass to the function
+        name         -- job name, used to coalesce jobs (keyword only)
+        """
         if self.stopping:
             return
         if item == None:
             logger.warning("Attempt to run empty job.")
             traceback.print_stack()
             return
+        key = ( kwargs["name"], item ) if self.coalesce and kwargs.get("name") is not None else None
         self.all_jobs_lock.acquire()
         try :
+            if key is not None and key in self.pending:
+                # Latest wins, the waiting job just gets the new arguments
+                ji = self.pending[key]
+                ji.args = args
+                ji.stack = stack
+                self.coalesced += 1
+                logger.debug("Coalesced task %s on %s", key[0], self.name)
+                return ji
+            
+            if self.max_size > 0 and len(self.work_queue) >= self.max_size:
+                self.dropped += 1
+                if self.policy == POLICY_DROP_OLDEST:
+                    dropped = self.work_queue.popleft()
+                    if dropped.key is not None:
+                        del self.pending[dropped.key]
+                    logger.warning("Queue %s is full (%d jobs), dropped oldest job %s", self.name, self.max_size, str(dropped.item))
+                else:
+                    logger.warning("Queue %s is full (%d jobs), dropped new job %s", self.name, self.max_size, str(item))
+                    return None
+            
             logger.debug("Queued task on %s", self.name)
-            ji = self.JobItem(stack, item, args)
-            self.queued_jobs.append(ji)
-            self.work_queue.put(ji)
-            jobs = self.work_queue.qsize()
+            ji = self.JobItem(stack, item, args, key)
+            self.work_queue.append(ji)
+            if key is not None:
+                self.pending[key] = ji
+            self.queued += 1
+            jobs = len(self.work_queue)
             if jobs > 1:
                 logger.debug("Queue %s filling, now at %d jobs.", self.name, jobs)
+            self.work_available.notify()
                 
         finally :
             self.all_jobs_lock.release()
         return ji
+    
+    def _next(self):
+        self.all_jobs_lock.acquire()
+        try:
+            while len(self.work_queue) == 0 and not self.stopping:
+                self.work_available.wait()
+            if self.stopping:
+                return None
+            item = self.work_queue.popleft()
+            if item.key is not None:
+                del self.pending[item.key]
+            item.started = time.time()
+            self.running.add(item)
+            self.wait_times.record(item.started - item.queued)
+            return item
+        finally:
+            self.all_jobs_lock.release()
             
     def worker(self):
         queue_names.queue_name = self.name
         while not self.stopping:
-            item = self.work_queue.get()
+            item = self._next()
+            if item is None:
+                break
             try:
-                if item != None:
+                try:
+                    logger.debug("Running task on %s", self.name)
+                    if item.args and len(item.args) > 0:
+                        item.item(*item.args)
+                    else:
+                        item.item()
+                    logger.debug("Ran task on %s", self.name)
+                finally:
+                    item.finished = time.time()
+                    self.all_jobs_lock.acquire()
                     try:
-                        logger.debug("Running task on %s", self.name)
-                        item.started = time.time()
-                        if item.args and len(item.args) > 0:
-                            item.item(*item.args)
-                        else:
-                            item.item()
-                        item.finished = time.time()
-                        logger.debug("Ran task on %s", self.name)
+                        self.running.discard(item)
+                        self.executed += 1
+                        self.run_times.record(item.finished - item.started)
                     finally:
-                        if item in self.queued_jobs: 
-                            self.queued_jobs.remove(item)
+                        self.all_jobs_lock.release()
             except Exception as a:
                 try:
                     logger.debug("Error on worker", exc_info = a)
@@ -277,11 +516,9 @@ class JobQueue():
                 except Exception as e:
                     logger.debug("Could not log error on worker", exc_info = e)
                     pass
-            self.work_queue.task_done()
             
         if logger:
             try:
                 logger.info("Exited queue %s", self.name)
             except Exception as e:
                 pass
- 
@@ -303,6 +303,19 @@ class G15DBUSDebugService(dbus.service.Object):
             for filename, lineno, name, line in traceback.extract_stack(stack):
                 print('    File: "%s", line %d, in %s' % (filename, lineno, name))
         
+    @dbus.service.method(DEBUG_IF_NAME)
+    def QueueStats(self):
+        print("Job Queues")
+        print("----------")
+        print()
+        for queue_name, stats in sorted(g15scheduler.get_queue_stats().items()):
+            print("%s (workers %d, limit %d, %s%s)" % ( queue_name, stats["workers"], stats["max_size"], stats["policy"], ", coalescing" if stats["coalesce"] else ""))
+            print("    Waiting: %d, Running: %d, Queued: %d, Executed: %d, Coalesced: %d, Dropped: %d" % \
+                  ( stats["depth"], stats["running"], stats["queued"], stats["executed"], stats["coalesced"], stats["dropped"] ))
+            for h in [ "wait", "run" ]:
+                print("    %-5s mean %.1fms, p50 <= %.0fms, p90 <= %.0fms, p99 <= %.0fms, max %.1fms" % \
+                      ( h.capitalize() + ":", stats[h]["mean"], stats[h]["p50"], stats[h]["p90"], stats[h]["p99"], stats[h]["max"] ))
+        
     @dbus.service.method(DEBUG_IF_NAME)
     def ShowGraph(self):
         objgraph.show_refs(self._service)
@@ -400,17 +413,23 @@ class G15Debug(g15plugin.G15RefreshingPlugin):
         self.resident = 0
         self.stack = 0
         self.only_refresh_when_visible = False
+        self._metrics_page = g15theme.G15Page("%s-metrics" % id, self.screen, title = _("Timings"),
+                                              painter = self._paint_metrics, originating_plugin = self)
+        self.screen.add_page(self._metrics_page)
         g15plugin.G15RefreshingPlugin.activate(self)
         self.do_refresh()
     
     def deactivate(self):            
         self._silently_remove_from_connector(self._debug_service)              
         g15plugin.G15RefreshingPlugin.deactivate(self)
+        self.screen.del_page(self._metrics_page)
         
     def refresh(self):
         self.memory = memory()
         self.resident = resident()
         self.stack = stacksize()
+        if self.screen.is_visible(self._metrics_page):
+            self.screen.redraw(self._metrics_page)
     
     def get_theme_properties(self): 
         properties = g15plugin.G15RefreshingPlugin.get_theme_properties(self)
@@ -434,6 +453,35 @@ class G15Debug(g15plugin.G15RefreshingPlugin):
         except Exception:
             pass
         
+    def _paint_metrics(self, canvas):
+        """
+        Paint the frame stage timings and queue wait times, slowest (by 90th
+        percentile) first, followed by the counters
+        """
+        rows = []
+        for stage, stats in self.screen.metrics.get_stats().items():
+            rows.append(( stage, stats ))
+        for queue_name, stats in g15scheduler.get_queue_stats().items():
+            rows.append(( "q:%s" % queue_name, stats["wait"] ))
+        rows.sort(key = lambda row: row[1]["p90"], reverse = True)
+        
+        if self.screen.driver.get_bpp() == 1:
+            font_name = g15globals.fixed_size_font_name
+            font_size = 6
+            lines = [ "%-12s %4.0f %5.0f" % ( stage[:12], stats["p90"], stats["max"] ) for stage, stats in rows ]
+        else:
+            font_name = "Monospace"
+            font_size = 10
+            lines = [ _("Stage                 p50    p90    max") ]
+            lines += [ "%-20s %6.0f %6.0f %6.0f" % ( stage[:20], stats["p50"], stats["p90"], stats["max"] ) for stage, stats in rows ]
+        lines += [ "%-14s %d" % ( counter[:14], value ) for counter, value in sorted(self.screen.metrics.get_counters().items()) ]
+            
+        self.text.set_canvas(canvas)
+        canvas.set_source_rgb(*self.screen.driver.get_color_as_ratios(g15driver.HINT_FOREGROUND, ( 0, 0, 0 )))
+        self.text.set_attributes("\n".join(lines), font_desc = font_name, \
+                                 font_absolute_size = font_size * Pango.SCALE)
+        self.text.draw(2, 0)
+        
     def _paint_panel(self, canvas, allocated_size, horizontal):
         if self.page and not self.screen.is_visible(self.page):
             # Don't display the date or seconds on mono displays, not enough room as it is
@@ -24,6 +24,7 @@ from gi.repository import Gtk
 from gnome15 import g15screen
 from gnome15 import g15driver
 from gnome15.util import g15uigconf
+from gnome15.util import g15scheduler
 import os
 import time
 import cairo
@@ -58,19 +59,199 @@ def show_preferences(parent, driver, gconf_client, gconf_key):
     
 effects = [ "vertical-scroll", "horizontal-scroll", "fade", "zoom" ]
 
+# Queue transition frames are painted on
+FX_QUEUE = "fxQueue"
+
+class Transition():
+    """
+    A single running transition. Frames are rendered one ahead of being painted,
+    and painted on a timer rather than sleeping on the redraw thread. Any frames
+    the screen paints while the transition is running become the new target
+    frame, and the last of these is painted when the transition finishes.
+    
+    Frames are painted outside of the screen's drawing, which goes on reusing
+    its own surfaces, so the transition works on copies of them.
+    """
+    
+    def __init__(self, fx, effect, speed, old_surface, new_surface, direction, chained_args):
+        self.fx = fx
+        self.screen = fx.screen
+        self.speed = speed
+        self.chained_args = chained_args
+        self.cancelled = False
+        self.timer = None
+        self.width = self.screen.width
+        self.height = self.screen.height
+        self.old_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+        self.new_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+        self._copy_surface(old_surface, self.old_surface)
+        self._copy_surface(new_surface, self.new_surface)
+        
+        # Frames should arrive no faster than the screen's maximum frame rate
+        self.interval = ( 1.0 - speed ) / 50.0 if speed < 1.0 else 0.0
+        max_fps = self.screen.redraw_scheduler.max_fps
+        if max_fps > 0:
+            self.interval = max(self.interval, 1.0 / max_fps)
+        
+        # The frame that will be painted on the next tick
+        self.img_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+        self.frames = self._frames(effect, direction, cairo.Context(self.img_surface))
+        self.ready = next(self.frames, None) is not None
+        self.o_painter = self.screen.set_painter(self._paint)
+        
+    def start(self):
+        self.timer = g15scheduler.queue(FX_QUEUE, "TransitionFrame", 0, self._tick)
+        
+    def cancel(self):
+        self.cancelled = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self._restore_painter()
+        
+    """
+    Private
+    """
+        
+    def _paint(self, surface):
+        # Called by the screen (with its draw lock held) while the transition is running
+        self._copy_surface(surface, self.new_surface)
+        
+    def _copy_surface(self, source, target):
+        ctx = cairo.Context(target)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.set_source_surface(source)
+        ctx.paint()
+        
+    def _restore_painter(self):
+        if self.screen.painter_function == self._paint:
+            self.screen.set_painter(self.o_painter)
+        
+    def _tick(self):
+        self.screen.draw_lock.acquire()
+        try:
+            if self.cancelled or self.screen.driver is None or not self.screen.driver.is_connected():
+                return
+            if self.ready:
+                started = time.time()
+                self.screen.driver.paint(self.img_surface)
+                
+                # Render the next frame now, while waiting for it to be due
+                self.ready = next(self.frames, None) is not None
+                if self.ready:
+                    self.timer = g15scheduler.queue(FX_QUEUE, "TransitionFrame",
+                                                    max(0.0, self.interval - ( time.time() - started )),
+                                                    self._tick)
+                    return
+                
+            # Finished, paint the latest frame from the screen and let it paint again
+            self._restore_painter()
+            self.screen.frame_diff.reset()
+            if self.o_painter != None:
+                self.o_painter(self.new_surface)
+            else:
+                self.screen.driver.paint(self.new_surface)
+            self.fx._transition_finished(self)
+        finally:
+            self.screen.draw_lock.release()
+            
+    def _frames(self, effect, direction, img_context):
+        """
+        Generator that draws each frame of the effect on to img_context
+        """
+        width = self.width
+        height = self.height
+        speed = self.speed
+        if effect == "vertical-scroll":
+            # Vertical scroll
+            step = max( int(speed), 1 )      
+            for i in range(0, height, step):
+                img_context.save()
+                if direction == "down":                
+                    img_context.translate(0, -i)                
+                    img_context.set_source_surface(self.old_surface)
+                    img_context.paint()
+                    img_context.translate(0, height)
+                    img_context.set_source_surface(self.new_surface)
+                else:
+                    img_context.translate(0, -(height - i))                
+                    img_context.set_source_surface(self.new_surface)
+                    img_context.paint()
+                    img_context.translate(0, height)
+                    img_context.set_source_surface(self.old_surface)
+                img_context.paint()
+                img_context.restore()
+                yield img_context
+                
+        elif effect == "horizontal-scroll":    
+            # Horizontal scroll
+            step = max( ( width / height ) * speed, 1 )
+            for i in range(0, width, int(step)):
+                img_context.save()
+                if direction == "down":                
+                    img_context.translate(-i, 0)                
+                    img_context.set_source_surface(self.old_surface)
+                    img_context.paint()
+                    img_context.translate(width, 0)
+                    img_context.set_source_surface(self.new_surface)
+                else:
+                    img_context.translate(-(width - i), 0)                
+                    img_context.set_source_surface(self.new_surface)
+                    img_context.paint()
+                    img_context.translate(width, 0)
+                    img_context.set_source_surface(self.old_surface)
+                img_context.paint()
+                img_context.restore()
+                yield img_context
+                
+        elif effect == "fade":
+            step = max( int(speed), 1 )
+            for i in range(0, 256, step):                
+                img_context.set_source_surface(self.new_surface)
+                img_context.paint_with_alpha(float(i) / 256.0)                
+                img_context.set_source_surface(self.old_surface)
+                img_context.paint_with_alpha(1.0 - ( float(i) / 256.0 ) )
+                yield img_context
+                
+        elif effect == "zoom":
+            step = max( int(speed), 1 )
+            if direction == "down":
+                sizes = range(1, width, step)
+                back, front = "old_surface", "new_surface"
+            else:
+                sizes = range(width, 0, step * -1)
+                back, front = "new_surface", "old_surface"
+            for i in sizes:
+                img_context.save()                
+                img_context.set_source_surface(getattr(self, back))
+                img_context.paint() 
+                scale = i / float(width)
+                scaled_width = width * scale
+                scaled_height = height * scale
+                img_context.translate( ( width - scaled_width) / 2, ( height - scaled_height) / 2)  
+                img_context.scale(scale, scale)            
+                img_context.set_source_surface(getattr(self, front))
+                img_context.paint()               
+                img_context.restore()             
+                yield img_context
+
 class G15Fx():
     
     def __init__(self, gconf_key, gconf_client, screen):
         self.screen = screen
         self.gconf_client = gconf_client
         self.gconf_key = gconf_key
+        self.current_transition = None
+        self.effect = "random"
+        self.speed = 5.0
     
     def activate(self):
+        self._load_configuration()
         self.chained_transition =self.screen.set_transition(self.transition)
         self.notify_handler = self.gconf_client.notify_add(self.gconf_key, self.config_changed)
     
     def deactivate(self):
         self.gconf_client.notify_remove(self.notify_handler)
+        self._cancel_transition()
         self.screen.set_transition(self.chained_transition)
         
     def destroy(self):
@@ -80,131 +261,46 @@ class G15Fx():
     '''
         
     def config_changed(self, client, connection_id, entry, *args):
+        self._load_configuration()
         self.screen.redraw()
     
     
     def transition(self, old_surface, new_surface, old_page, new_page, direction="up"):
+        # A newer page change replaces any transition that is still running
+        self._cancel_transition()
+        
         # Determine effect to use
-        effect = self.gconf_client.get_string(self.gconf_key + "/transition_effect")
-        if effect == "":
-            effect = "random"
+        effect = self.effect
         if effect == "random":
             effect = effects[int(random.random() * len(effects))]
-            
-        # Animation speed
-        speed_entry =  self.gconf_client.get(self.gconf_key + "/anim_speed")
-        speed = 5.0 if speed_entry == None else speed_entry.get_float()
         
         # Don't transition for high priority screens
         if new_page == None or old_page == None or new_page.priority == g15screen.PRI_HIGH:
             return
         
-        width = self.screen.width
-        height = self.screen.height  
+        self.current_transition = Transition(self, effect, self.speed, old_surface, new_surface, direction,
+                                             ( old_page, new_page, direction ))
+        self.current_transition.start()
         
-        # Create a working surface
-        img_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.screen.width, self.screen.height)
-        img_context = cairo.Context(img_surface)
-        if effect == "vertical-scroll":
-            # Vertical scroll
-            step = max( int(speed), 1 )      
-            if direction == "down":                
-                for i in range(0, self.screen.height, step):
-                    img_context.save()
-                    img_context.translate(0, -i)                
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.translate(0, self.screen.height)
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-            else:                
-                for i in range(0, self.screen.height, step):
-                    img_context.save() 
-                    img_context.translate(0, -(self.screen.height - i))                
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.translate(0, self.screen.height)
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-                
-        elif effect == "horizontal-scroll":    
-            # Horizontal scroll
-            step = max( ( width / height ) * speed, 1 )
-            if direction == "down":                
-                for i in range(0, self.screen.width, int(step)):
-                    img_context.save()
-                    img_context.translate(-i, 0)                
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.translate(self.screen.width, 0)
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-            else:                
-                for i in range(0, self.screen.width, int(step)):
-                    img_context.save() 
-                    img_context.translate(-(self.screen.width - i), 0)                
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.translate(self.screen.width, 0)
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-        elif effect == "fade":
-            step = max( int(speed), 1 )
-            for i in range(0, 256, step):                
-                img_context.set_source_surface(new_surface)
-                img_context.paint_with_alpha(float(i) / 256.0)                
-                img_context.set_source_surface(old_surface)
-                img_context.paint_with_alpha(1.0 - ( float(i) / 256.0 ) )
-                self.screen.driver.paint(img_surface)
-                self.anim_delay(speed)
-        elif effect == "zoom":
-            step = max( int(speed), 1 )
-            if direction == "down":               
-                for i in range(1, self.screen.width, step):
-                    img_context.save()                
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint() 
-                    scale = i / float(self.screen.width)
-                    scaled_width = self.screen.width * scale
-                    scaled_height = self.screen.height * scale
-                    img_context.translate( ( self.screen.width - scaled_width) / 2, ( self.screen.height - scaled_height) / 2)  
-                    img_context.scale(scale, scale)            
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()               
-                    img_context.restore()             
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-            else:                
-                for i in range(self.screen.width, 0, step * -1):
-                    img_context.save()             
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()               
-                    scale = i / float(self.screen.width)
-                    scaled_width = self.screen.width * scale
-                    scaled_height = self.screen.height * scale
-                    img_context.translate( ( self.screen.width - scaled_width) / 2, ( self.screen.height - scaled_height) / 2)  
-                    img_context.scale(scale, scale)            
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()               
-                    img_context.restore()  
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-                
+    '''
+    Private
+    '''
+    
+    def _load_configuration(self):
+        effect = self.gconf_client.get_string(self.gconf_key + "/transition_effect")
+        self.effect = "random" if effect is None or effect == "" else effect
+        
+        # Animation speed
+        speed_entry =  self.gconf_client.get(self.gconf_key + "/anim_speed")
+        self.speed = 5.0 if speed_entry == None else speed_entry.get_float()
+        
+    def _cancel_transition(self):
+        if self.current_transition is not None:
+            self.current_transition.cancel()
+            self.current_transition = None
+    
+    def _transition_finished(self, transition):
+        if self.current_transition == transition:
+            self.current_transition = None
         if self.chained_transition != None:
-            self.chained_transition(old_surface, new_surface, old_page, new_page, direction)
-
-    def anim_delay(self, speed):
-        if speed < 1.0:
-            time.sleep( ( 1.0 - speed ) / 50.0 )
+            self.chained_transition(transition.old_surface, transition.new_surface, *transition.chained_args)
@@ -467,6 +467,14 @@ class G15DaemonServer():
     def join(self, client):
         self.clients.append(client)
                     
+    def is_consuming_keys(self, keys, state):
+        if self.take_over_macro_keys:
+            visible = self.screen.get_visible_page()    
+            for client in list(self.clients):
+                if client.enable_keys and client.page == visible:
+                    return True
+        return False
+                    
     def handle_key(self, keys, state, post):
         if ( not post and self.take_over_macro_keys ) or ( post and not self.take_over_macro_keys ):
             visible = self.screen.get_visible_page()    
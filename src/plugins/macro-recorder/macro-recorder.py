@@ -150,6 +150,10 @@ class G15MacroRecorder():
                 self._cancel_macro(None)
                 return True
     
+    def is_consuming_keys(self, keys, state):
+        # All keys are wanted while recording
+        return self._record_thread != None
+    
     def handle_key(self, keys, state, post):
         # Memory keys
                             
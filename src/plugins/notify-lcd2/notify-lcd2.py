@@ -483,6 +483,13 @@ class G15NotifyLCD():
     def destroy(self):
         pass 
                     
+    def is_consuming_keys(self, keys, state):
+        if self._screen.get_page("NotifyLCD") != None:
+            for k in [ g15driver.G_KEY_BACK, g15driver.G_KEY_L3, g15driver.G_KEY_RIGHT, g15driver.G_KEY_L4, g15driver.G_KEY_OK, g15driver.G_KEY_L5 ]:
+                if k in keys:
+                    return True
+        return False
+                    
     def handle_key(self, keys, state, post):
         if not post and state == g15driver.KEY_STATE_UP:            
             page = self._screen.get_page("NotifyLCD")
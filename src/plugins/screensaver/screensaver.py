@@ -156,6 +156,9 @@ class G15ScreenSaver():
         if self._session_bus:
             self._session_bus.remove_signal_receiver(self._screensaver_changed_handler, dbus_interface = self._dbus_interface, signal_name = "ActiveChanged")
         
+    def is_consuming_keys(self, keys, state):
+        return self._page is not None
+        
     def handle_key(self, keys, state, post):
         # Sinks all keyboard events when the page is active
         return self._page is not None
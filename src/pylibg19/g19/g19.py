@@ -25,6 +25,13 @@ import logging
 import array
 logger = logging.getLogger(__name__)
 
+# Use the shared Gnome15 frame encoder if it is available
+try:
+    from gnome15.util import g15frame
+except ImportError as e:
+    logger.debug("Gnome15 frame encoder not available", exc_info = e)
+    g15frame = None
+
 class G19(object):
     '''Simple access to Logitech G19 features.
 
@@ -49,6 +56,9 @@ class G19(object):
             self.__frame_content.append(i)
         for i in range(256):
             self.__frame_content.append(i)
+        # Header and frame data are written into the same buffer for every frame
+        self.__frame_buffer = bytearray(self.__frame_content) + bytearray(320 * 240 * 2)
+        self.__frame_data = memoryview(self.__frame_buffer)[len(self.__frame_content):]
 
     @staticmethod
     def convert_image_to_frame(filename):
@@ -61,10 +71,13 @@ class G19(object):
 
         '''
         img = Img.open(filename)
-        access = img.load()
         if img.size != (320, 240):
             img = img.resize((320, 240), Img.CUBIC)
-            access = img.load()
+        if g15frame is not None:
+            # Get the raw data in the same layout as a cairo ARGB32 surface
+            raw = img.convert("RGBA").tobytes("raw", "BGRA" if sys.byteorder == "little" else "ARGB")
+            return bytes(g15frame.RGB565Encoder(320, 240, transpose = True).encode_buffer(raw, 320 * 4))
+        access = img.load()
         data = []
         for x in range(320):
             for y in range(240):
@@ -111,7 +124,7 @@ class G19(object):
         value = self.rgb_to_uint16(r, g, b)
         valueH = value & 0xff
         valueL = value >> 8
-        frame = [valueL, valueH] * (320 * 240)
+        frame = bytes([valueL, valueH]) * (320 * 240)
         self.send_frame(frame)
 
     def load_image(self, filename):
@@ -209,7 +222,8 @@ class G19(object):
         '''Sends a frame to display.
 
         @param data 320x240x2 bytes, containing the frame in little-endian
-        16bit highcolor (5-6-5) format.
+        16bit highcolor (5-6-5) format. May be a list or any buffer (such as
+        the output of g15frame.RGB565Encoder).
         Image must be row-wise, starting at upper left corner and ending at
         lower right.  This means (data[0], data[1]) is the first pixel and
         (data[239 * 2], data[239 * 2 + 1]) the lower left one.
@@ -218,12 +232,10 @@ class G19(object):
         if len(data) != (320 * 240 * 2):
             raise ValueError("illegal frame size: " + str(len(data))
                     + " should be 320x240x2=" + str(320 * 240 * 2))
-        frame = list(self.__frame_content)
-        frame += data
-
         self.__usbDeviceMutex.acquire()
         try:
-            self.__usbDevice.handleIf0.bulkWrite(0x02, frame, self.__write_timeout)
+            self.__frame_data[:] = bytes(data) if isinstance(data, list) else data
+            self.__usbDevice.handleIf0.bulkWrite(0x02, self.__frame_buffer, self.__write_timeout)
         finally:
             self.__usbDeviceMutex.release()
 